@@ -0,0 +1,88 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import antientropy
+import digest
+import neighbors
+
+# Measures anti-entropy reconciliation of two directories which differ in a fraction
+# of files: bytes exchanged (beacon, bucket digests and file digests in both directions)
+# and time spent building digests and comparing them, compared with sending heads of
+# all files.
+#
+# python3 antientropy_benchmark.py --files 10000 --divergence 0.01
+
+
+def create_digests(files_n, divergence, seed=0):
+    rnd = random.Random(seed)
+    local, remote = digest.DirectoryDigest(), digest.DirectoryDigest()
+
+    paths = ["dir%d/file%d.txt" % (i % 100, i) for i in range(files_n)]
+    for path in paths:
+        head = rnd.getrandbits(128).to_bytes(16, 'big')
+        local.update(path, 10, head)
+        remote.update(path, 10, head)
+
+    differing = set(rnd.sample(paths, int(files_n * divergence)))
+    for path in differing:
+        remote.update(path, 11, rnd.getrandbits(128).to_bytes(16, 'big'))
+
+    return local, remote, differing
+
+
+def reconcile(local, remote):
+    exchanged = {}
+
+    def send(name, message):
+        data = message.to_bytes()
+        exchanged[name] = exchanged.get(name, 0) + len(data)
+        return type(message).from_bytes(data)
+
+    beacon = send("beacon", neighbors.Beacon(bytes(16), neighbors.CAPABILITY_ANTI_ENTROPY, remote.root()))
+    if beacon.summary == local.root():
+        return set(), exchanged
+
+    bucket_digests = send("bucket digests", antientropy.BucketDigests(local.bucket_digests()))
+    buckets = remote.differing_buckets(bucket_digests.digests)
+
+    remote_files = send("file digests", antientropy.FileDigests(buckets, remote.files_in_buckets(buckets)))
+    local_files = send("file digests", antientropy.FileDigests(buckets, local.files_in_buckets(buckets), reply=True))
+
+    local_heads = {path: head for path, _, head in local_files.files}
+    differing = {path for path, _, head in remote_files.files if local_heads.get(path) != head}
+
+    return differing, exchanged
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--files", type=int, default=10000, help="Number of files")
+    parser.add_argument("-d", "--divergence", type=float, default=0.01, help="Fraction of files which differ")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    local, remote, expected = create_digests(args.files, args.divergence)
+    print("digests of %d files built in %.3fs" % (args.files, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    found, exchanged = reconcile(local, remote)
+    elapsed = time.perf_counter() - start
+
+    assert found == expected, "reconciliation found %d of %d differing files" % (len(found & expected), len(expected))
+
+    for name, size in exchanged.items():
+        print("%-16s %10d bytes" % (name, size))
+    print("%-16s %10d bytes" % ("total", sum(exchanged.values())))
+    print("found %d differing files in %.3fs" % (len(found), elapsed))
+
+    all_files = antientropy.FileDigests(list(range(digest.BUCKETS_N)), remote.files_in_buckets(range(digest.BUCKETS_N)))
+    print("heads of all files: %d bytes" % len(all_files.to_bytes()))
+
+
+if __name__ == '__main__':
+    main()
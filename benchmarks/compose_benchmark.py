@@ -0,0 +1,104 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rdiff
+
+# Compares catching up with a number of sequential patches of a large file by applying
+# them one after another (a rewrite and a full signature per patch) with composing their
+# deltas and applying the result once (one rewrite and one signature update).
+#
+# python3 compose_benchmark.py --size 256M --patches 16
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def write_random_file(path, size):
+    chunk = 1024 * 1024
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(chunk, size)
+            f.write(os.urandom(n))
+            size -= n
+
+
+# Overwrites a few places in the file and appends some data
+def modify(path, rnd):
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        for _ in range(4):
+            f.seek(rnd.randrange(max(1, size)))
+            f.write(os.urandom(16))
+
+        f.seek(0, os.SEEK_END)
+        f.write(os.urandom(1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--size", default="64M", help="File size")
+    parser.add_argument("-p", "--patches", type=int, default=16, help="Number of sequential patches")
+    args = parser.parse_args()
+
+    backend = rdiff.NativeBackend()
+    rnd = random.Random(0)
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, "source")
+        basis = os.path.join(workdir, "basis")
+        patched = os.path.join(workdir, "patched")
+
+        write_random_file(source, parse_size(args.size))
+        shutil.copyfile(source, basis)
+        signature = backend.signature(source)
+
+        deltas = []
+        for _ in range(args.patches):
+            modify(source, rnd)
+            deltas.append(backend.delta(signature, source))
+            signature = backend.signature(source)
+
+        target = os.path.join(workdir, "target")
+
+        shutil.copyfile(basis, target)
+        start = time.perf_counter()
+        for delta in deltas:
+            backend.patch(target, delta, patched)
+            os.replace(patched, target)
+            signature = backend.signature(target)
+        sequential = time.perf_counter() - start
+
+        shutil.copyfile(basis, target)
+        basis_signature = backend.signature(basis)
+        start = time.perf_counter()
+        delta = rdiff.compose_deltas(deltas)
+        backend.patch(target, delta, patched)
+        os.replace(patched, target)
+        composed_signature = backend.update_signature(basis_signature, delta, target)
+        composed = time.perf_counter() - start
+
+        if composed_signature != signature:
+            raise Exception("Signature of composed result differs")
+
+        print("sequential: %.3fs, composed: %.3fs (%d patches, %d bytes of deltas, %d bytes composed)"
+              % (sequential, composed, len(deltas), sum(map(len, deltas)), len(delta)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import hashing
+
+# Compares hashing of files with sha1sum subprocess (used by older versions), in-process
+# hashing and HashCache lookups of unchanged files.
+#
+# python3 hashing_benchmark.py --files 200 --size 1M
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def measure(name, paths, fn):
+    start = time.perf_counter()
+    for path in paths:
+        fn(path)
+    elapsed = time.perf_counter() - start
+
+    print("%-12s %8.3fs %10.1f us/file" % (name, elapsed, elapsed / len(paths) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--files", type=int, default=200, help="Number of files")
+    parser.add_argument("-s", "--size", default="1M", help="Size of every file")
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(directory, "file%d" % i)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            paths.append(path)
+
+        # Files must not be modified right before they are hashed for digests to be trusted
+        time.sleep(hashing.RACY_INTERVAL_NS / 1e9)
+
+        cache = hashing.HashCache()
+
+        measure("sha1sum", paths, lambda path: subprocess.check_output(["sha1sum", "-b", path])[:40])
+        measure("native", paths, hashing.file_digest)
+        measure("cache miss", paths, cache.digest)
+        measure("cache hit", paths, cache.digest)
+
+        print(cache.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rdiff
+import vcs
+
+# Measures commit throughput of VCS when several threads commit changes concurrently.
+# Threads are spread over a number of distinct files - with per-file locks throughput
+# should grow with the number of files.
+#
+# python3 lock_benchmark.py --threads 8 --files 1,2,4,8 --size 4M
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def worker(file_vcs, name, path, size, deadline, counter, counter_lock):
+    commits = 0
+    while time.monotonic() < deadline:
+        # Change beginning of the file so that a delta has to be computed
+        with open(path, 'r+b') as f:
+            f.write(os.urandom(64))
+
+        with file_vcs.file_version_control(name) as file:
+            file.commit()
+        commits += 1
+
+    with counter_lock:
+        counter[0] += commits
+
+
+def run(threads_n, files_n, size, duration):
+    directory = tempfile.mkdtemp()
+    try:
+        file_vcs = vcs.VCS(directory)
+
+        names = ["file%d" % i for i in range(files_n)]
+        for name in names:
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(os.urandom(size))
+
+        counter = [0]
+        counter_lock = threading.Lock()
+        deadline = time.monotonic() + duration
+
+        threads = []
+        for i in range(threads_n):
+            name = names[i % files_n]
+            thread = threading.Thread(target=worker, args=(file_vcs, name, os.path.join(directory, name),
+                                                           size, deadline, counter, counter_lock))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return counter[0] / duration
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--threads", type=int, default=8, help="Number of committing threads")
+    parser.add_argument("-f", "--files", default="1,2,4,8", help="Comma separated numbers of distinct files")
+    parser.add_argument("-s", "--size", type=parse_size, default=parse_size("1M"), help="Size of every file")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="Duration of every run in seconds")
+    parser.add_argument("-b", "--backend", choices=rdiff.BACKENDS, default=rdiff.DEFAULT_BACKEND, help="Delta backend")
+    args = parser.parse_args()
+
+    rdiff.set_backend(args.backend, args.threads)
+
+    print("%-8s %-8s %12s" % ("threads", "files", "commits/s"))
+    for files_n in args.files.split(","):
+        throughput = run(args.threads, int(files_n), args.size, args.duration)
+        print("%-8d %-8s %12.1f" % (args.threads, files_n, throughput))
+
+
+if __name__ == '__main__':
+    main()
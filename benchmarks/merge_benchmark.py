@@ -0,0 +1,73 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import merge
+
+# Measures three-way merge of concurrent versions of a large text file: lines appended
+# on both sides (a log), edits in distant parts of the file and edits of nearby lines
+# (the overlapping window is compared line by line).
+#
+# python3 merge_benchmark.py --sizes 1M,16M
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def create_lines(size, rnd):
+    lines = []
+    while size > 0:
+        line = ("%d %x\n" % (len(lines), rnd.getrandbits(256))).encode()
+        lines.append(line)
+        size -= len(line)
+    return lines
+
+
+def replace_line(lines, index, rnd):
+    lines = list(lines)
+    lines[index] = ("changed %x\n" % rnd.getrandbits(64)).encode()
+    return lines
+
+
+def cases(size, rnd):
+    lines = create_lines(size, rnd)
+    base = b"".join(lines)
+    n = len(lines)
+
+    yield "append", base, base + b"x\n" * 100, base + b"y\n" * 100
+    yield "distant", base, b"".join(replace_line(lines, n // 4, rnd)), b"".join(replace_line(lines, 3 * n // 4, rnd))
+    yield "nearby", base, b"".join(replace_line(lines, n // 2, rnd)), b"".join(replace_line(lines, n // 2 + 2, rnd))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", default="1M,16M", help="Comma separated file sizes")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+
+    print("%-8s %-10s %12s" % ("size", "case", "merge[s]"))
+    for size_str in args.sizes.split(","):
+        for name, base, x, y in cases(parse_size(size_str), rnd):
+            start = time.perf_counter()
+            merged = merge.merge(base, x, y)
+            elapsed = time.perf_counter() - start
+
+            if merged is None:
+                raise Exception("Versions were not merged")
+
+            print("%-8s %-10s %12.4f" % (size_str, name, elapsed))
+
+
+if __name__ == '__main__':
+    main()
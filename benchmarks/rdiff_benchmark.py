@@ -0,0 +1,120 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rdiff
+
+# Compares delta backends: signature, delta and patch times for a file with a few
+# small modifications (overwrites, insertion and deletion).
+#
+# python3 rdiff_benchmark.py --sizes 1K,1M,64M,1G
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def write_random_file(path, size):
+    chunk = 1024 * 1024
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(chunk, size)
+            f.write(os.urandom(n))
+            size -= n
+
+
+# Copies file, changing a few places in it
+def write_modified_copy(src, dst, size, edits=4):
+    shutil.copyfile(src, dst)
+
+    rnd = random.Random(size)
+    with open(dst, 'r+b') as f:
+        for _ in range(edits):
+            f.seek(rnd.randrange(max(1, size)))
+            f.write(os.urandom(16))
+
+    # Insert and delete some bytes in the middle
+    with open(dst, 'rb') as f:
+        head = f.read(size // 2)
+        f.seek(size // 2 + 100)
+        tail = f.read()
+
+    with open(dst, 'wb') as f:
+        f.write(head)
+        f.write(os.urandom(37))
+        f.write(tail)
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def files_equal(path1, path2):
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            b1 = f1.read(1024 * 1024)
+            b2 = f2.read(1024 * 1024)
+            if b1 != b2:
+                return False
+            if not b1:
+                return True
+
+
+def run(backend, basis, modified, patched):
+    signature, t_sig = measure(backend.signature, basis)
+    delta, t_delta = measure(backend.delta, signature, modified)
+    _, t_patch = measure(backend.patch, basis, delta, patched)
+
+    if not files_equal(modified, patched):
+        raise Exception("%s: patched file differs from the modified one" % backend.name)
+
+    return t_sig, t_delta, t_patch, len(delta)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", default="1K,64K,1M,16M,256M,1G", help="Comma separated file sizes")
+    parser.add_argument("-b", "--backends", default=",".join(rdiff.BACKENDS), help="Comma separated backends")
+    args = parser.parse_args()
+
+    backends = []
+    for name in args.backends.split(","):
+        if name == "rdiff" and shutil.which("rdiff") is None:
+            print("rdiff binary not found, skipping rdiff backend")
+            continue
+        backends.append(rdiff.create_backend(name))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        basis = os.path.join(workdir, "basis")
+        modified = os.path.join(workdir, "modified")
+        patched = os.path.join(workdir, "patched")
+
+        print("%-8s %-16s %12s %12s %12s %12s" % ("size", "backend", "signature[s]", "delta[s]", "patch[s]", "delta[B]"))
+        for size_str in args.sizes.split(","):
+            size = parse_size(size_str)
+            write_random_file(basis, size)
+            write_modified_copy(basis, modified, size)
+
+            for backend in backends:
+                t_sig, t_delta, t_patch, delta_len = run(backend, basis, modified, patched)
+                print("%-8s %-16s %12.4f %12.4f %12.4f %12d" % (size_str, backend.name, t_sig, t_delta, t_patch, delta_len))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
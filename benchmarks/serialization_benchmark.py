@@ -0,0 +1,94 @@
+import argparse
+import os
+import pickle
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import vcs
+
+# Compares binary serialization of patches and version histories with pickle
+# (used by older versions): encoded size, encode and decode time.
+#
+# python3 serialization_benchmark.py --deltas 100,64K,4M --commits 1024
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def create_commit():
+    commit = vcs.Commit()
+    commit.author = uuid.uuid4()
+    commit.id = uuid.uuid1()
+    return commit
+
+
+def create_history(commits_n, signature_size):
+    history = vcs.VersionHistory()
+    for _ in range(commits_n):
+        history.append(create_commit(), os.urandom(signature_size))
+    return history
+
+
+def create_patch(history, delta_size):
+    patch = vcs.FilePatch()
+    patch.relative_path = "some/directory/file.txt"
+    patch.parent_length = history.length
+    patch.parent_chain = history.head()
+    patch.commits = [create_commit()]
+    patch.delta = os.urandom(delta_size)
+    return patch
+
+
+# Returns average time of a single call in microseconds
+def measure(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def compare(name, obj, cls, repeat):
+    pickled = pickle.dumps(obj)
+    encoded = obj.to_bytes()
+
+    results = [
+        ("pickle", len(pickled), measure(lambda: pickle.dumps(obj), repeat), measure(lambda: pickle.loads(pickled), repeat)),
+        ("binary", len(encoded), measure(lambda: obj.to_bytes(), repeat), measure(lambda: cls.from_bytes(encoded), repeat)),
+    ]
+
+    for codec, size, encode_time, decode_time in results:
+        print("%-24s %-8s %12d %12.1f %12.1f" % (name, codec, size, encode_time, decode_time))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--deltas", default="100,64K,4M", help="Comma separated delta sizes of patches")
+    parser.add_argument("-c", "--commits", type=int, default=vcs.COMMITS_RETENTION, help="Commits in version history")
+    parser.add_argument("-s", "--signature-size", type=parse_size, default=parse_size("4K"), help="Size of every signature")
+    parser.add_argument("-r", "--repeat", type=int, default=200, help="Repetitions of every operation")
+    args = parser.parse_args()
+
+    history = create_history(args.commits, args.signature_size)
+
+    print("%-24s %-8s %12s %12s %12s" % ("object", "codec", "bytes", "encode us", "decode us"))
+    for delta_size in args.deltas.split(","):
+        patch = create_patch(history, parse_size(delta_size))
+        compare("patch (delta %s)" % delta_size, patch, vcs.FilePatch, args.repeat)
+
+    compare("history (%d commits)" % history.length, history, vcs.VersionHistory, max(1, args.repeat // 10))
+
+    record = vcs.HistoryRecord(vcs.HistoryRecord.APPEND, commit=create_commit(), signature=os.urandom(args.signature_size))
+    compare("history record", record, vcs.HistoryRecord, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rdiff
+
+# Compares computing signature of a modified file from scratch with updating signature
+# of its previous version using the delta (only blocks which were not copied whole
+# are hashed). A few small edits are made in a large file, the updated signature must
+# be identical to the full one.
+#
+# python3 signature_benchmark.py --sizes 16M,256M,1G --edits 4
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def write_random_file(path, size):
+    chunk = 1024 * 1024
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(chunk, size)
+            f.write(os.urandom(n))
+            size -= n
+
+
+# Overwrites a few places in the file and appends some data
+def modify(path, size, edits):
+    rnd = random.Random(size)
+    with open(path, 'r+b') as f:
+        for _ in range(edits):
+            f.seek(rnd.randrange(max(1, size)))
+            f.write(os.urandom(16))
+
+        f.seek(0, os.SEEK_END)
+        f.write(os.urandom(1000))
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", default="16M,256M", help="Comma separated file sizes")
+    parser.add_argument("-e", "--edits", type=int, default=4, help="Number of small edits")
+    args = parser.parse_args()
+
+    backend = rdiff.NativeBackend()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, "file")
+
+        print("%-8s %12s %12s %12s" % ("size", "delta[s]", "full[s]", "update[s]"))
+        for size_str in args.sizes.split(","):
+            size = parse_size(size_str)
+            write_random_file(path, size)
+            signature = backend.signature(path)
+
+            modify(path, size, args.edits)
+            delta, t_delta = measure(backend.delta, signature, path)
+            full, t_full = measure(backend.signature, path)
+            updated, t_update = measure(backend.update_signature, signature, delta, path)
+
+            if updated != full:
+                raise Exception("Updated signature differs from the full one")
+
+            print("%-8s %12.4f %12.4f %12.4f" % (size_str, t_delta, t_full, t_update))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import communication
+
+# Measures throughput of fragmented transport on loopback: sender splits messages
+# with Fragmenter and receiver puts them back together with Reassembler.
+#
+# python3 transport_benchmark.py --sizes 1M,4M,16M --count 20
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+class Receiver:
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.received_bytes = 0
+        self.done = threading.Event()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, communication.SOCKET_BUFFER_SIZE)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(1)
+
+        self.reassembler = communication.Reassembler()
+        self.thread = threading.Thread(target=self.listen)
+        self.thread.start()
+
+    def listen(self):
+        buffer = bytearray(communication.MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+
+        while self.received < self.expected:
+            try:
+                nbytes, addr = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                break
+
+            _, message = self.reassembler.add(view[:nbytes])
+            if message is not None:
+                self.received += 1
+                self.received_bytes += len(message)
+
+        self.done.set()
+
+
+def run(size, count, payload_size, max_rate):
+    receiver = Receiver(count)
+    address = receiver.sock.getsockname()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, communication.SOCKET_BUFFER_SIZE)
+    fragmenter = communication.Fragmenter(bytes(16), payload_size, max_rate)
+
+    data = os.urandom(size)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        fragmenter.send(sock, data, address)
+
+    receiver.done.wait()
+    elapsed = time.perf_counter() - start
+    receiver.thread.join()
+
+    return receiver.received, receiver.received_bytes / elapsed / 1024 / 1024, receiver.reassembler.dropped_n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", default="64K,1M,4M,16M", help="Comma separated message sizes")
+    parser.add_argument("-c", "--count", type=int, default=20, help="Messages sent per size")
+    parser.add_argument("-p", "--payload", type=int, default=communication.DEFAULT_FRAGMENT_PAYLOAD,
+                        help="Fragment payload size")
+    parser.add_argument("-r", "--rate", type=parse_size, default=None,
+                        help="Sender rate limit in bytes per second (e.g. 200M)")
+    args = parser.parse_args()
+
+    print("%-8s %10s %12s %10s" % ("size", "received", "MB/s", "dropped"))
+    for size_str in args.sizes.split(","):
+        received, throughput, dropped = run(parse_size(size_str), args.count, args.payload, args.rate)
+        print("%-8s %5d/%-4d %12.1f %10d" % (size_str, received, args.count, throughput, dropped))
+
+
+if __name__ == '__main__':
+    main()
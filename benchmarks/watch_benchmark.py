@@ -0,0 +1,86 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# Measures time of the initial scan and of adding inotify watches for a large directory tree.
+#
+# python3 watch_benchmark.py --files 100000 --fanout 10 --depth 3
+
+
+class NullHandler:
+    def __call__(self, event):
+        pass
+
+
+# Creates tree with fanout^depth leaf directories and files spread evenly over all directories
+def create_tree(root, files_n, fanout, depth):
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                path = os.path.join(parent, "d%d" % i)
+                os.mkdir(path)
+                next_level.append(path)
+        directories += next_level
+        level = next_level
+
+    for i in range(files_n):
+        with open(os.path.join(directories[i % len(directories)], "f%d" % i), 'w') as f:
+            f.write("x")
+
+    return len(directories)
+
+
+def scan(root):
+    files = 0
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    files += 1
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--files", type=int, default=100000, help="Number of files")
+    parser.add_argument("-n", "--fanout", type=int, default=10, help="Subdirectories per directory")
+    parser.add_argument("-d", "--depth", type=int, default=3, help="Depth of the tree")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        directories_n = create_tree(root, args.files, args.fanout, args.depth)
+        print("created %d files in %d directories in %.2fs" % (args.files, directories_n, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        files_n = scan(root)
+        print("scan: %d files in %.3fs" % (files_n, time.perf_counter() - start))
+
+        try:
+            import monitor
+        except ImportError as e:
+            print("watch setup skipped: %s" % e)
+            return
+
+        start = time.perf_counter()
+        watcher = monitor.Watcher(root, NullHandler())
+        print("watch setup: %d watches in %.3fs" % (len(watcher.wds), time.perf_counter() - start))
+        watcher.stop()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+import threading
+import time
+import logging
+
+import digest
+import neighbors
+from serialization import Serializable
+
+# Minimal number of seconds between reconciliations with the same neighbor
+DEFAULT_INTERVAL = 30
+
+
+class BucketDigests(Serializable):
+    TYPE_ID = 7
+    SCHEMA_VERSION = 1
+
+    def __init__(self, digests=None):
+        self.digests = digests
+
+    def encode(self, writer):
+        writer.write_fixed_array(self.digests)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        return cls(reader.read_fixed_array(digest.DIGEST_SIZE))
+
+
+# Heads of all files in some buckets. reply is set if the message is an answer to
+# FileDigests of the other node (so it is not answered again).
+class FileDigests(Serializable):
+    TYPE_ID = 8
+    SCHEMA_VERSION = 1
+
+    def __init__(self, buckets=None, files=None, reply=False):
+        self.buckets = buckets
+        self.files = files
+        self.reply = reply
+
+    def encode(self, writer):
+        writer.write_varint(len(self.buckets))
+        for bucket in self.buckets:
+            writer.write_varint(bucket)
+
+        writer.write_varint(len(self.files))
+        for path, length, head in self.files:
+            writer.write_str(path)
+            writer.write_varint(length)
+            writer.write_fixed(head)
+
+        writer.write_varint(int(self.reply))
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        buckets = [reader.read_varint() for _ in range(reader.read_varint())]
+        files = [(reader.read_str(), reader.read_varint(), reader.read_fixed(digest.DIGEST_SIZE))
+                 for _ in range(reader.read_varint())]
+
+        return cls(buckets, files, bool(reader.read_varint()))
+
+
+# Asks for a patch from the given version of a file to the sender's head. signature
+# is a signature of the file at that version.
+class PatchRequest(Serializable):
+    TYPE_ID = 9
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path=None, length=0, head=None, signature=None):
+        self.path = path
+        self.length = length
+        self.head = head
+        self.signature = signature
+
+    def encode(self, writer):
+        writer.write_str(self.path)
+        writer.write_varint(self.length)
+        writer.write_fixed(self.head)
+        writer.write_optional_bytes(self.signature)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        return cls(reader.read_str(), reader.read_varint(), reader.read_fixed(digest.DIGEST_SIZE),
+                   reader.read_optional_bytes())
+
+
+# Periodic reconciliation of directories of nodes which missed some patches:
+#
+#  1. Every node announces the root digest of its directory in beacons (see neighbors).
+#  2. Node which sees a neighbor with different root sends BucketDigests to it (at most
+#     once every interval seconds; of two such neighbors only the one with smaller node
+#     id starts, the other one takes part by answering).
+#  3. Node receiving BucketDigests sends FileDigests (heads of files) of buckets which
+#     differ. The other node answers with its own FileDigests of these buckets.
+#  4. For every file whose head is not in local history, the node sends PatchRequest
+#     with its head and signature. Node which has the requested version in its history
+#     answers with a patch from it to its head (delta is computed against the signature).
+#     If a conflicting patch of the file could not be resolved, the request is for its
+#     parent (common version), still with signature of the local head.
+#
+# Apart from bucket digests (constant size), exchanged data is proportional
+# to the number of differing files.
+#
+# send_patch(patch, address) sends a patch to a node, file operations run in workers.
+class AntiEntropy:
+    def __init__(self, vcs, comm, workers, send_patch, interval=DEFAULT_INTERVAL):
+        self.vcs = vcs
+        self.comm = comm
+        self.workers = workers
+        self.send_patch = send_patch
+        self.interval = interval
+
+        self.stopped = threading.Event()
+
+        # node id -> monotonic time of the last reconciliation started with the neighbor
+        self.last_started = {}
+
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.start()
+
+    def __run(self):
+        while not self.stopped.wait(neighbors.BEACON_INTERVAL):
+            directory = self.vcs.digest
+            root = directory.root()
+            now = time.monotonic()
+
+            for neighbor in self.comm.neighbors.alive():
+                if neighbor.summary == root or not neighbor.capable(neighbors.CAPABILITY_ANTI_ENTROPY):
+                    continue
+                if neighbor.node_id < self.comm.node_id:
+                    continue
+                if now - self.last_started.get(neighbor.node_id, -self.interval) < self.interval:
+                    continue
+
+                self.last_started[neighbor.node_id] = now
+                logging.debug("AntiEntropy: reconciling with %s" % neighbor.address)
+                self.comm.send_control(BucketDigests(directory.bucket_digests()).to_bytes(), neighbor.address)
+
+    # Handles anti-entropy message (called from the listen thread)
+    def handle(self, message, address):
+        directory = self.vcs.digest
+
+        if isinstance(message, BucketDigests):
+            buckets = directory.differing_buckets(message.digests)
+            if buckets:
+                logging.debug("AntiEntropy: %d buckets differ from %s" % (len(buckets), address))
+                self.comm.send_control(FileDigests(buckets, directory.files_in_buckets(buckets)).to_bytes(), address)
+        elif isinstance(message, FileDigests):
+            for path, length, head in message.files:
+                if directory.head(path) != head:
+                    self.workers.submit(path, self.__request_patch, path, head, address)
+
+            if not message.reply:
+                files = directory.files_in_buckets([bucket for bucket in message.buckets if 0 <= bucket < digest.BUCKETS_N])
+                self.comm.send_control(FileDigests(message.buckets, files, reply=True).to_bytes(), address)
+        elif isinstance(message, PatchRequest):
+            self.workers.submit(message.path, self.__answer_request, message, address)
+        else:
+            logging.debug("AntiEntropy: unknown message %s from %s" % (type(message).__name__, address))
+
+    def __request_patch(self, path, head, address):
+        try:
+            with self.vcs.file_version_control(path) as file_vcs:
+                if file_vcs.conflicted or file_vcs.version_history.position(head) is not None:
+                    return
+
+                history = file_vcs.version_history
+                request = PatchRequest(file_vcs.relative_path, history.length, history.head(), history.last_signature())
+
+                # Conflicting patch which could not be applied is requested again from its
+                # parent, with delta against the local content
+                unresolved = file_vcs.unresolved_parent()
+                if unresolved is not None:
+                    request.length, request.head = unresolved
+
+            self.comm.send_control(request.to_bytes(), address)
+        except Exception:
+            logging.exception("AntiEntropy: request_patch")
+
+    def __answer_request(self, request, address):
+        try:
+            with self.vcs.file_version_control(request.path) as file_vcs:
+                if file_vcs.conflicted:
+                    return
+
+                patch = file_vcs.patch_since(request.length, request.head, request.signature)
+
+            if patch is not None:
+                logging.debug("AntiEntropy: sending %s (%d commits) to %s" % (patch.relative_path, len(patch.commits), address))
+                self.send_patch(patch, address)
+        except Exception:
+            logging.exception("AntiEntropy: answer_request")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
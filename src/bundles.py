@@ -0,0 +1,203 @@
+import threading
+import time
+import logging
+
+import store
+from serialization import Serializable
+
+# Bundles live for a day unless the sender sets other lifetime
+DEFAULT_LIFETIME = 24 * 3600
+
+DEFAULT_PRIORITY = 1
+
+DEFAULT_MAX_QUEUE_BYTES = 1024 * 1024 * 1024
+
+# Number of bundle ids read from the queue at once when iterating over it (and offered
+# to a neighbor in one BundleOffer)
+PENDING_BATCH_SIZE = 256
+
+
+# Unit of data carried through the network. Every bundle is identified by a 16 byte id
+# (commit id of the carried patch) - nodes keep received bundles and forward them to
+# the nodes they meet later (store-carry-forward), ids are used to suppress duplicates.
+#
+# created is a unix timestamp, bundle expires lifetime seconds after it.
+class Bundle(Serializable):
+    TYPE_ID = 5
+    SCHEMA_VERSION = 1
+
+    def __init__(self, id=None, payload=None, priority=DEFAULT_PRIORITY, lifetime=DEFAULT_LIFETIME, created=None):
+        self.id = id
+        self.payload = payload
+        self.priority = priority
+        self.lifetime = lifetime
+        self.created = int(time.time()) if created is None else created
+
+    def expires(self):
+        return self.created + self.lifetime
+
+    def encode(self, writer):
+        writer.write_fixed(self.id)
+        writer.write_varint(self.priority)
+        writer.write_varint(self.created)
+        writer.write_varint(self.lifetime)
+        writer.write_bytes(self.payload)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        bundle = cls()
+        bundle.id = reader.read_fixed(16)
+        bundle.priority = reader.read_varint()
+        bundle.created = reader.read_varint()
+        bundle.lifetime = reader.read_varint()
+        bundle.payload = reader.read_view(reader.read_varint())
+
+        return bundle
+
+
+# Ids of queued bundles offered to a neighbor (see communication.Communicator.forward)
+class BundleOffer(Serializable):
+    TYPE_ID = 11
+    SCHEMA_VERSION = 1
+
+    def __init__(self, ids=None):
+        self.ids = ids if ids is not None else []
+
+    def encode(self, writer):
+        writer.write_fixed_array(self.ids)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        return cls(reader.read_fixed_array(16))
+
+
+# Answer to BundleOffer - ids of the offered bundles the node does not have
+class BundleRequest(Serializable):
+    TYPE_ID = 12
+    SCHEMA_VERSION = 1
+
+    def __init__(self, ids=None):
+        self.ids = ids if ids is not None else []
+
+    def encode(self, writer):
+        writer.write_fixed_array(self.ids)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        return cls(reader.read_fixed_array(16))
+
+
+# Persistent queue of bundles waiting for contact with other nodes. Bundles stay in the
+# queue until they expire, so they can be sent to every node which shows up. If the queue
+# is larger than max_bytes, bundles with the lowest priority (and then the ones which
+# expire first) are dropped.
+#
+# Bundles are kept only on disk, they are listed in batches of ids (pending_ids) and
+# read one by one, so memory usage does not depend on the queue length.
+class BundleQueue(store.Database):
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS bundles (id BLOB PRIMARY KEY, priority INTEGER NOT NULL, "
+        "expires INTEGER NOT NULL, size INTEGER NOT NULL, sent_n INTEGER NOT NULL DEFAULT 0, data BLOB NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS bundles_priority ON bundles (priority)",
+        "CREATE INDEX IF NOT EXISTS bundles_expires ON bundles (expires)",
+    ]
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_QUEUE_BYTES):
+        super().__init__(path, BundleQueue.SCHEMA)
+        self.max_bytes = max_bytes
+
+        self.size_lock = threading.Lock()
+        self.size = self.__total_size(self.connection())
+
+    def __total_size(self, db):
+        return db.execute("SELECT COALESCE(SUM(size), 0) FROM bundles").fetchone()[0]
+
+    def contains(self, id):
+        return self.connection().execute("SELECT 1 FROM bundles WHERE id = ?", (id,)).fetchone() is not None
+
+    # Returns ids (of the given ones) of bundles which are not queued
+    def missing(self, ids):
+        db = self.connection()
+
+        queued = set()
+        for start in range(0, len(ids), PENDING_BATCH_SIZE):
+            batch = ids[start:start + PENDING_BATCH_SIZE]
+            queued.update(id for id, in db.execute("SELECT id FROM bundles WHERE id IN (%s)" % ",".join("?" * len(batch)),
+                                                   batch))
+
+        return [id for id in ids if id not in queued]
+
+    # Returns encoded bundle or None if it is not queued (or expired before now)
+    def get(self, id, now=None):
+        now = time.time() if now is None else now
+
+        row = self.connection().execute("SELECT data FROM bundles WHERE id = ? AND expires > ?", (id, now)).fetchone()
+        return None if row is None else row[0]
+
+    # Adds bundle (data is the encoded bundle). Returns False if a bundle with the same
+    # id is already queued.
+    def put(self, bundle, data):
+        with self.transaction() as db:
+            inserted = db.execute("INSERT OR IGNORE INTO bundles (id, priority, expires, size, data) VALUES (?, ?, ?, ?, ?)",
+                                  (bundle.id, bundle.priority, bundle.expires(), len(data), data)).rowcount > 0
+            if not inserted:
+                return False
+
+            with self.size_lock:
+                self.size += len(data)
+                excess = self.size - self.max_bytes
+
+            while excess > 0:
+                id, size = db.execute("SELECT id, size FROM bundles ORDER BY priority, expires LIMIT 1").fetchone()
+                db.execute("DELETE FROM bundles WHERE id = ?", (id,))
+                logging.debug("BundleQueue: queue full, dropped bundle %s" % id.hex())
+
+                with self.size_lock:
+                    self.size -= size
+                excess -= size
+
+            return True
+
+    # Removes bundles which expired before now
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+
+        with self.transaction() as db:
+            removed = db.execute("DELETE FROM bundles WHERE expires <= ?", (now,)).rowcount
+            if removed > 0:
+                with self.size_lock:
+                    self.size = self.__total_size(db)
+
+        return removed
+
+    # Yields lists of ids of all queued bundles (at most batch_size in each), the highest
+    # priority first. Bundles added or removed during iteration may or may not be returned.
+    def pending_ids(self, batch_size=PENDING_BATCH_SIZE):
+        db = self.connection()
+        priority, rowid = None, -1
+        while True:
+            if priority is None:
+                rows = db.execute("SELECT rowid, priority, id FROM bundles ORDER BY priority DESC, rowid LIMIT ?",
+                                  (batch_size,)).fetchall()
+            else:
+                rows = db.execute("SELECT rowid, priority, id FROM bundles WHERE priority < ? OR (priority = ? AND rowid > ?) "
+                                  "ORDER BY priority DESC, rowid LIMIT ?",
+                                  (priority, priority, rowid, batch_size)).fetchall()
+            if not rows:
+                return
+
+            # Next batch starts after the last row of this one
+            rowid, priority, _ = rows[-1]
+            yield [id for _, _, id in rows]
+
+    def mark_sent(self, id):
+        with self.transaction() as db:
+            db.execute("UPDATE bundles SET sent_n = sent_n + 1 WHERE id = ?", (id,))
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM bundles").fetchone()[0]
+
+    def stats(self):
+        with self.size_lock:
+            size = self.size
+        return {"bundles": len(self), "bytes": size}
@@ -2,54 +2,483 @@ import socket
 import threading
 import io
 import os
+import random
+import struct
+import time
+import collections
 import utils
+import uuid
+import bundles
+import neighbors
+import serialization
 
 import logging
 
+# Every datagram starts with this header:
+#   magic, version, flags, sender node id, message id, message length, fragment index, fragment count
+FRAGMENT_HEADER = struct.Struct("!2sBB16sQIII")
+FRAGMENT_MAGIC = b"DS"
+FRAGMENT_VERSION = 2
+
+MAX_DATAGRAM_SIZE = 65507
+
+# Fits into ethernet MTU together with IP/UDP/fragment headers
+DEFAULT_FRAGMENT_PAYLOAD = 1400
+
+# Fragments (except for the last one) carry at least this many bytes, so the number
+# of fragments of a message is bounded by its length
+MIN_FRAGMENT_PAYLOAD = 512
+
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Bytes per second sent by a node (all messages together). UDP has no flow control, if
+# fragments are sent faster than receivers read them, their socket buffers overflow and
+# large messages are lost.
+DEFAULT_MAX_RATE = 20 * 1024 * 1024
+
+# Pacing does not sleep for shorter delays (they are caught up with the next sleep)
+MIN_PACING_DELAY = 0.001
+
+DEFAULT_BROADCAST_ADDRESS = "255.255.255.255"
+
+# Data for more neighbors than this is broadcast instead of being sent to each of them
+UNICAST_FANOUT = 4
+
+# Splits messages into sequenced fragments and sends them. Fragments are sent with
+# sendmsg (header and payload are not concatenated) so data is never copied. Every
+# fragment carries node_id (16 bytes) of the sender.
+#
+# UDP has no flow control - if max_rate (bytes per second) is set, fragments are paced
+# so that receivers' socket buffers do not overflow on large messages. The rate is shared
+# by all threads sending with the fragmenter.
+class Fragmenter:
+    def __init__(self, node_id, payload_size=DEFAULT_FRAGMENT_PAYLOAD, max_rate=None):
+        if payload_size < MIN_FRAGMENT_PAYLOAD:
+            raise ValueError("Fragment payload too small: %d" % payload_size)
+
+        self.node_id = node_id
+        self.payload_size = payload_size
+        self.max_rate = max_rate
+        self.next_message_id = random.getrandbits(64)
+        self.id_lock = threading.Lock()
+
+        # Time at which the next fragment can be sent
+        self.next_send = time.monotonic()
+        self.pacing_lock = threading.Lock()
+
+    def __message_id(self):
+        with self.id_lock:
+            message_id = self.next_message_id
+            self.next_message_id = (self.next_message_id + 1) & 0xffffffffffffffff
+
+        return message_id
+
+    # Waits until a datagram of size bytes can be sent
+    def __pace(self, size):
+        with self.pacing_lock:
+            now = time.monotonic()
+            send_at = max(self.next_send, now)
+            self.next_send = send_at + size / self.max_rate
+
+        if send_at - now >= MIN_PACING_DELAY:
+            time.sleep(send_at - now)
+
+    def send(self, sock, data, address):
+        data = memoryview(data)
+        message_id = self.__message_id()
+        fragments_n = max(1, (len(data) + self.payload_size - 1) // self.payload_size)
+
+        for index in range(fragments_n):
+            payload = data[index * self.payload_size:(index + 1) * self.payload_size]
+            header = FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, FRAGMENT_VERSION, 0, self.node_id, message_id,
+                                          len(data), index, fragments_n)
+
+            if self.max_rate:
+                self.__pace(len(header) + len(payload))
+            sock.sendmsg([header, payload], [], 0, address)
+
+
+# Message which was not fully received yet. Payload of every fragment is copied
+# directly to its place in preallocated buffer.
+class _PartialMessage:
+    def __init__(self, length, fragments_n, deadline):
+        self.buffer = bytearray(length)
+        self.received = bytearray(fragments_n)
+        self.missing = fragments_n
+        self.deadline = deadline
+
+    # Memory used by the message (counted in Reassembler.pending_bytes)
+    def size(self):
+        return len(self.buffer) + len(self.received)
+
+    def add(self, index, fragments_n, payload):
+        if self.received[index]:
+            return
+
+        if index == fragments_n - 1:
+            # Last fragment can be shorter than the others
+            offset = len(self.buffer) - len(payload)
+        else:
+            offset = index * len(payload)
+
+        if offset < 0 or offset + len(payload) > len(self.buffer):
+            raise ValueError("Fragment out of message bounds")
+
+        self.buffer[offset:offset + len(payload)] = payload
+        self.received[index] = 1
+        self.missing -= 1
+
+
+# Reassembles fragmented messages. Memory used by partial messages is bounded by
+# max_pending_bytes (the oldest partial messages are dropped first) and messages which
+# were not completed within timeout seconds are discarded.
+#
+# Fragments sent by local_id (this node's own broadcasts) are dropped without copying.
+class Reassembler:
+    def __init__(self, max_message_size=256 * 1024 * 1024, max_pending_bytes=512 * 1024 * 1024, timeout=10,
+                 local_id=None):
+        self.local_id = local_id
+        self.max_message_size = max_message_size
+        self.max_pending_bytes = max_pending_bytes
+        self.timeout = timeout
+
+        # (sender node id, message id) -> _PartialMessage, ordered by creation time
+        self.partial = collections.OrderedDict()
+        self.pending_bytes = 0
+
+        self.messages_n = 0
+        self.dropped_n = 0
+
+    def __drop(self, key):
+        message = self.partial.pop(key)
+        self.pending_bytes -= message.size()
+        self.dropped_n += 1
+
+    def __expire(self, now):
+        while self.partial:
+            key, message = next(iter(self.partial.items()))
+            if message.deadline > now:
+                break
+
+            logging.debug("Reassembler: message %x from %s timed out" % (key[1], key[0].hex()))
+            self.__drop(key)
+
+    # Takes received datagram, returns (sender node id, whole message as memoryview) if
+    # the message is complete or (sender node id, None) otherwise. Returned view can
+    # reference datagram so it is valid only until the receive buffer is reused.
+    def add(self, datagram):
+        if len(datagram) < FRAGMENT_HEADER.size:
+            raise ValueError("Datagram too short")
+
+        magic, version, flags, sender, message_id, length, index, fragments_n = FRAGMENT_HEADER.unpack_from(datagram)
+        if magic != FRAGMENT_MAGIC or version != FRAGMENT_VERSION:
+            raise ValueError("Unknown datagram format")
+        if fragments_n == 0 or fragments_n > max(1, -(-length // MIN_FRAGMENT_PAYLOAD)):
+            raise ValueError("Invalid fragment count: %d (message length %d)" % (fragments_n, length))
+        if index >= fragments_n:
+            raise ValueError("Invalid fragment index")
+        if sender == self.local_id:
+            return sender, None
+
+        payload = datagram[FRAGMENT_HEADER.size:]
+
+        # Message is not fragmented, no need to copy anything
+        if fragments_n == 1:
+            if len(payload) != length:
+                raise ValueError("Invalid message length")
+            self.messages_n += 1
+            return sender, payload
+
+        now = time.monotonic()
+        self.__expire(now)
+
+        key = (sender, message_id)
+        message = self.partial.get(key)
+        if message is None:
+            if length > self.max_message_size:
+                raise ValueError("Message too big: %d" % length)
+
+            while self.partial and self.pending_bytes + length + fragments_n > self.max_pending_bytes:
+                self.__drop(next(iter(self.partial)))
+
+            message = _PartialMessage(length, fragments_n, now + self.timeout)
+            self.partial[key] = message
+            self.pending_bytes += message.size()
+        elif len(message.received) != fragments_n:
+            raise ValueError("Inconsistent fragment count")
+
+        message.add(index, fragments_n, payload)
+
+        if message.missing > 0:
+            return sender, None
+
+        del self.partial[key]
+        self.pending_bytes -= message.size()
+        self.messages_n += 1
+
+        return sender, memoryview(message.buffer)
+
+
 # Class responsible for communictation. Allows sending files to the network
 # via send_file() function and calls registerd on_receive_callback every time
 # new file is received from the network.
 #
-# Also responsible for broadcasting data to other nodes in DTN.
+# Also responsible for broadcasting data to other nodes in DTN. Data is sent in bundles
+# which are kept in a persistent queue (queue_path) until they expire - both the ones
+# sent by this node and the ones received from others (store-carry-forward). Received
+# bundles which are already queued are dropped.
+#
+# Every node is identified by node_id (16 bytes) sent in headers of all its datagrams,
+# messages of this node (e.g. its own broadcasts) are ignored.
+#
+# Nodes announce themselves with beacons (node id, capabilities and summary of their
+# directory) and are kept in a table of neighbors. New bundles are sent directly to
+# the neighbors (or broadcast if there are many of them). Ids of queued bundles are
+# offered (in batches) to every new neighbor whose summary differs from this node's one,
+# the neighbor requests the bundles it does not have and only those are sent to it.
+#
+# Control messages (send_control) are sent once, to one node or to all, and are not queued.
 #
 class Communicator:
-    # on_receive_callback takes 2 parameters - instance of File class which
-    # represents the file itself and path to where this file is stored
-    def __init__(self, port, on_receive_callback):
+    # on_receive_callback takes 1 parameter - buffer (memoryview) with the whole received message.
+    # on_control_callback takes the buffer with a control message and address of its sender.
+    # The buffer is valid only until the callback returns.
+    #
+    # summary is a function returning summary of this node's directory (sent in beacons).
+    #
+    # All data is sent at most max_rate bytes per second (None disables pacing).
+    def __init__(self, port, on_receive_callback, queue_path, max_queue_bytes=bundles.DEFAULT_MAX_QUEUE_BYTES,
+                 on_control_callback=None, broadcast_address=DEFAULT_BROADCAST_ADDRESS, node_id=None,
+                 capabilities=neighbors.CAPABILITY_CUSTODY, summary=lambda: bytes(16), max_rate=DEFAULT_MAX_RATE):
         self.port = port
         self.on_receive_callback = on_receive_callback
+        self.on_control_callback = on_control_callback
+        self.broadcast_address = broadcast_address
+        self.node_id = node_id if node_id is not None else uuid.uuid4().bytes
+        self.capabilities = capabilities
+        self.summary = summary
+
+        self.queue = bundles.BundleQueue(queue_path, max_queue_bytes)
+        self.duplicates_n = 0
 
-        # XXX this is hack to obtain local ip address - replace with uuid
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("10.83.0.1", 5001))
-        self.local_address = s.getsockname()[0]
+        self.neighbors = neighbors.NeighborTable()
 
-        logging.debug("Local ip address: " + self.local_address)
+        # Neighbors which appeared and bundle offers and requests received since the last forwarding
+        self.new_neighbors = []
+        self.received_ids = []
+        self.forward_lock = threading.Lock()
+
+        self.fragmenter = Fragmenter(self.node_id, max_rate=max_rate)
+        self.reassembler = Reassembler(local_id=self.node_id)
 
         self.out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.out_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.out_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
 
         self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
         self.client.bind(("", self.port))
 
+        self.stopped = False
+        self.stopped_event = threading.Event()
         self.listen_thread = threading.Thread(target=self.listen)
         self.listen_thread.start()
 
+        self.forward_wakeup = threading.Event()
+        self.forward_thread = threading.Thread(target=self.forward)
+        self.forward_thread.start()
+
+        self.beacon_thread = threading.Thread(target=self.beacon)
+        self.beacon_thread.start()
+
+    def beacon(self):
+        while True:
+            beacon = neighbors.Beacon(self.node_id, self.capabilities, self.summary())
+            self.__broadcast(beacon.to_bytes())
+
+            for neighbor in self.neighbors.expire():
+                logging.debug("Neighbor %s (%s) timed out" % (neighbor.node_id.hex(), neighbor.address))
+
+            if self.stopped_event.wait(neighbors.BEACON_INTERVAL):
+                return
+
+    def __beacon_received(self, message, address):
+        try:
+            beacon = neighbors.Beacon.from_bytes(message)
+        except (serialization.SerializationError, ValueError) as e:
+            logging.debug("Dropped beacon from %s: %s" % (address, e))
+            return
+
+        neighbor, new = self.neighbors.update(beacon, address)
+        if new:
+            logging.debug("New neighbor %s (%s)" % (neighbor.node_id.hex(), address))
+
+            with self.forward_lock:
+                self.new_neighbors.append(neighbor)
+            self.forward_wakeup.set()
+
+    # Offers and requests are handled by the forward thread, sending (paced) must not block listening
+    def __bundle_ids_received(self, message, address):
+        try:
+            message = serialization.Serializable.from_bytes(bytes(message))
+        except (serialization.SerializationError, ValueError) as e:
+            logging.debug("Dropped bundle ids from %s: %s" % (address, e))
+            return
+
+        with self.forward_lock:
+            self.received_ids.append((message, address))
+        self.forward_wakeup.set()
+
     def listen(self):
+        buffer = bytearray(MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+
         while True:
-            buffer = bytearray(4096) # XXX bigger buffer size/split recv
             nbytes, addr = self.client.recvfrom_into(buffer)
+            if self.stopped:
+                return
 
             incoming_addr, _ = addr
 
-            # XXX Ignore messages from self
-            if incoming_addr == self.local_address:
+            try:
+                _, message = self.reassembler.add(view[:nbytes])
+            except ValueError as e:
+                logging.debug("Dropped datagram from %s: %s" % (incoming_addr, e))
+                continue
+
+            # Messages from self are not reassembled, empty messages are not valid
+            if message is None or len(message) == 0:
                 continue
 
-            # Call callback with data
-            self.on_receive_callback(buffer)
+            # Errors in handling of a single message must not stop the listen thread
+            try:
+                self.__message_received(message, incoming_addr)
+            except Exception:
+                logging.exception("Handling message from %s failed" % incoming_addr)
+
+    def __message_received(self, message, address):
+        # Messages are serialized objects, type id is their first byte
+        if message[0] == neighbors.Beacon.TYPE_ID:
+            self.__beacon_received(message, address)
+            return
+
+        if message[0] in (bundles.BundleOffer.TYPE_ID, bundles.BundleRequest.TYPE_ID):
+            self.__bundle_ids_received(message, address)
+            return
+
+        if message[0] != bundles.Bundle.TYPE_ID:
+            if self.on_control_callback is not None:
+                self.on_control_callback(message, address)
+            return
+
+        try:
+            bundle = bundles.Bundle.from_bytes(message)
+        except (serialization.SerializationError, ValueError) as e:
+            logging.debug("Dropped message from %s: %s" % (address, e))
+            return
+
+        if bundle.expires() <= time.time():
+            return
+
+        # Take custody of the bundle (it will be forwarded to other nodes)
+        if not self.queue.put(bundle, message):
+            self.duplicates_n += 1
+            return
+
+        # Call callback with data
+        self.on_receive_callback(bundle.payload)
+
+    # Offers queued bundles to new neighbors which have different summary (neighbors
+    # with equal summaries already have everything this node has), answers offers
+    # of other nodes and sends the bundles they requested
+    def forward(self):
+        while True:
+            self.forward_wakeup.wait()
+            self.forward_wakeup.clear()
+            if self.stopped:
+                return
+
+            with self.forward_lock:
+                new_neighbors, self.new_neighbors = self.new_neighbors, []
+                received, self.received_ids = self.received_ids, []
+
+            summary = self.summary()
+            new_neighbors = [neighbor for neighbor in new_neighbors if neighbor.summary != summary]
+            if new_neighbors:
+                self.queue.expire()
+                logging.debug("Offering queued bundles %s to %s" % (self.queue.stats(), [n.address for n in new_neighbors]))
+
+                for ids in self.queue.pending_ids():
+                    offer = bundles.BundleOffer(ids).to_bytes()
+                    for neighbor in new_neighbors:
+                        self.__send_to(offer, neighbor.address)
+
+            for message, address in received:
+                if self.stopped:
+                    return
+
+                if isinstance(message, bundles.BundleOffer):
+                    missing = self.queue.missing(message.ids)
+                    if missing:
+                        self.__send_to(bundles.BundleRequest(missing).to_bytes(), address)
+                    continue
+
+                for id in message.ids:
+                    data = self.queue.get(id)
+                    if data is not None:
+                        self.__send_to(data, address)
+                        self.queue.mark_sent(id)
+
+    # Failures are not fatal - data stays queued and is sent again later
+    def __broadcast(self, data):
+        self.__send_to(data, self.broadcast_address)
+
+    def __send_to(self, data, address):
+        try:
+            self.fragmenter.send(self.out_sock, data, (address, self.port))
+        except OSError as e:
+            logging.debug("Sending to %s failed: %s" % (address, e))
+
+    # Sends data to each of neighbors, broadcasts it if there are too many of them
+    def __send_to_all(self, data, targets):
+        if len(targets) > UNICAST_FANOUT:
+            self.__broadcast(data)
+            return
+
+        for neighbor in targets:
+            self.__send_to(data, neighbor.address)
+
+    # Sends control message to a node (ip address) or to all nodes if address is None
+    def send_control(self, data, address=None):
+        if address is None:
+            self.__broadcast(data)
+        else:
+            self.__send_to(data, address)
+
+    # Sends data in a bundle identified by id (16 bytes) to the current neighbors.
+    # The bundle is queued and sent to nodes met later, until lifetime (seconds) passes.
+    def send(self, data, id, priority=bundles.DEFAULT_PRIORITY, lifetime=bundles.DEFAULT_LIFETIME):
+        bundle = bundles.Bundle(id, data, priority, lifetime)
+        encoded = bundle.to_bytes()
+
+        if self.queue.put(bundle, encoded):
+            self.__send_to_all(encoded, self.neighbors.alive())
+
+    def stop(self):
+        self.stopped = True
+        self.stopped_event.set()
+        self.beacon_thread.join()
+
+        self.forward_wakeup.set()
+        self.forward_thread.join()
+
+        # Wakes up the listen thread (raises ENOTCONN for UDP socket but works anyway)
+        try:
+            self.client.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
 
-    def send(self, data):
-        # Broadcast data
-        self.out_sock.sendto(data, ('10.83.255.255', self.port))
+        self.listen_thread.join()
+        self.client.close()
+        self.out_sock.close()
@@ -0,0 +1,233 @@
+import bz2
+import lzma
+import os
+import threading
+import time
+import zlib
+import logging
+
+# Codec ids (sent with every patch, see FilePatch.compression)
+NONE = 0
+ZLIB = 1
+LZMA = 2
+BZ2 = 3
+
+# codec -> (name, compress function, decompressor factory)
+CODECS = {
+    ZLIB: ("zlib", lambda data: zlib.compress(data, 6), zlib.decompressobj),
+    LZMA: ("lzma", lambda data: lzma.compress(data, preset=6), lzma.LZMADecompressor),
+    BZ2: ("bz2", lambda data: bz2.compress(data, 9), bz2.BZ2Decompressor),
+}
+
+CODEC_IDS = {name: codec for codec, (name, _, _) in CODECS.items()}
+
+MODES = ["auto", "none"] + sorted(CODEC_IDS)
+
+# Smaller deltas are never compressed (codec overhead is larger than the gain)
+MIN_COMPRESSED_SIZE = 256
+
+# Number of patches after which statistics are logged
+STATS_LOG_INTERVAL = 100
+
+# Deltas which decompress to more than this are rejected (the largest message which
+# can be received, see communication.Reassembler)
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+
+
+# Compressed data comes from other nodes, output is limited so that a small message
+# cannot expand to an arbitrary amount of memory
+def decompress(codec, data, max_size=MAX_DECOMPRESSED_SIZE):
+    if codec == NONE:
+        return data
+
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec: %d" % codec)
+
+    decompressor = CODECS[codec][2]()
+    decompressed = decompressor.decompress(data, max_size)
+    if not decompressor.eof:
+        raise ValueError("Compressed data is truncated or larger than %d bytes" % max_size)
+
+    return decompressed
+
+
+# Type of a file used for statistics and codec selection - its lowercased extension
+def file_type(path):
+    extension = os.path.splitext(path)[1].lower()
+    return extension if extension else "(none)"
+
+
+# Estimates of codec's compression ratio and CPU time per input byte (moving averages)
+class _Estimate:
+    ALPHA = 0.2
+
+    def __init__(self, ratio, time_per_byte):
+        self.ratio = ratio
+        self.time_per_byte = time_per_byte
+
+    def update(self, ratio, time_per_byte):
+        self.ratio += _Estimate.ALPHA * (ratio - self.ratio)
+        self.time_per_byte += _Estimate.ALPHA * (time_per_byte - self.time_per_byte)
+
+
+# Per-file-type statistics
+class _TypeStats:
+    def __init__(self):
+        self.patches = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+        self.codecs = {}
+
+        # codec -> _Estimate
+        self.estimates = {}
+
+
+# Compresses deltas with the codec which is expected to deliver them the fastest.
+#
+# Cost of sending n bytes compressed by a codec is estimated as
+#   n * ratio / link_rate + n * time_per_byte
+# (transmission + CPU time). Ratio and time of every codec are measured separately
+# for every file type: the first patches of a type and then every probe_interval-th
+# one are compressed (a sample of at most probe_size bytes) with all codecs.
+# If no codec saves at least min_saving of the size, deltas are sent uncompressed.
+class AdaptiveCompressor:
+    def __init__(self, codecs=(ZLIB, LZMA, BZ2), link_rate=1024 * 1024, min_saving=0.05,
+                 probe_interval=64, probe_size=64 * 1024):
+        self.codecs = list(codecs)
+        self.link_rate = link_rate
+        self.min_saving = min_saving
+        self.probe_interval = probe_interval
+        self.probe_size = probe_size
+
+        self.lock = threading.Lock()
+        self.types = {}
+        self.patches_n = 0
+
+    # mode is one of MODES
+    @staticmethod
+    def create(mode, **kwargs):
+        if mode == "auto":
+            return AdaptiveCompressor(**kwargs)
+        elif mode == "none":
+            return AdaptiveCompressor(codecs=[], **kwargs)
+        elif mode in CODEC_IDS:
+            return AdaptiveCompressor(codecs=[CODEC_IDS[mode]], **kwargs)
+
+        raise ValueError("Unknown compression mode: %s" % mode)
+
+    def __type_stats(self, type):
+        stats = self.types.get(type)
+        if stats is None:
+            stats = self.types[type] = _TypeStats()
+        return stats
+
+    def __measure(self, codec, data):
+        start = time.thread_time()
+        compressed = CODECS[codec][1](data)
+        elapsed = time.thread_time() - start
+
+        return compressed, len(compressed) / len(data), elapsed / len(data)
+
+    # Compresses sample with all codecs and updates their estimates
+    def __probe(self, type, data):
+        sample = memoryview(data)[:self.probe_size]
+        measurements = {codec: self.__measure(codec, sample)[1:] for codec in self.codecs}
+
+        with self.lock:
+            stats = self.__type_stats(type)
+            stats.compress_time += sum(time_per_byte * len(sample) for _, time_per_byte in measurements.values())
+
+            estimates = stats.estimates
+            for codec, (ratio, time_per_byte) in measurements.items():
+                if codec in estimates:
+                    estimates[codec].update(ratio, time_per_byte)
+                else:
+                    estimates[codec] = _Estimate(ratio, time_per_byte)
+
+    # Returns codec with the lowest estimated cost of sending data
+    def __select(self, type, data):
+        with self.lock:
+            stats = self.__type_stats(type)
+            probe = any(codec not in stats.estimates for codec in self.codecs) or stats.patches % self.probe_interval == 0
+
+        if probe:
+            self.__probe(type, data)
+
+        with self.lock:
+            estimates = dict(self.__type_stats(type).estimates)
+
+        best, best_cost = NONE, 1.0 / self.link_rate
+        for codec, estimate in estimates.items():
+            if estimate.ratio > 1.0 - self.min_saving:
+                continue
+
+            cost = estimate.ratio / self.link_rate + estimate.time_per_byte
+            if cost < best_cost:
+                best, best_cost = codec, cost
+
+        return best
+
+    # Returns (codec, compressed data) for delta of a file
+    def compress(self, path, data):
+        type = file_type(path)
+
+        codec = NONE
+        compressed = data
+        elapsed = 0.0
+
+        if self.codecs and len(data) >= MIN_COMPRESSED_SIZE:
+            codec = self.__select(type, data)
+
+            if codec != NONE:
+                compressed, ratio, time_per_byte = self.__measure(codec, data)
+                elapsed = time_per_byte * len(data)
+
+                with self.lock:
+                    self.__type_stats(type).estimates[codec].update(ratio, time_per_byte)
+
+                if len(compressed) >= len(data):
+                    codec, compressed = NONE, data
+
+        with self.lock:
+            stats = self.__type_stats(type)
+            stats.patches += 1
+            stats.bytes_in += len(data)
+            stats.bytes_out += len(compressed)
+            stats.compress_time += elapsed
+            stats.codecs[codec] = stats.codecs.get(codec, 0) + 1
+
+            self.patches_n += 1
+            log = self.patches_n % STATS_LOG_INTERVAL == 0
+
+        if log:
+            logging.debug("AdaptiveCompressor: %s" % self.stats())
+
+        return codec, compressed
+
+    def decompress(self, path, codec, data):
+        if codec == NONE:
+            return data
+
+        start = time.thread_time()
+        decompressed = decompress(codec, data)
+        elapsed = time.thread_time() - start
+
+        with self.lock:
+            self.__type_stats(file_type(path)).decompress_time += elapsed
+
+        return decompressed
+
+    # Bytes saved and CPU time spent, per file type
+    def stats(self):
+        with self.lock:
+            return {type: {
+                "patches": stats.patches,
+                "bytes_in": stats.bytes_in,
+                "bytes_out": stats.bytes_out,
+                "bytes_saved": stats.bytes_in - stats.bytes_out,
+                "compress_time": stats.compress_time,
+                "decompress_time": stats.decompress_time,
+                "codecs": {CODECS[codec][0] if codec != NONE else "none": n for codec, n in stats.codecs.items()},
+            } for type, stats in self.types.items()}
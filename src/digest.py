@@ -0,0 +1,83 @@
+import hashlib
+import threading
+
+# Number of buckets the synchronized directory is divided into
+BUCKETS_N = 1024
+
+DIGEST_SIZE = 16
+
+
+def bucket(path):
+    return int.from_bytes(hashlib.blake2b(path.encode('utf-8'), digest_size=4).digest(), 'big') % BUCKETS_N
+
+
+def leaf(path, head):
+    return int.from_bytes(hashlib.blake2b(path.encode('utf-8') + b"\0" + head, digest_size=DIGEST_SIZE).digest(), 'big')
+
+
+# Summary of heads of all files in the synchronized directory (a two level Merkle tree).
+# Files are divided into buckets by hash of their path. Digest of a bucket is XOR of
+# digests of its files (path and head chain digest), so it is updated in constant time
+# when a file changes. Root digest is a hash of all bucket digests.
+#
+# Two nodes with equal roots have the same heads of all files. Otherwise comparing
+# bucket digests shows which (small) subsets of files have to be compared.
+class DirectoryDigest:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # path -> (length, head)
+        self.files = {}
+        self.buckets = [0] * BUCKETS_N
+        self.bucket_files = [set() for _ in range(BUCKETS_N)]
+        self.root_cache = None
+
+    def update(self, path, length, head):
+        index = bucket(path)
+        with self.lock:
+            old = self.files.get(path)
+            if old is not None:
+                if old[1] == head:
+                    return
+                self.buckets[index] ^= leaf(path, old[1])
+
+            self.files[path] = (length, head)
+            self.buckets[index] ^= leaf(path, head)
+            self.bucket_files[index].add(path)
+            self.root_cache = None
+
+    # Returns head chain digest of a file or None if it is unknown
+    def head(self, path):
+        with self.lock:
+            entry = self.files.get(path)
+            return None if entry is None else entry[1]
+
+    def root(self):
+        with self.lock:
+            if self.root_cache is None:
+                self.root_cache = hashlib.blake2b(b"".join(self.__bucket_bytes()), digest_size=DIGEST_SIZE).digest()
+            return self.root_cache
+
+    def __bucket_bytes(self):
+        return [value.to_bytes(DIGEST_SIZE, 'big') for value in self.buckets]
+
+    def bucket_digests(self):
+        with self.lock:
+            return self.__bucket_bytes()
+
+    # Indices of buckets which differ from the given bucket digests
+    def differing_buckets(self, digests):
+        if len(digests) != BUCKETS_N:
+            raise ValueError("Invalid number of buckets: %d" % len(digests))
+
+        with self.lock:
+            return [i for i, digest in enumerate(self.__bucket_bytes()) if digest != digests[i]]
+
+    # Returns list of (path, length, head) of all files in buckets
+    def files_in_buckets(self, buckets):
+        with self.lock:
+            return [(path,) + self.files[path] for index in buckets for path in sorted(self.bucket_files[index])]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.files)
@@ -0,0 +1,162 @@
+import collections
+import hashlib
+import mmap
+import os
+import threading
+import time
+
+# In-process hashing of file contents.
+#
+# Files are read in chunks (large ones are mapped to memory instead) and hashed with
+# hashlib, which releases the GIL while hashing, so files can be hashed by many
+# worker threads at once. Digests are cached by HashCache.
+
+DIGEST_SIZE = 16
+
+# Files at least this big are mapped to memory instead of being read
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# How much of a file is hashed at once
+CHUNK_SIZE = 1024 * 1024
+
+# Digest of a file hashed less than this many nanoseconds after its modification is not
+# trusted - the file could have been modified again within the filesystem's timestamp
+# granularity without changing (size, mtime_ns). Such file is hashed again when its
+# digest is needed.
+RACY_INTERVAL_NS = 10 * 1000 * 1000
+
+DEFAULT_CACHE_ENTRIES = 64 * 1024
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def _hash_mapped(f, size, h):
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for start in range(0, size, CHUNK_SIZE):
+                h.update(view[start:start + CHUNK_SIZE])
+        finally:
+            view.release()
+
+
+def _hash_read(f, h):
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+
+    while True:
+        n = f.readinto(buffer)
+        if not n:
+            break
+        h.update(view[:n])
+
+
+# Hashes an open file (from its current position if it is read in chunks)
+def hash_file_object(f, size, algorithm=None):
+    h = new_hash() if algorithm is None else hashlib.new(algorithm)
+
+    if size >= MMAP_THRESHOLD:
+        _hash_mapped(f, size, h)
+    else:
+        _hash_read(f, h)
+
+    return h.digest()
+
+
+def file_digest(path, algorithm=None):
+    with open(path, 'rb') as f:
+        return hash_file_object(f, os.fstat(f.fileno()).st_size, algorithm)
+
+
+def _stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+# Identifies content of a file - if the key did not change, the content did not change either
+def file_key(path):
+    return _stat_key(os.stat(path))
+
+
+# Digests of file contents identified by (device, inode, size, mtime_ns), so an unchanged
+# file is never hashed again - even if it was renamed (e.g. patched file replacing
+# the original one). At most max_entries digests are kept, the least recently used
+# ones are evicted first.
+class HashCache:
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.mutex = threading.Lock()
+
+        # stat key -> (digest, time when the file was hashed)
+        self.entries = collections.OrderedDict()
+
+        self.hits_n = 0
+        self.misses_n = 0
+        self.hashed_bytes = 0
+
+    def __get(self, key):
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] - key[3] < RACY_INTERVAL_NS:
+                self.misses_n += 1
+                return None
+
+            self.hits_n += 1
+            self.entries.move_to_end(key)
+
+            return entry[0]
+
+    def __put(self, key, value):
+        with self.mutex:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Returns digest of the file's content, hashing it only if it changed since it was hashed
+    def digest(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            key = _stat_key(st)
+
+            value = self.__get(key)
+            if value is not None:
+                return value
+
+            started = time.time_ns()
+            value = hash_file_object(f, st.st_size)
+
+            with self.mutex:
+                self.hashed_bytes += st.st_size
+
+            # File changed while it was hashed
+            if _stat_key(os.fstat(f.fileno())) == key:
+                self.__put(key, (value, started))
+
+            return value
+
+    # Returns cached digest of the file's content or None if it changed since it was hashed
+    def cached_digest(self, path):
+        try:
+            return self.__get(_stat_key(os.stat(path)))
+        except FileNotFoundError:
+            return None
+
+    def __len__(self):
+        with self.mutex:
+            return len(self.entries)
+
+    def stats(self):
+        with self.mutex:
+            return {"files": len(self.entries), "hits": self.hits_n, "misses": self.misses_n,
+                    "hashed_bytes": self.hashed_bytes}
+
+
+# Shared by all users in the process (files are identified by device and inode)
+cache = HashCache()
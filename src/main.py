@@ -2,8 +2,15 @@
 
 import argparse
 import synchronization
+import rdiff
+import compression
+import antientropy
+import communication
+import vcs
 import logging
+import signal
 import sys
+import threading
 
 import daemon
 
@@ -13,6 +20,28 @@ def main(args=sys.argv[1:]):
     parser.add_argument("-d", "--directory", help="Directory which will be synchronized - it must exist", required=True)
     parser.add_argument("-l", "--log", help="Logging level", required=False)
     parser.add_argument("-o", "--stdout", help="Stdout file", required=False)
+    parser.add_argument("-b", "--delta-backend", help="Delta engine used to compute and apply patches",
+                        choices=rdiff.BACKENDS, default=rdiff.DEFAULT_BACKEND, required=False)
+    parser.add_argument("-w", "--workers", help="Number of threads computing and applying patches",
+                        type=int, default=4, required=False)
+    parser.add_argument("-q", "--quiet-period", help="Seconds without writes after which a file is committed (0 disables coalescing)",
+                        type=float, default=0.1, required=False)
+    parser.add_argument("-m", "--max-latency", help="Maximum seconds between the first write to a file and its commit",
+                        type=float, default=1.0, required=False)
+    parser.add_argument("-c", "--compression", help="Compression of sent patches (auto selects codec per file type)",
+                        choices=compression.MODES, default="auto", required=False)
+    parser.add_argument("-a", "--anti-entropy-interval", help="Minimal seconds between reconciliations with the same node",
+                        type=float, default=antientropy.DEFAULT_INTERVAL, required=False)
+
+    parser.add_argument("-B", "--broadcast-address", help="Address to which beacons and messages for many nodes are sent",
+                        default=communication.DEFAULT_BROADCAST_ADDRESS, required=False)
+    parser.add_argument("-H", "--history-cache", help="Megabytes of memory used by cached version histories",
+                        type=int, default=vcs.DEFAULT_HISTORY_CACHE_BYTES // (1024 * 1024), required=False)
+    parser.add_argument("-M", "--merge-max-size", help="Megabytes - concurrent changes of smaller text files are merged "
+                        "instead of splitting them into per-node copies (0 disables merging)",
+                        type=int, default=vcs.DEFAULT_MERGE_MAX_BYTES // (1024 * 1024), required=False)
+    parser.add_argument("-r", "--max-rate", help="Megabytes per second sent to the network (0 disables pacing)",
+                        type=float, default=communication.DEFAULT_MAX_RATE / (1024 * 1024), required=False)
 
     args = parser.parse_args(args)
 
@@ -23,14 +52,27 @@ def main(args=sys.argv[1:]):
             raise ValueError('Invalid log level: %s' % args.log)
         logging.basicConfig(level=numeric_level)
 
+    rdiff.set_backend(args.delta_backend, args.workers)
+
     stdout = None
     if args.stdout:
         stdout = open(args.stdout, 'w')
     else:
         stdout = open("/dev/stdout", 'w')
 
-    with daemon.DaemonContext(stdout=stdout, stderr=stdout):
-        sync = synchronization.SyncWorker(args.directory, args.port)
+    stopped = threading.Event()
+    signal_map = {signal.SIGTERM: lambda signum, frame: stopped.set()}
+
+    with daemon.DaemonContext(stdout=stdout, stderr=stdout, signal_map=signal_map):
+        sync = synchronization.SyncWorker(args.directory, args.port, args.workers,
+                                          args.quiet_period, args.max_latency, args.compression,
+                                          args.anti_entropy_interval, args.broadcast_address,
+                                          args.history_cache * 1024 * 1024, args.merge_max_size * 1024 * 1024,
+                                          int(args.max_rate * 1024 * 1024) or None)
+
+        # Run until SIGTERM, then finish queued work
+        stopped.wait()
+        sync.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,139 @@
+import difflib
+
+# Three-way merge of concurrent versions of a text file.
+#
+# Versions x and y were both created from base. Changes made on both sides are combined
+# if they do not touch the same (or adjacent) lines, otherwise merge() returns None and
+# the file is split into per-node variants (see FileVersionControl.__resolve_conflict).
+# The result depends only on the arguments, so nodes merging the same versions get
+# the same content.
+#
+# Common cases take linear time: both sides only appended lines (logs), or every side
+# changed one region of the file (regions are found by comparing common prefix and
+# suffix with base in large chunks). Only if the regions overlap, lines of the overlapping
+# part are compared with difflib - at most MAX_DIFF_LINES of them.
+
+# Overlapping parts of versions with more lines are not compared (they are not merged)
+MAX_DIFF_LINES = 20000
+
+# How much of two versions is compared at once when looking for a common prefix/suffix
+COMPARE_CHUNK_SIZE = 64 * 1024
+
+
+def _common_prefix(a, b):
+    a, b = memoryview(a), memoryview(b)
+    n = min(len(a), len(b))
+
+    pos = 0
+    while pos < n:
+        end = min(pos + COMPARE_CHUNK_SIZE, n)
+        if a[pos:end] != b[pos:end]:
+            while a[pos] == b[pos]:
+                pos += 1
+            return pos
+        pos = end
+
+    return n
+
+
+def _common_suffix(a, b, limit):
+    a, b = memoryview(a), memoryview(b)
+
+    n = 0
+    while n < limit:
+        size = min(COMPARE_CHUNK_SIZE, limit - n)
+        if a[len(a) - n - size:len(a) - n] != b[len(b) - n - size:len(b) - n]:
+            while a[len(a) - n - 1] == b[len(b) - n - 1]:
+                n += 1
+            return n
+        n += size
+
+    return limit
+
+
+# Returns (start, base_end, end): lines base[start:base_end] were replaced with
+# version[start:end], all other lines are the same in both
+def _changed_region(base, version):
+    prefix = _common_prefix(base, version)
+    suffix = _common_suffix(base, version, min(len(base), len(version)) - prefix)
+
+    # Whole lines only
+    start = base.rfind(b"\n", 0, prefix) + 1
+    base_end = len(base) - suffix
+    if base_end > 0 and base[base_end - 1:base_end] != b"\n":
+        base_end = base.find(b"\n", base_end) + 1 or len(base)
+
+    return start, base_end, len(version) - (len(base) - base_end)
+
+
+# Changes of lines of base made in version, as (first, end, side, replacement) tuples
+def _hunks(base_lines, lines, side):
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    return [(i1, i2, side, lines[j1:j2]) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+# Merges overlapping parts of both versions line by line
+def _merge_lines(base, x, y):
+    base_lines, x_lines, y_lines = base.splitlines(True), x.splitlines(True), y.splitlines(True)
+    if max(len(base_lines), len(x_lines), len(y_lines)) > MAX_DIFF_LINES:
+        return None
+
+    merged = []
+    for hunk in sorted(_hunks(base_lines, x_lines, 0) + _hunks(base_lines, y_lines, 1)):
+        if merged:
+            last = merged[-1]
+
+            # The same change made on both sides
+            if (hunk[0], hunk[1], hunk[3]) == (last[0], last[1], last[3]):
+                continue
+            if hunk[0] < last[1] or (hunk[0] == last[1] and hunk[2] != last[2]):
+                return None
+
+        merged.append(hunk)
+
+    result = []
+    position = 0
+    for first, end, _, replacement in merged:
+        result.extend(base_lines[position:first])
+        result.extend(replacement)
+        position = end
+    result.extend(base_lines[position:])
+
+    return b"".join(result)
+
+
+# Returns content combining changes made in x and y (both created from base) or None
+# if they cannot be merged
+def merge(base, x, y):
+    if x == y or y == base:
+        return x
+    if x == base:
+        return y
+
+    # Binary files are not merged
+    if b"\0" in base or b"\0" in x or b"\0" in y:
+        return None
+
+    # Lines appended on both sides (e.g. to a log), x goes first. Lines both sides start
+    # with (e.g. both merged the same changes before) are kept once.
+    if (x.startswith(base) and y.startswith(base) and base[-1:] in (b"", b"\n") and x.endswith(b"\n")):
+        common = len(base) + _common_prefix(x[len(base):], y[len(base):])
+        common = max(x.rfind(b"\n", len(base), common) + 1, len(base))
+        return x + y[common:]
+
+    x_start, x_base_end, x_end = _changed_region(base, x)
+    y_start, y_base_end, y_end = _changed_region(base, y)
+
+    if x_base_end < y_start or y_base_end < x_start:
+        (first, base_end1, end1, v1), (second, base_end2, end2, v2) = sorted(
+            [(x_start, x_base_end, x_end, x), (y_start, y_base_end, y_end, y)], key=lambda region: region[0])
+
+        return b"".join([base[:first], v1[first:end1], base[base_end1:second], v2[second:end2], base[base_end2:]])
+
+    # Both versions differ from base only within the window
+    start, end = min(x_start, y_start), max(x_base_end, y_base_end)
+    merged = _merge_lines(base[start:end], x[start:len(x) - (len(base) - end)], y[start:len(y) - (len(base) - end)])
+    if merged is None:
+        return None
+
+    return base[:start] + merged + base[end:]
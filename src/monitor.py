@@ -1,49 +1,249 @@
 import pyinotify
+import os
+import select
 import time
 import threading
+import logging
 
 # Watches for changes in a directory
 # http://seb.dbzteam.org/pyinotify/
+#
+# Events are handled by a thread which blocks in poll() on the inotify descriptor,
+# so changes are processed as soon as they happen and nothing runs while the
+# directory is idle. stop() wakes the thread up through a pipe.
+#
+# Whole directory tree is watched (except for excluded directories). Watches for new
+# subdirectories are added by the event handler (see add_directory).
 class Watcher:
-    def __init__(self, directory, event_handler, interval=1):
-        self.interval = interval
-
+    def __init__(self, directory, event_handler, excluded=[]):
         # watched events
-        mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE |\
-               pyinotify.IN_MODIFY | pyinotify.IN_OPEN |\
-               pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CLOSE_NOWRITE |\
-               pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        self.mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE |\
+                    pyinotify.IN_MODIFY | pyinotify.IN_OPEN |\
+                    pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CLOSE_NOWRITE |\
+                    pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+
+        self.excluded = set(os.path.normpath(path) for path in excluded)
+
+        # wd -> watched directory and watched directory -> wd
+        # (WatchManager can only find wd of a path by scanning all watches)
+        self.paths = {}
+        self.wds = {}
+
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, event_handler)
+        self.add_directory(directory)
+
+        self.wakeup_read, self.wakeup_write = os.pipe()
+
+        self.poller = select.poll()
+        self.poller.register(self.wm.get_fd(), select.POLLIN)
+        self.poller.register(self.wakeup_read, select.POLLIN)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    # Adds watches for directory and all its subdirectories.
+    # Returns files found in those directories.
+    def add_directory(self, directory):
+        files = []
+        stack = [os.path.normpath(directory)]
+
+        while stack:
+            path = stack.pop()
+            if path in self.wds or path in self.excluded:
+                continue
+
+            # Watch is added before listing the directory so that no file is missed
+            wd = self.wm.add_watch(path, self.mask, quiet=True).get(path, -1)
+            if wd < 0:
+                logging.warning("Cannot watch %s (fs.inotify.max_user_watches too low?)" % path)
+                continue
+
+            self.paths[wd] = path
+            self.wds[path] = wd
+
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            files.append(entry.path)
+            except OSError:
+                # Directory was removed in the meantime
+                continue
 
-        wm = pyinotify.WatchManager()
+        return files
 
-        # Check directory for events every 1000ms timeout=self.interval * 1000
-        self.notifier = pyinotify.Notifier(wm, event_handler, timeout=0)
-        wdd = wm.add_watch(directory, mask)
+    # Removes watches of a directory which was moved (possibly out of the watched tree)
+    # and of its subdirectories. If it was moved within the tree, it is added again under
+    # its new path (see Monitor.process_IN_MOVED_TO).
+    def remove_directory(self, directory):
+        directory = os.path.normpath(directory)
+        prefix = directory + os.sep
 
-        self._run_check_events()
+        for path in [path for path in self.wds if path == directory or path.startswith(prefix)]:
+            wd = self.wds.pop(path)
+            del self.paths[wd]
+            self.wm.rm_watch(wd, quiet=True)
 
-    # Periodically check events and make actions (defined in EventHandler)
-    def _run_check_events(self):
-        self._check_events()
-        threading.Timer(self.interval, self._run_check_events).start()
+    # Called when watch was removed (directory deleted or moved out)
+    def forget(self, wd):
+        path = self.paths.pop(wd, None)
+        if path is not None:
+            del self.wds[path]
+
+    # Waits for events and makes actions (defined in EventHandler)
+    def _run(self):
+        while True:
+            for fd, _ in self.poller.poll():
+                if fd == self.wakeup_read:
+                    return
 
-    def _check_events(self):
-        self.notifier.process_events()
-        while self.notifier.check_events():
             self.notifier.read_events()
             self.notifier.process_events()
 
+    def stop(self):
+        os.write(self.wakeup_write, b"\0")
+        self.thread.join()
+
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+        self.notifier.stop()
+
+
+# Merges bursts of events for the same path into a single one. Path is passed to
+# the callback when no new event for it arrived for quiet_period seconds, but not
+# later than max_latency seconds after the first event of the burst.
+class Coalescer:
+    def __init__(self, callback, quiet_period=0.1, max_latency=1.0):
+        self.callback = callback
+        self.quiet_period = quiet_period
+        self.max_latency = max_latency
+
+        # path -> [time of the first event, time of the last event, number of events]
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        self.events_n = 0
+        self.merged_n = 0
+        self.emitted_n = 0
+
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.start()
+
+    def add(self, path):
+        now = time.monotonic()
+
+        with self.condition:
+            self.events_n += 1
+
+            entry = self.pending.get(path)
+            if entry is None:
+                self.pending[path] = [now, now, 1]
+                self.condition.notify()
+            else:
+                entry[1] = now
+                entry[2] += 1
+                self.merged_n += 1
+
+    def __deadline(self, entry):
+        return min(entry[1] + self.quiet_period, entry[0] + self.max_latency)
+
+    # Removes and returns paths which should be emitted now and time of the nearest deadline
+    def __take_due(self, now):
+        due = []
+        next_deadline = None
+
+        for path, entry in self.pending.items():
+            deadline = self.__deadline(entry)
+            if deadline <= now or self.stopped:
+                due.append((path, entry[2]))
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+
+        for path, _ in due:
+            del self.pending[path]
+        self.emitted_n += len(due)
+
+        return due, next_deadline
+
+    def __run(self):
+        while True:
+            with self.condition:
+                due, next_deadline = self.__take_due(time.monotonic())
+
+                if not due:
+                    if self.stopped:
+                        return
+
+                    timeout = None if next_deadline is None else next_deadline - time.monotonic()
+                    self.condition.wait(timeout)
+                    continue
+
+            # Callback is called without the lock so new events can be added meanwhile
+            for path, events_n in due:
+                if events_n > 1:
+                    logging.debug("Coalescer: %d events merged for %s" % (events_n, path))
+                self.callback(path)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "events": self.events_n,
+                "merged": self.merged_n,
+                "emitted": self.emitted_n,
+                "pending": len(self.pending),
+            }
+
+    # Emits all pending paths and stops
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        self.thread.join()
+
+
 class Monitor(pyinotify.ProcessEvent):
-    def __init__(self, directory, callback):
-        self.files_watcher = Watcher(directory, self)
+    # Bursts of writes to a file are coalesced into one file_updated call, see Coalescer.
+    # quiet_period == 0 disables coalescing.
+    #
+    # Excluded directories (e.g. metadata) are not watched.
+    def __init__(self, directory, callback, quiet_period=0.1, max_latency=1.0, excluded=[]):
         self.callback = callback
 
+        self.coalescer = None
+        if quiet_period > 0:
+            self.coalescer = Coalescer(callback.file_updated, quiet_period, max_latency)
+
+        self.files_watcher = Watcher(directory, self, excluded)
+
+    def __file_updated(self, pathname):
+        if self.coalescer is not None:
+            self.coalescer.add(pathname)
+        else:
+            self.callback.file_updated(pathname)
+
+    # New directory is watched and files which were created in it before the watch
+    # was added are reported as updated
+    def __directory_added(self, pathname):
+        for file in self.files_watcher.add_directory(pathname):
+            self.__file_updated(file)
+
+    # Stops watching, pending (coalesced) events are still reported
+    def stop(self):
+        self.files_watcher.stop()
+
+        if self.coalescer is not None:
+            self.coalescer.stop()
+
     ############ defines handlers for different fs events ############
 
-    # XXX currently, only one level directory is supoorted - changes
-    # in sub directoreis are NOT handled
     def process_IN_CREATE(self, event):
-        pass
+        if event.dir:
+            self.__directory_added(event.pathname)
 
     def process_IN_MODIFY(self, event):
         pass
@@ -55,13 +255,18 @@ class Monitor(pyinotify.ProcessEvent):
         pass
 
     def process_IN_CLOSE_WRITE(self, event):
-        self.callback.file_updated(event.pathname)
+        self.__file_updated(event.pathname)
 
     def process_IN_CLOSE_NOWRITE(self, event):
         pass
 
     def process_IN_MOVED_FROM(self, event):
-        pass
+        if event.dir:
+            self.files_watcher.remove_directory(event.pathname)
 
     def process_IN_MOVED_TO(self, event):
-        pass
\ No newline at end of file
+        if event.dir:
+            self.__directory_added(event.pathname)
+
+    def process_IN_IGNORED(self, event):
+        self.files_watcher.forget(event.wd)
@@ -0,0 +1,112 @@
+import threading
+import time
+
+from serialization import Serializable
+
+# Seconds between beacons
+BEACON_INTERVAL = 5
+
+# Neighbor which did not send a beacon for this many seconds is considered gone
+NEIGHBOR_TIMEOUT = 3 * BEACON_INTERVAL
+
+# Capabilities announced in beacons
+CAPABILITY_CUSTODY = 1
+CAPABILITY_COMPRESSION = 2
+CAPABILITY_ANTI_ENTROPY = 4
+
+
+# Periodically broadcast by every node. summary is the root digest of the node's
+# directory (see digest.DirectoryDigest) - nodes with equal summaries have nothing
+# to send to each other.
+class Beacon(Serializable):
+    TYPE_ID = 10
+    SCHEMA_VERSION = 1
+
+    def __init__(self, node_id=None, capabilities=0, summary=None):
+        self.node_id = node_id
+        self.capabilities = capabilities
+        self.summary = summary
+
+    def encode(self, writer):
+        writer.write_fixed(self.node_id)
+        writer.write_varint(self.capabilities)
+        writer.write_fixed(self.summary)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        return cls(reader.read_fixed(16), reader.read_varint(), reader.read_fixed(16))
+
+
+class Neighbor:
+    def __init__(self, node_id, address, capabilities, summary, last_seen):
+        self.node_id = node_id
+        self.address = address
+        self.capabilities = capabilities
+        self.summary = summary
+        self.last_seen = last_seen
+
+    def capable(self, capability):
+        return self.capabilities & capability != 0
+
+
+# Nodes which were heard from (sent a beacon) within timeout seconds
+class NeighborTable:
+    def __init__(self, timeout=NEIGHBOR_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+        # node id -> Neighbor
+        self.neighbors = {}
+
+    # Records beacon received from address. Returns (neighbor, new) where new is True
+    # if the neighbor was not in the table.
+    def update(self, beacon, address, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            neighbor = self.neighbors.get(beacon.node_id)
+            new = neighbor is None or now - neighbor.last_seen > self.timeout
+            if neighbor is None:
+                neighbor = self.neighbors[beacon.node_id] = Neighbor(beacon.node_id, address, beacon.capabilities,
+                                                                     beacon.summary, now)
+            else:
+                neighbor.address = address
+                neighbor.capabilities = beacon.capabilities
+                neighbor.summary = beacon.summary
+                neighbor.last_seen = now
+
+            return neighbor, new
+
+    # Removes neighbors which timed out, returns them
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            expired = [neighbor for neighbor in self.neighbors.values() if now - neighbor.last_seen > self.timeout]
+            for neighbor in expired:
+                del self.neighbors[neighbor.node_id]
+
+            return expired
+
+    def alive(self, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            return [neighbor for neighbor in self.neighbors.values() if now - neighbor.last_seen <= self.timeout]
+
+    # True if all alive neighbors (or the one at address) announced capability. Nodes
+    # which are not in the table are not known to have it.
+    def capable(self, capability, address=None, now=None):
+        alive = self.alive(now)
+        if address is None:
+            return all(neighbor.capable(capability) for neighbor in alive)
+
+        return any(neighbor.address == address and neighbor.capable(capability) for neighbor in alive)
+
+    def get(self, node_id):
+        with self.lock:
+            return self.neighbors.get(node_id)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.neighbors)
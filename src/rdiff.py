@@ -0,0 +1,793 @@
+import bisect
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import threading
+
+from itertools import accumulate
+
+import utils
+
+# Delta engines producing and consuming librsync (rdiff) compatible signatures and deltas.
+#
+# Two backends are available:
+#  * NativeBackend - in-process rolling checksum implementation (no fork/exec, no pipes)
+#  * RdiffBackend - runs rdiff binary in a subprocess
+#
+# NativeBackend computes checksums in Python - it is faster than running rdiff only for
+# small files (where fork/exec dominates), signatures and deltas of bigger files are
+# computed by rdiff if it is installed (see SizeBackend, "auto" backend). NativeBackend
+# holds the GIL, so when it is used for big files, they are handled by a pool of
+# processes (see ProcessBackend) and workers compute deltas of several files at once.
+#
+# Both backends speak the same on-disk/on-wire formats so nodes using different backends
+# can exchange patches. NativeBackend writes BLAKE2 signatures and is able to read
+# MD4, BLAKE2, RabinKarp-MD4 and RabinKarp-BLAKE2 signatures (MD4 only if hashlib
+# provides it). If it cannot handle some input, UnsupportedFormat is raised and
+# FallbackBackend retries the operation with rdiff.
+
+MD4_SIG_MAGIC = 0x72730136
+BLAKE2_SIG_MAGIC = 0x72730137
+RK_MD4_SIG_MAGIC = 0x72730146
+RK_BLAKE2_SIG_MAGIC = 0x72730147
+DELTA_MAGIC = 0x72730236
+
+DEFAULT_BLOCK_LEN = 2048
+DEFAULT_STRONG_LEN = 8
+
+# librsync always computes BLAKE2 sums of this length and truncates them
+BLAKE2_SUM_LEN = 32
+
+MD4_SUM_LEN = 16
+
+ROLLSUM_CHAR_OFFSET = 31
+
+RABINKARP_SEED = 1
+RABINKARP_MULT = 0x08104225
+RABINKARP_ADJ = 0x08104224
+
+# Delta opcodes (see librsync prototab.h)
+OP_END = 0x00
+OP_LITERAL_N1 = 0x41
+OP_COPY_N1_N1 = 0x45
+OP_COPY_N8_N8 = 0x54
+
+# How much of a file is read at once when computing signatures or copying data
+IO_CHUNK_SIZE = 1024 * 1024
+
+# Files at least this big are mapped to memory instead of being read when computing deltas
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# Copies of at least this many bytes of the basis are done by the kernel when patching
+COPY_FILE_RANGE_THRESHOLD = 64 * 1024
+
+# Signatures and deltas of files up to this size are computed in process by the "auto"
+# backend, bigger files are handled by rdiff
+NATIVE_MAX_FILE_SIZE = 16 * 1024
+
+_INT_SIZES = (1, 2, 4, 8)
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def _int_len(value):
+    for size in _INT_SIZES:
+        if value < (1 << (size * 8)):
+            return size
+
+    raise ValueError("Value too big: %d" % value)
+
+
+def _md4_available():
+    try:
+        hashlib.new("md4")
+        return True
+    except ValueError:
+        return False
+
+
+MD4_AVAILABLE = _md4_available()
+
+
+def _md4_sum(data):
+    return hashlib.new("md4", data).digest()
+
+
+def _blake2_sum(data):
+    return hashlib.blake2b(data, digest_size=BLAKE2_SUM_LEN).digest()
+
+
+def rollsum(block):
+    n = len(block)
+    s1 = sum(block) + n * ROLLSUM_CHAR_OFFSET
+    s2 = sum(accumulate(block)) + (n * (n + 1) // 2) * ROLLSUM_CHAR_OFFSET
+
+    return ((s2 & 0xffff) << 16) | (s1 & 0xffff)
+
+
+def rabinkarp(block):
+    value = RABINKARP_SEED
+    for byte in block:
+        value = (value * RABINKARP_MULT + byte) & 0xffffffff
+
+    return value
+
+
+# Parsed signature file: block sums of a basis file
+class Signature:
+    def __init__(self, magic, block_len, strong_len):
+        if magic in (MD4_SIG_MAGIC, RK_MD4_SIG_MAGIC):
+            self.strong_fn = _md4_sum
+            max_strong_len = MD4_SUM_LEN
+        elif magic in (BLAKE2_SIG_MAGIC, RK_BLAKE2_SIG_MAGIC):
+            self.strong_fn = _blake2_sum
+            max_strong_len = BLAKE2_SUM_LEN
+        else:
+            raise UnsupportedFormat("Unknown signature magic: %x" % magic)
+
+        # Signatures can come from other nodes (see antientropy.PatchRequest), block_len 0
+        # would never advance the delta computation
+        if block_len == 0:
+            raise UnsupportedFormat("Invalid signature block length: 0")
+        if not 1 <= strong_len <= max_strong_len:
+            raise UnsupportedFormat("Invalid signature strong sum length: %d" % strong_len)
+
+        self.magic = magic
+        self.rabinkarp = magic in (RK_MD4_SIG_MAGIC, RK_BLAKE2_SIG_MAGIC)
+        self.block_len = block_len
+        self.strong_len = strong_len
+
+        # weak sums of all blocks (for cheap rejection while rolling)
+        self.weak_sums = set()
+        # strong sum -> index of the first block with such sum
+        self.blocks = {}
+        self.blocks_n = 0
+
+    def strong_sum(self, data):
+        return self.strong_fn(data)[:self.strong_len]
+
+    def weak_sum(self, data):
+        if self.rabinkarp:
+            return rabinkarp(data)
+        return rollsum(data)
+
+    @staticmethod
+    def parse(buffer):
+        buffer = memoryview(buffer)
+        if len(buffer) < 12:
+            raise UnsupportedFormat("Signature too short")
+
+        magic, block_len, strong_len = struct.unpack_from(">III", buffer, 0)
+        signature = Signature(magic, block_len, strong_len)
+
+        entry_len = 4 + strong_len
+        entries_n = (len(buffer) - 12) // entry_len
+
+        if entries_n > 0 and signature.strong_fn is _md4_sum and not MD4_AVAILABLE:
+            raise UnsupportedFormat("MD4 is not supported by hashlib")
+
+        offset = 12
+        for i in range(entries_n):
+            weak, = struct.unpack_from(">I", buffer, offset)
+            strong = bytes(buffer[offset + 4:offset + entry_len])
+            offset += entry_len
+
+            signature.weak_sums.add(weak)
+            signature.blocks.setdefault(strong, i)
+
+        signature.blocks_n = entries_n
+
+        return signature
+
+
+# Accumulates delta commands, merging adjacent copies (and adjacent literals) into one command
+class _DeltaWriter:
+    def __init__(self):
+        self.buffer = bytearray(struct.pack(">I", DELTA_MAGIC))
+        self.copy_start = 0
+        self.copy_len = 0
+        self.literal_parts = []
+
+    def __flush_copy(self):
+        if self.copy_len == 0:
+            return
+
+        where_len = _int_len(self.copy_start)
+        len_len = _int_len(self.copy_len)
+
+        op = OP_COPY_N1_N1 + _INT_SIZES.index(where_len) * 4 + _INT_SIZES.index(len_len)
+        self.buffer.append(op)
+        self.buffer += self.copy_start.to_bytes(where_len, "big")
+        self.buffer += self.copy_len.to_bytes(len_len, "big")
+
+        self.copy_len = 0
+
+    def copy(self, start, length):
+        self.__flush_literal()
+
+        if self.copy_len > 0 and self.copy_start + self.copy_len == start:
+            self.copy_len += length
+            return
+
+        self.__flush_copy()
+        self.copy_start = start
+        self.copy_len = length
+
+    def literal(self, data):
+        if len(data) == 0:
+            return
+
+        self.__flush_copy()
+        self.literal_parts.append(data)
+
+    def __flush_literal(self):
+        if not self.literal_parts:
+            return
+
+        data = self.literal_parts[0] if len(self.literal_parts) == 1 else b"".join(self.literal_parts)
+        self.literal_parts = []
+
+        if len(data) <= 64:
+            # Immediate literal, opcode is the length itself
+            self.buffer.append(len(data))
+        else:
+            len_len = _int_len(len(data))
+            self.buffer.append(OP_LITERAL_N1 + _INT_SIZES.index(len_len))
+            self.buffer += len(data).to_bytes(len_len, "big")
+
+        self.buffer += data
+
+    def finish(self):
+        self.__flush_literal()
+        self.__flush_copy()
+        self.buffer.append(OP_END)
+
+        return bytes(self.buffer)
+
+
+# Yields delta commands as tuples: ("literal", memoryview) or ("copy", where, length)
+def parse_delta(delta):
+    delta = memoryview(delta)
+    if len(delta) < 4 or struct.unpack_from(">I", delta, 0)[0] != DELTA_MAGIC:
+        raise UnsupportedFormat("Not a delta")
+
+    pos = 4
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+
+        if op == OP_END:
+            return
+        elif op <= 64:
+            yield ("literal", delta[pos:pos + op])
+            pos += op
+        elif op < OP_COPY_N1_N1:
+            len_len = _INT_SIZES[op - OP_LITERAL_N1]
+            length = int.from_bytes(delta[pos:pos + len_len], "big")
+            pos += len_len
+            yield ("literal", delta[pos:pos + length])
+            pos += length
+        elif op <= OP_COPY_N8_N8:
+            where_len = _INT_SIZES[(op - OP_COPY_N1_N1) // 4]
+            len_len = _INT_SIZES[(op - OP_COPY_N1_N1) % 4]
+            where = int.from_bytes(delta[pos:pos + where_len], "big")
+            pos += where_len
+            length = int.from_bytes(delta[pos:pos + len_len], "big")
+            pos += len_len
+            yield ("copy", where, length)
+        else:
+            raise UnsupportedFormat("Unknown delta opcode: %x" % op)
+
+    raise UnsupportedFormat("Truncated delta")
+
+
+# Returns delta equivalent to applying deltas one after another (copies of every delta
+# refer to the result of the previous one, copies of the result refer to the basis
+# of the first delta), so a file can be patched once instead of len(deltas) times.
+def compose_deltas(deltas):
+    result = deltas[0]
+    for delta in deltas[1:]:
+        result = _compose(result, delta)
+
+    return result
+
+
+def _compose(first, second):
+    # Commands of the first delta with offsets in its result
+    starts = []
+    commands = []
+    length = 0
+    for command in parse_delta(first):
+        starts.append(length)
+        commands.append(command)
+        length += len(command[1]) if command[0] == "literal" else command[2]
+
+    out = _DeltaWriter()
+    for command in parse_delta(second):
+        if command[0] == "literal":
+            out.literal(command[1])
+            continue
+
+        _, where, copy_len = command
+        if where + copy_len > length:
+            raise UnsupportedFormat("Copy beyond end of basis file")
+
+        index = bisect.bisect_right(starts, where) - 1
+        while copy_len > 0:
+            offset = where - starts[index]
+            command = commands[index]
+
+            if command[0] == "literal":
+                n = min(copy_len, len(command[1]) - offset)
+                out.literal(command[1][offset:offset + n])
+            else:
+                n = min(copy_len, command[2] - offset)
+                out.copy(command[1] + offset, n)
+
+            where += n
+            copy_len -= n
+            index += 1
+
+    return out.finish()
+
+
+# Writes patched file (opened unbuffered) from literals and ranges of the basis file
+class _PatchWriter:
+    def __init__(self, basis, out):
+        self.basis = basis
+        self.out = out
+        self.basis_size = os.fstat(basis.fileno()).st_size
+        self.buffer = bytearray()
+
+        self.mapped = None
+        self.view = memoryview(b"")
+        if self.basis_size > 0:
+            self.mapped = mmap.mmap(basis.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mapped)
+
+        self.copy_file_range = hasattr(os, "copy_file_range")
+
+    def __write(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            n = self.out.write(data)
+            data = data[n:]
+
+    def flush(self):
+        if self.buffer:
+            self.__write(self.buffer)
+            self.buffer = bytearray()
+
+    def __append(self, data):
+        self.buffer += data
+        if len(self.buffer) >= IO_CHUNK_SIZE:
+            self.flush()
+
+    def literal(self, data):
+        if len(data) >= IO_CHUNK_SIZE:
+            self.flush()
+            self.__write(data)
+        else:
+            self.__append(data)
+
+    def copy(self, where, length):
+        if where + length > self.basis_size:
+            raise UnsupportedFormat("Copy beyond end of basis file")
+
+        if length >= COPY_FILE_RANGE_THRESHOLD and self.copy_file_range:
+            self.flush()
+            try:
+                while length > 0:
+                    n = os.copy_file_range(self.basis.fileno(), self.out.fileno(), length, where)
+                    if n == 0:
+                        raise UnsupportedFormat("Copy beyond end of basis file")
+                    where += n
+                    length -= n
+                return
+            except OSError as e:
+                # Not supported by the kernel or between these filesystems
+                logging.debug("rdiff: copy_file_range failed (%s), copying through memory" % e)
+                self.copy_file_range = False
+
+        for start in range(where, where + length, IO_CHUNK_SIZE):
+            self.__append(self.view[start:min(start + IO_CHUNK_SIZE, where + length)])
+
+    def close(self):
+        self.view.release()
+        if self.mapped is not None:
+            self.mapped.close()
+
+
+# In-process implementation of rdiff signature/delta/patch
+class NativeBackend:
+    name = "native"
+
+    def __init__(self, block_len=DEFAULT_BLOCK_LEN, strong_len=DEFAULT_STRONG_LEN):
+        self.block_len = block_len
+        self.strong_len = strong_len
+
+    def __signature_header(self):
+        return struct.pack(">III", BLAKE2_SIG_MAGIC, self.block_len, self.strong_len)
+
+    # Appends sums of blocks [first, end) of an open file to signature (end is None
+    # for all blocks up to the end of the file)
+    def __sum_blocks(self, out, f, first, end=None):
+        # Read many blocks at once, IO_CHUNK_SIZE is a multiple of block_len
+        chunk_blocks = max(1, IO_CHUNK_SIZE // self.block_len)
+
+        f.seek(first * self.block_len)
+        while end is None or first < end:
+            blocks_n = chunk_blocks if end is None else min(chunk_blocks, end - first)
+            chunk = f.read(blocks_n * self.block_len)
+            if not chunk:
+                break
+
+            view = memoryview(chunk)
+            for start in range(0, len(view), self.block_len):
+                block = view[start:start + self.block_len]
+                out += struct.pack(">I", rollsum(block))
+                out += _blake2_sum(block)[:self.strong_len]
+
+            first += blocks_n
+
+    def signature(self, file):
+        out = bytearray(self.__signature_header())
+
+        with open(file, 'rb') as f:
+            self.__sum_blocks(out, f, 0)
+
+        return bytes(out)
+
+    # Returns signature of file computed from signature of its previous version (basis)
+    # and delta which turned the basis into file. Sums of blocks copied whole from
+    # the basis (at a block boundary) are taken from the old signature, only the other
+    # blocks are read and hashed. Result is identical to signature(file).
+    #
+    # Raises UnsupportedFormat if the old signature was not written by this backend
+    # (with the same parameters) or delta does not describe file.
+    def update_signature(self, signature, delta, file):
+        signature = memoryview(signature)
+        header = self.__signature_header()
+        if bytes(signature[:len(header)]) != header:
+            raise UnsupportedFormat("Signature was not written by this backend")
+
+        entry_len = 4 + self.strong_len
+        # Basis length is not known, so the last block of the basis (which can be
+        # shorter than block_len) is never reused
+        full_blocks_n = max(0, (len(signature) - len(header)) // entry_len - 1)
+
+        block_len = self.block_len
+        out = bytearray(header)
+
+        with open(file, 'rb') as f:
+            length = os.fstat(f.fileno()).st_size
+            next_block = 0
+            pos = 0
+
+            for command in parse_delta(delta):
+                if command[0] == "literal":
+                    pos += len(command[1])
+                    continue
+
+                _, where, copy_len = command
+
+                # Blocks of file lying whole in the copied range
+                first = (pos + block_len - 1) // block_len
+                end = (pos + copy_len) // block_len
+                pos += copy_len
+
+                source = where + first * block_len - (pos - copy_len)
+                if first >= end or source % block_len != 0:
+                    continue
+
+                # Corresponding blocks of the basis
+                source_first = source // block_len
+                end = min(end, first + full_blocks_n - source_first)
+                if first >= end:
+                    continue
+
+                self.__sum_blocks(out, f, next_block, first)
+                out += signature[len(header) + source_first * entry_len:len(header) + (source_first + end - first) * entry_len]
+                next_block = end
+
+            if pos != length:
+                raise UnsupportedFormat("Delta does not describe file (%d != %d bytes)" % (pos, length))
+
+            self.__sum_blocks(out, f, next_block)
+
+        return bytes(out)
+
+    def delta(self, signature, file):
+        signature = Signature.parse(signature)
+
+        # Large files are mapped instead of being read, their pages can be dropped by
+        # the kernel when memory is needed
+        with open(file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_THRESHOLD:
+                return self._delta(signature, f.read())
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return self._delta(signature, data)
+
+    def _delta(self, signature, data):
+        out = _DeltaWriter()
+
+        n = len(data)
+        block_len = signature.block_len
+        blocks = signature.blocks
+        weak_sums = signature.weak_sums
+        strong_sum = signature.strong_sum
+
+        if signature.blocks_n == 0:
+            out.literal(data)
+            return out.finish()
+
+        rabinkarp_sum = signature.rabinkarp
+        rk_mult = pow(RABINKARP_MULT, block_len, 1 << 32)
+
+        pos = 0
+        literal_start = 0
+        rolling = False
+        s1 = s2 = weak = 0
+
+        while pos + block_len <= n:
+            if not rolling:
+                # Just after a match (or at the beginning) - unchanged files are matched
+                # block after block, try strong sum directly and avoid rolling
+                index = blocks.get(strong_sum(data[pos:pos + block_len]))
+                if index is not None:
+                    out.literal(data[literal_start:pos])
+                    out.copy(index * block_len, block_len)
+                    pos += block_len
+                    literal_start = pos
+                    continue
+
+                rolling = True
+                if rabinkarp_sum:
+                    weak = rabinkarp(data[pos:pos + block_len])
+                else:
+                    block = data[pos:pos + block_len]
+                    s1 = (sum(block) + block_len * ROLLSUM_CHAR_OFFSET) & 0xffff
+                    s2 = (sum(accumulate(block)) + (block_len * (block_len + 1) // 2) * ROLLSUM_CHAR_OFFSET) & 0xffff
+            else:
+                if not rabinkarp_sum:
+                    weak = (s2 << 16) | s1
+
+                if weak in weak_sums:
+                    index = blocks.get(strong_sum(data[pos:pos + block_len]))
+                    if index is not None:
+                        out.literal(data[literal_start:pos])
+                        out.copy(index * block_len, block_len)
+                        pos += block_len
+                        literal_start = pos
+                        rolling = False
+                        continue
+
+            if pos + block_len == n:
+                break
+
+            # Roll checksum by one byte
+            byte_out = data[pos]
+            byte_in = data[pos + block_len]
+            if rabinkarp_sum:
+                weak = (weak * RABINKARP_MULT + byte_in - rk_mult * (byte_out + RABINKARP_ADJ)) & 0xffffffff
+            else:
+                s1 = (s1 + byte_in - byte_out) & 0xffff
+                s2 = (s2 + s1 - block_len * (byte_out + ROLLSUM_CHAR_OFFSET)) & 0xffff
+            pos += 1
+
+        # Last block of the basis file may be shorter than block_len
+        if not rolling and pos < n:
+            index = blocks.get(strong_sum(data[pos:n]))
+            if index is not None:
+                out.literal(data[literal_start:pos])
+                out.copy(index * block_len, n - pos)
+                literal_start = n
+
+        out.literal(data[literal_start:n])
+
+        return out.finish()
+
+    # Streams the new file: literals are written straight from the delta (no copies),
+    # copied ranges are moved between files by the kernel (copy_file_range, which may
+    # share extents on filesystems supporting reflinks) or, for small ranges, gathered
+    # from the memory mapped basis into large sequential writes. Memory used does not
+    # depend on the size of the file.
+    def patch(self, file, delta, new_file):
+        with open(file, 'rb') as basis, open(new_file, 'wb', buffering=0) as out:
+            writer = _PatchWriter(basis, out)
+            try:
+                for command in parse_delta(delta):
+                    if command[0] == "literal":
+                        writer.literal(command[1])
+                    else:
+                        writer.copy(command[1], command[2])
+
+                writer.flush()
+            finally:
+                writer.close()
+
+
+# Runs rdiff binary for every operation
+class RdiffBackend:
+    name = "rdiff"
+
+    def signature(self, file):
+        return utils.run_command(["rdiff", "signature", file, "-"])
+
+    def delta(self, signature, file):
+        return utils.run_command(["rdiff", "delta", "-", file], signature)
+
+    def patch(self, file, delta, new_file):
+        return utils.run_command(["rdiff", "patch", file, "-", new_file], delta)
+
+    def update_signature(self, signature, delta, file):
+        return self.signature(file)
+
+
+def _native_call(method, *args):
+    return getattr(NativeBackend(), method)(*args)
+
+
+# Computes signatures and deltas with NativeBackend in a pool of processes_n processes
+# (started when they are needed for the first time). Files are patched in process,
+# patching holds the GIL only between kernel copies and writes.
+class ProcessBackend:
+    name = "native-processes"
+
+    def __init__(self, processes_n):
+        self.processes_n = processes_n
+        self.native = NativeBackend()
+
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    # Processes are not forked from this (multithreaded) process
+    def __pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.processes_n,
+                                                                   mp_context=multiprocessing.get_context(method))
+            return self.pool
+
+    # Buffers (e.g. memoryviews of received messages) are copied to bytes to be sent to the process
+    def __call(self, method, *args):
+        args = [bytes(arg) if isinstance(arg, memoryview) else arg for arg in args]
+        return self.__pool().submit(_native_call, method, *args).result()
+
+    def signature(self, file):
+        return self.__call("signature", file)
+
+    def delta(self, signature, file):
+        return self.__call("delta", signature, file)
+
+    def patch(self, file, delta, new_file):
+        return self.native.patch(file, delta, new_file)
+
+    def update_signature(self, signature, delta, file):
+        return self.__call("update_signature", signature, delta, file)
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+
+# Uses primary backend and switches to the fallback one for inputs the primary cannot handle
+class FallbackBackend:
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = primary.name + "+" + fallback.name
+
+    def __call(self, method, *args):
+        try:
+            return getattr(self.primary, method)(*args)
+        except UnsupportedFormat as e:
+            logging.debug("rdiff: %s backend cannot %s (%s), using %s" % (self.primary.name, method, e, self.fallback.name))
+            return getattr(self.fallback, method)(*args)
+
+    def signature(self, file):
+        return self.__call("signature", file)
+
+    def delta(self, signature, file):
+        return self.__call("delta", signature, file)
+
+    def patch(self, file, delta, new_file):
+        return self.__call("patch", file, delta, new_file)
+
+    # Signature is computed again by the primary backend (like signature() would)
+    def update_signature(self, signature, delta, file):
+        try:
+            return self.primary.update_signature(signature, delta, file)
+        except UnsupportedFormat as e:
+            logging.debug("rdiff: cannot update signature (%s), computing it again" % e)
+            return self.signature(file)
+
+
+# Computes signatures and deltas of files up to max_size bytes with small backend, bigger
+# files are handled by large backend. Files are always patched by small backend (patching
+# streams data between files, its cost does not depend on the backend).
+class SizeBackend:
+    def __init__(self, small, large, max_size=NATIVE_MAX_FILE_SIZE):
+        self.small = small
+        self.large = large
+        self.max_size = max_size
+        self.name = "%s<=%d<%s" % (small.name, max_size, large.name)
+
+    def __backend(self, file):
+        try:
+            return self.small if os.path.getsize(file) <= self.max_size else self.large
+        except OSError:
+            return self.small
+
+    def signature(self, file):
+        return self.__backend(file).signature(file)
+
+    def delta(self, signature, file):
+        return self.__backend(file).delta(signature, file)
+
+    def patch(self, file, delta, new_file):
+        return self.small.patch(file, delta, new_file)
+
+    def update_signature(self, signature, delta, file):
+        return self.__backend(file).update_signature(signature, delta, file)
+
+
+BACKENDS = ["auto", "native", "rdiff"]
+
+DEFAULT_BACKEND = "auto"
+
+_backend = None
+
+
+# Native engine for all files, big ones are handled by processes_n processes
+def _native_backend(processes_n):
+    if processes_n <= 1:
+        return NativeBackend()
+
+    return SizeBackend(NativeBackend(), ProcessBackend(processes_n))
+
+
+# processes_n is the number of files whose deltas are computed at once (number of workers)
+def create_backend(name, processes_n=1):
+    rdiff_installed = shutil.which("rdiff") is not None
+
+    if name == "auto":
+        if not rdiff_installed:
+            logging.warning("rdiff: rdiff is not installed, deltas of big files are computed slowly in process")
+            return _native_backend(processes_n)
+
+        return SizeBackend(FallbackBackend(NativeBackend(), RdiffBackend()), RdiffBackend())
+    elif name == "native":
+        backend = _native_backend(processes_n)
+        if rdiff_installed:
+            backend = FallbackBackend(backend, RdiffBackend())
+        return backend
+    elif name == "rdiff":
+        return RdiffBackend()
+
+    raise ValueError("Unknown delta backend: %s" % name)
+
+
+def set_backend(name, processes_n=1):
+    global _backend
+    _backend = create_backend(name, processes_n)
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = create_backend(DEFAULT_BACKEND)
+
+    return _backend
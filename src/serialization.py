@@ -1,14 +1,216 @@
 import pickle
 import io
 
+# Binary format of serialized objects:
+#
+#   type id (1 byte) | schema version (1 byte) | body length (varint) | body
+#
+# Body is written by the object's encode() and read by its decode(). Integers are
+# unsigned LEB128 varints, byte strings and text are prefixed with their length.
+# Decoders ignore bytes at the end of a body they do not know, so fields can be
+# appended in newer schema versions.
+#
+# Metadata files written by older versions (pickles) are still readable when they are
+# migrated, see LegacyUnpickler and Serializable.from_stored_bytes.
+PICKLE_PROTOCOL_MARKER = 0x80
+
+
+class SerializationError(Exception):
+    pass
+
+
+class Writer:
+    def __init__(self):
+        # Written data is kept as a list of parts (large byte strings are not copied)
+        # and joined once in getvalue()
+        self.parts = []
+        self.size = 0
+
+    def __append(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def write_varint(self, value):
+        if value < 0:
+            raise SerializationError("Negative varint: %d" % value)
+
+        data = bytearray()
+        while value > 0x7f:
+            data.append((value & 0x7f) | 0x80)
+            value >>= 7
+        data.append(value)
+
+        self.__append(data)
+
+    def write_fixed(self, data):
+        self.__append(data)
+
+    def write_bytes(self, data):
+        self.write_varint(len(data))
+        self.__append(data)
+
+    # None is written as length 0, other values as length + 1
+    def write_optional_bytes(self, data):
+        if data is None:
+            self.write_varint(0)
+            return
+
+        self.write_varint(len(data) + 1)
+        self.__append(data)
+
+    # Values of the same length (e.g. digests) written as one block
+    def write_fixed_array(self, values):
+        self.write_varint(len(values))
+        self.__append(b"".join(values))
+
+    def write_str(self, value):
+        self.write_bytes(value.encode('utf-8'))
+
+    def write_object(self, obj):
+        body = Writer()
+        obj.encode(body)
+
+        self.__append(bytes((obj.TYPE_ID, obj.SCHEMA_VERSION)))
+        self.write_varint(body.size)
+        self.parts += body.parts
+        self.size += body.size
+
+    def getvalue(self):
+        return b"".join(self.parts)
+
+
+# Reads from a buffer without copying it - read_view() returns memoryviews
+# of the underlying buffer
+class Reader:
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.offset = 0
+        self.end = len(self.view)
+
+    def __advance(self, n):
+        start = self.offset
+        if start + n > self.end:
+            raise SerializationError("Unexpected end of data")
+
+        self.offset = start + n
+        return start
+
+    def at_end(self):
+        return self.offset >= self.end
+
+    def read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.view[self.__advance(1)]
+            if byte < 0x80:
+                return value | (byte << shift)
+            value |= (byte & 0x7f) << shift
+            shift += 7
+
+    def read_view(self, n):
+        start = self.__advance(n)
+        return self.view[start:start + n]
+
+    def read_fixed(self, n):
+        start = self.__advance(n)
+        return self.view[start:start + n].tobytes()
+
+    def read_bytes(self):
+        return self.read_fixed(self.read_varint())
+
+    def read_optional_bytes(self):
+        n = self.read_varint()
+        if n == 0:
+            return None
+        return self.read_fixed(n - 1)
+
+    def read_fixed_array(self, size):
+        data = self.read_fixed(self.read_varint() * size)
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def read_str(self):
+        n = self.read_varint()
+        start = self.__advance(n)
+        return str(self.view[start:start + n], 'utf-8')
+
+    def read_object(self):
+        type_id, schema_version = self.read_view(2)
+        length = self.read_varint()
+
+        cls = Serializable.types.get(type_id)
+        if cls is None:
+            raise SerializationError("Unknown object type: %d" % type_id)
+
+        # Decode body with a reader limited to it
+        body = Reader(self.read_view(length))
+        return cls.decode(body, schema_version)
+
+
+# Unpickler for objects written by older versions. Only serializable classes
+# (and types they contained) can be loaded, so data from other nodes cannot
+# construct arbitrary objects.
+class LegacyUnpickler(pickle.Unpickler):
+    ALLOWED_GLOBALS = {("uuid", "UUID"), ("uuid", "SafeUUID")}
+
+    def find_class(self, module, name):
+        cls = Serializable.types_by_name.get((module, name))
+        if cls is not None:
+            return cls
+        if (module, name) in LegacyUnpickler.ALLOWED_GLOBALS:
+            return super().find_class(module, name)
+
+        raise pickle.UnpicklingError("Forbidden global in legacy data: %s.%s" % (module, name))
+
+
+# Base of classes with binary representation. Subclasses define TYPE_ID (unique
+# among all serializable classes), SCHEMA_VERSION, encode(writer) and
+# decode(reader, schema_version) classmethod.
 class Serializable:
+    # type id -> class, (module, class name) -> class
+    types = {}
+    types_by_name = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        if cls.TYPE_ID in Serializable.types:
+            raise SerializationError("Duplicate type id %d: %s" % (cls.TYPE_ID, cls.__name__))
+
+        Serializable.types[cls.TYPE_ID] = cls
+        Serializable.types_by_name[(cls.__module__, cls.__name__)] = cls
+
     def to_bytes(self):
-        buffer = io.BytesIO()
-        pickle.dump(self, buffer)
+        writer = Writer()
+        writer.write_object(self)
+
+        return writer.getvalue()
+
+    # Decoded objects may reference buffer (e.g. FilePatch.delta), it must not
+    # be modified while they are in use.
+    #
+    # Pickles are rejected, data received from other nodes is always decoded here
+    # (see from_stored_bytes).
+    @classmethod
+    def from_bytes(cls, buffer):
+        return cls.__decode(memoryview(buffer), False)
+
+    # Like from_bytes, but also reads pickles. Only for metadata stored by this
+    # node (possibly by an older version).
+    @classmethod
+    def from_stored_bytes(cls, buffer):
+        return cls.__decode(memoryview(buffer), True)
+
+    @classmethod
+    def __decode(cls, view, legacy):
+        if len(view) > 0 and view[0] == PICKLE_PROTOCOL_MARKER:
+            if not legacy:
+                raise SerializationError("Pickled %s accepted only from stored metadata" % cls.__name__)
+            obj = LegacyUnpickler(io.BytesIO(view)).load()
+        else:
+            obj = Reader(view).read_object()
 
-        return buffer.getbuffer()
+        if not isinstance(obj, cls):
+            raise SerializationError("Expected %s, got %s" % (cls.__name__, type(obj).__name__))
 
-    @staticmethod
-    def from_bytes(buffer):
-        data = pickle.loads(buffer)
-        return data
+        return obj
@@ -0,0 +1,361 @@
+import sqlite3
+import threading
+import uuid
+import logging
+import contextlib
+
+# Waiting patches (received before the patches they depend on) take at most this many bytes
+DEFAULT_MAX_WAITING_BYTES = 256 * 1024 * 1024
+
+
+# SQLite database in WAL mode. Every thread uses its own connection. Operations can be
+# grouped in a transaction (transactions can be nested, only the outermost one commits).
+# Reads outside of a transaction do not take the write lock.
+#
+# schema is a list of statements executed when the database is opened.
+class Database:
+    def __init__(self, path, schema):
+        self.path = path
+        self.local = threading.local()
+
+        with self.transaction() as db:
+            for statement in schema:
+                db.execute(statement)
+
+            self.upgrade(db)
+
+    # Called when the database is opened, for changes of schema which cannot be
+    # expressed by "IF NOT EXISTS" statements
+    def upgrade(self, db):
+        pass
+
+    # Calls callback when the current transaction commits (it is not called if the
+    # transaction is rolled back)
+    def after_commit(self, callback):
+        if self.local.depth == 0:
+            callback()
+        else:
+            self.local.committed_callbacks.append(callback)
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+
+            self.local.connection = connection
+            self.local.depth = 0
+
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self.connection()
+        if self.local.depth > 0:
+            self.local.depth += 1
+            try:
+                yield db
+            finally:
+                self.local.depth -= 1
+            return
+
+        db.execute("BEGIN IMMEDIATE")
+        self.local.depth = 1
+        self.local.committed_callbacks = []
+        try:
+            yield db
+        except:
+            db.execute("ROLLBACK")
+            raise
+        else:
+            db.execute("COMMIT")
+        finally:
+            self.local.depth = 0
+
+        for callback in self.local.committed_callbacks:
+            callback()
+
+
+# Embedded database holding all synchronization metadata:
+#  * files - version history snapshot, number of journal records, head (length and chain
+#    digest of the last commit), digest of the content at the head and conflict flag
+#    of every file
+#  * journal - changes of version histories made since the last snapshot
+#  * waiting_patches - patches which cannot be applied yet, with chain digests of their
+#    parents (see FileVersionControl.apply_patch). Their total size is at most
+#    max_waiting_bytes, the oldest ones are dropped first.
+#  * bases - compressed contents of the most recent versions of small files (common
+#    versions of concurrent changes are needed to merge them or split them correctly)
+#  * merges - the last merge of concurrent changes of every file (see
+#    FileVersionControl.__merge)
+#  * variants - files a conflicted file was split into (see FileVersionControl.apply_patch),
+#    their heads are in files
+#  * unresolved_patches - heads and parents of conflicting patches whose remote version
+#    could not be recreated (see FileVersionControl.__resolve_conflict), they are
+#    requested again by anti-entropy
+#  * properties - store-wide values (e.g. migration markers, id of this node)
+class MetadataStore(Database):
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, history BLOB, "
+        "journal_n INTEGER NOT NULL DEFAULT 0, conflicted INTEGER NOT NULL DEFAULT 0, "
+        "length INTEGER, head BLOB, content_hash BLOB)",
+        "CREATE TABLE IF NOT EXISTS journal (path TEXT NOT NULL, seq INTEGER NOT NULL, "
+        "record BLOB NOT NULL, PRIMARY KEY (path, seq))",
+        "CREATE TABLE IF NOT EXISTS waiting_patches (path TEXT NOT NULL, chain BLOB NOT NULL, "
+        "patch BLOB NOT NULL, parent BLOB NOT NULL, PRIMARY KEY (path, chain))",
+        "CREATE INDEX IF NOT EXISTS waiting_patches_parent ON waiting_patches (path, parent)",
+        "CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value)",
+        "CREATE TABLE IF NOT EXISTS bases (path TEXT NOT NULL, chain BLOB NOT NULL, content BLOB NOT NULL, "
+        "PRIMARY KEY (path, chain))",
+        "CREATE TABLE IF NOT EXISTS merges (path TEXT PRIMARY KEY, head BLOB NOT NULL, parent_length INTEGER NOT NULL, "
+        "parent_chain BLOB NOT NULL, first_head BLOB NOT NULL, first_n INTEGER NOT NULL, "
+        "second_head BLOB NOT NULL, second_n INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS variants (path TEXT NOT NULL, variant TEXT NOT NULL, PRIMARY KEY (path, variant))",
+        "CREATE TABLE IF NOT EXISTS unresolved_patches (path TEXT NOT NULL, head BLOB NOT NULL, "
+        "parent_length INTEGER NOT NULL, parent_chain BLOB NOT NULL, PRIMARY KEY (path, head))",
+    ]
+
+    def __init__(self, path, max_waiting_bytes=DEFAULT_MAX_WAITING_BYTES):
+        # Called with (path, length, head) after head of a file changes
+        self.head_observers = []
+
+        super().__init__(path, MetadataStore.SCHEMA)
+
+        self.max_waiting_bytes = max_waiting_bytes
+        self.waiting_lock = threading.Lock()
+        self.waiting_bytes = self.__waiting_size(self.connection())
+
+        # Identifies this node, generated when the store is created
+        self.node_id = uuid.UUID(bytes=self.get_property("node_id"))
+
+    def upgrade(self, db):
+        db.execute("INSERT OR IGNORE INTO properties (name, value) VALUES ('node_id', ?)", (uuid.uuid4().bytes,))
+
+    def __head_changed(self, path, length, head):
+        for observer in self.head_observers:
+            self.after_commit(lambda observer=observer: observer(path, length, head))
+
+    # Returns (history snapshot, list of journal records, conflicted flag) of a file.
+    # Snapshot is None if file has no history.
+    def load_file(self, path):
+        db = self.connection()
+        row = db.execute("SELECT history, journal_n, conflicted FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None, [], False
+
+        history, journal_n, conflicted = row
+
+        records = []
+        if journal_n > 0:
+            records = [record for record, in db.execute("SELECT record FROM journal WHERE path = ? ORDER BY seq", (path,))]
+
+        return history, records, bool(conflicted)
+
+    # Replaces history snapshot and drops its journal. length and head describe
+    # the history (with all journal records applied).
+    def save_history(self, path, history, length, head):
+        with self.transaction() as db:
+            db.execute("INSERT INTO files (path, history, length, head) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT (path) DO UPDATE SET history = excluded.history, journal_n = 0, "
+                       "length = excluded.length, head = excluded.head", (path, history, length, head))
+            db.execute("DELETE FROM journal WHERE path = ?", (path,))
+
+            self.__head_changed(path, length, head)
+
+    def append_history_record(self, path, seq, record, length, head):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO journal (path, seq, record) VALUES (?, ?, ?)", (path, seq, record))
+            db.execute("UPDATE files SET journal_n = ?, length = ?, head = ? WHERE path = ?", (seq + 1, length, head, path))
+
+            self.__head_changed(path, length, head)
+
+    def copy_history(self, source, destination):
+        with self.transaction() as db:
+            db.execute("INSERT INTO files (path, history, journal_n, length, head) "
+                       "SELECT ?, history, journal_n, length, head FROM files WHERE path = ? "
+                       "ON CONFLICT (path) DO UPDATE SET history = excluded.history, journal_n = excluded.journal_n, "
+                       "length = excluded.length, head = excluded.head, content_hash = NULL",
+                       (destination, source))
+            db.execute("DELETE FROM journal WHERE path = ?", (destination,))
+            db.execute("INSERT INTO journal (path, seq, record) SELECT ?, seq, record FROM journal WHERE path = ?",
+                       (destination, source))
+
+            row = db.execute("SELECT length, head FROM files WHERE path = ?", (destination,)).fetchone()
+            if row is not None and row[1] is not None:
+                self.__head_changed(destination, row[0], row[1])
+
+    def content_hash(self, path):
+        row = self.connection().execute("SELECT content_hash FROM files WHERE path = ?", (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_content_hash(self, path, content_hash):
+        with self.transaction() as db:
+            db.execute("UPDATE files SET content_hash = ? WHERE path = ?", (content_hash, path))
+
+    # Yields (path, length, head) of all files with history
+    def heads(self):
+        yield from self.connection().execute("SELECT path, length, head FROM files WHERE head IS NOT NULL")
+
+    def set_conflicted(self, path):
+        with self.transaction() as db:
+            db.execute("INSERT INTO files (path, conflicted) VALUES (?, 1) "
+                       "ON CONFLICT (path) DO UPDATE SET conflicted = 1", (path,))
+
+    def is_conflicted(self, path):
+        db = self.connection()
+        row = db.execute("SELECT conflicted FROM files WHERE path = ?", (path,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def conflicted_paths(self):
+        db = self.connection()
+        return [path for path, in db.execute("SELECT path FROM files WHERE conflicted = 1")]
+
+    # Saves content of a file's version identified by its chain digest, keeps only
+    # retention most recent versions of the file
+    def save_base(self, path, chain, content, retention):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO bases (path, chain, content) VALUES (?, ?, ?)", (path, chain, content))
+            db.execute("DELETE FROM bases WHERE path = ? AND rowid NOT IN "
+                       "(SELECT rowid FROM bases WHERE path = ? ORDER BY rowid DESC LIMIT ?)", (path, path, retention))
+
+    def load_base(self, path, chain):
+        db = self.connection()
+        row = db.execute("SELECT content FROM bases WHERE path = ? AND chain = ?", (path, chain)).fetchone()
+        return None if row is None else row[0]
+
+    # Records merge of two branches (identified by their heads and numbers of commits)
+    # following the version at parent_length, which created version head
+    def save_merge(self, path, head, parent_length, parent_chain, first_head, first_n, second_head, second_n):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO merges (path, head, parent_length, parent_chain, first_head, first_n, "
+                       "second_head, second_n) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (path, head, parent_length, parent_chain, first_head, first_n, second_head, second_n))
+
+    # Returns (parent_length, parent_chain, first_head, first_n, second_head, second_n) of
+    # the last merge of a file if it created version head, otherwise None
+    def load_merge(self, path, head):
+        db = self.connection()
+        return db.execute("SELECT parent_length, parent_chain, first_head, first_n, second_head, second_n FROM merges "
+                          "WHERE path = ? AND head = ?", (path, head)).fetchone()
+
+    # Returns (head, parent_length, parent_chain, first_head, first_n, second_head, second_n)
+    # of the last merge of a file or None
+    def last_merge(self, path):
+        db = self.connection()
+        return db.execute("SELECT head, parent_length, parent_chain, first_head, first_n, second_head, second_n "
+                          "FROM merges WHERE path = ?", (path,)).fetchone()
+
+    # Records that variants of a conflicted file were created. replaced is a variant
+    # which was split itself (it is replaced by the new ones).
+    def add_variants(self, path, variants, replaced=None):
+        with self.transaction() as db:
+            if replaced is not None:
+                db.execute("DELETE FROM variants WHERE path = ? AND variant = ?", (path, replaced))
+
+            db.executemany("INSERT OR IGNORE INTO variants (path, variant) VALUES (?, ?)",
+                           [(path, variant) for variant in variants])
+
+    # Variants of a conflicted file, the oldest first
+    def variants(self, path):
+        db = self.connection()
+        return [variant for variant, in db.execute("SELECT variant FROM variants WHERE path = ? ORDER BY rowid", (path,))]
+
+    # Returns variant of a conflicted file whose head is one of heads (the earlier
+    # in heads, the better) or None
+    def variant_with_head(self, path, heads):
+        db = self.connection()
+        found = dict(db.execute("SELECT files.head, variants.variant FROM variants JOIN files ON files.path = variants.variant "
+                                "WHERE variants.path = ? AND files.head IN (%s)" % ", ".join("?" * len(heads)),
+                                [path] + list(heads)))
+
+        for head in heads:
+            if head in found:
+                return found[head]
+
+        return None
+
+    # Yields (path, variant) of all conflicted files
+    def all_variants(self):
+        yield from self.connection().execute("SELECT path, variant FROM variants").fetchall()
+
+    def save_unresolved_patch(self, path, head, parent_length, parent_chain):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO unresolved_patches (path, head, parent_length, parent_chain) "
+                       "VALUES (?, ?, ?, ?)", (path, head, parent_length, parent_chain))
+
+    # Returns list of (head, parent_length, parent_chain) of unresolved patches of a file, the oldest first
+    def unresolved_patches(self, path):
+        db = self.connection()
+        return db.execute("SELECT head, parent_length, parent_chain FROM unresolved_patches WHERE path = ? "
+                          "ORDER BY rowid", (path,)).fetchall()
+
+    def remove_unresolved_patches(self, path, heads):
+        with self.transaction() as db:
+            db.executemany("DELETE FROM unresolved_patches WHERE path = ? AND head = ?", [(path, head) for head in heads])
+
+    def __waiting_size(self, db):
+        return db.execute("SELECT COALESCE(SUM(LENGTH(patch)), 0) FROM waiting_patches").fetchone()[0]
+
+    def __waiting_patch_size(self, db, path, chain):
+        row = db.execute("SELECT LENGTH(patch) FROM waiting_patches WHERE path = ? AND chain = ?", (path, chain)).fetchone()
+        return 0 if row is None else row[0]
+
+    # Saves patch identified by chain digest of its head. parent is chain digest of
+    # the patch's parent (patches are edges of a graph of versions).
+    def save_waiting_patch(self, path, chain, parent, patch):
+        with self.transaction() as db:
+            replaced = self.__waiting_patch_size(db, path, chain)
+            db.execute("INSERT OR REPLACE INTO waiting_patches (path, chain, parent, patch) VALUES (?, ?, ?, ?)",
+                       (path, chain, parent, patch))
+
+            with self.waiting_lock:
+                self.waiting_bytes += len(patch) - replaced
+                excess = self.waiting_bytes - self.max_waiting_bytes
+
+            while excess > 0:
+                rowid, dropped_path, size = db.execute("SELECT rowid, path, LENGTH(patch) FROM waiting_patches "
+                                                       "ORDER BY rowid LIMIT 1").fetchone()
+                db.execute("DELETE FROM waiting_patches WHERE rowid = ?", (rowid,))
+                logging.debug("MetadataStore: too many waiting patches, dropped patch of %s" % dropped_path)
+
+                with self.waiting_lock:
+                    self.waiting_bytes -= size
+                excess -= size
+
+    def load_waiting_patch(self, path, chain):
+        db = self.connection()
+        row = db.execute("SELECT patch FROM waiting_patches WHERE path = ? AND chain = ?", (path, chain)).fetchone()
+        return None if row is None else row[0]
+
+    # Chain digests of waiting patches which can be applied on top of the parent, the oldest first
+    def waiting_children(self, path, parent):
+        db = self.connection()
+        return [chain for chain, in db.execute("SELECT chain FROM waiting_patches WHERE path = ? AND parent = ? "
+                                               "ORDER BY rowid", (path, parent))]
+
+    # Returns list of (chain, parent) of all waiting patches of a file
+    def waiting_patches(self, path):
+        db = self.connection()
+        return db.execute("SELECT chain, parent FROM waiting_patches WHERE path = ? ORDER BY rowid", (path,)).fetchall()
+
+    def paths_with_waiting_patches(self):
+        db = self.connection()
+        return [path for path, in db.execute("SELECT DISTINCT path FROM waiting_patches")]
+
+    def remove_waiting_patch(self, path, chain):
+        with self.transaction() as db:
+            removed = self.__waiting_patch_size(db, path, chain)
+            db.execute("DELETE FROM waiting_patches WHERE path = ? AND chain = ?", (path, chain))
+
+            with self.waiting_lock:
+                self.waiting_bytes -= removed
+
+    def get_property(self, name, default=None):
+        db = self.connection()
+        row = db.execute("SELECT value FROM properties WHERE name = ?", (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_property(self, name, value):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO properties (name, value) VALUES (?, ?)", (name, value))
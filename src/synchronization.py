@@ -6,38 +6,163 @@ import utils
 import vcs
 import communication
 import monitor
+import workers
+import compression
+import antientropy
+import neighbors
+from serialization import Serializable
+
+# Capabilities announced to other nodes
+CAPABILITIES = neighbors.CAPABILITY_CUSTODY | neighbors.CAPABILITY_COMPRESSION | neighbors.CAPABILITY_ANTI_ENTROPY
 
 # Class which monitores changes to local files and sends updates to other DTN nodes.
+#
+# Commits and patch applications run in a worker pool so neither the inotify watcher
+# nor the network listener ever waits for delta computation.
+#
+# Nodes which missed some patches catch up using anti-entropy (see antientropy.AntiEntropy).
 class SyncWorker:
-    def __init__(self, directory, port):
-        self.comm = communication.Communicator(port, self.on_data_received)
+    def __init__(self, directory, port, workers_n=4, quiet_period=0.1, max_latency=1.0, compression_mode="auto",
+                 anti_entropy_interval=antientropy.DEFAULT_INTERVAL,
+                 broadcast_address=communication.DEFAULT_BROADCAST_ADDRESS,
+                 history_cache_bytes=vcs.DEFAULT_HISTORY_CACHE_BYTES, merge_max_bytes=vcs.DEFAULT_MERGE_MAX_BYTES,
+                 max_rate=communication.DEFAULT_MAX_RATE):
         self.directory = directory
-        self.vcs = vcs.VCS(directory)
-        self.monitor = monitor.Monitor(self.directory, self)
+        self.vcs = vcs.VCS(directory, history_cache_bytes, merge_max_bytes)
+        self.compressor = compression.AdaptiveCompressor.create(compression_mode)
+        self.workers = workers.WorkerPool(workers_n)
+
+        # Received patches waiting for a worker, by path. Patches for the same file which
+        # arrive before the worker gets to them (e.g. queued bundles forwarded after
+        # reconnecting) are applied together.
+        self.incoming = {}
+        self.incoming_lock = threading.Lock()
+
+        # Number of file updates which did not change the file's content
+        self.suppressed_commits_n = 0
+        self.suppressed_lock = threading.Lock()
+        self.comm = communication.Communicator(port, self.on_data_received,
+                                               os.path.join(self.vcs.metapath, "bundles.db"),
+                                               on_control_callback=self.on_control_received,
+                                               broadcast_address=broadcast_address,
+                                               node_id=self.vcs.store.node_id.bytes,
+                                               capabilities=CAPABILITIES,
+                                               summary=self.vcs.digest.root,
+                                               max_rate=max_rate)
+        self.anti_entropy = antientropy.AntiEntropy(self.vcs, self.comm, self.workers, self.send_patch,
+                                                    anti_entropy_interval)
+        self.monitor = monitor.Monitor(self.directory, self, quiet_period, max_latency,
+                                       excluded=[self.vcs.metapath])
+
+        for patch in self.vcs.merge_patches:
+            self.__send(patch)
 
         logging.info("Started")
 
+    # Called from the listen thread, buffer is valid only until return
     def on_data_received(self, buffer):
         try:
-            patch = vcs.FilePatch.from_bytes(buffer)
+            # Patch references data it was decoded from (delta is not copied), so the
+            # message is copied once out of the receive buffer
+            patch = vcs.FilePatch.from_bytes(bytes(buffer))
 
-            logging.info("Received: " + patch.file_basename)
-            
-            with self.vcs.file_version_control(patch.file_basename) as file_vcs:
-                file_vcs.apply_patch(patch)
+            logging.info("Received: " + patch.relative_path)
+
+            self.__enqueue_patch(patch)
         except Exception:
             logging.exception("on_data_received")
 
-    def file_updated(self, pathname):
+    # Called from the listen thread, buffer is valid only until return
+    def on_control_received(self, buffer, address):
         try:
-            logging.info("File updated: " + pathname)
+            message = Serializable.from_bytes(bytes(buffer))
+
+            # Patches requested by anti-entropy are sent directly
+            if isinstance(message, vcs.FilePatch):
+                logging.info("Received requested patch: " + message.relative_path)
+                self.__enqueue_patch(message)
+            else:
+                self.anti_entropy.handle(message, address)
+        except Exception:
+            logging.exception("on_control_received")
+
+    # Deltas are compressed only for nodes which announced they can decompress them
+    # (address is None for all neighbors). Bundles forwarded later to other nodes are
+    # written so that nodes without compression reject them (see vcs.CompressedFilePatch).
+    def __compress(self, patch, address=None):
+        if self.comm.neighbors.capable(neighbors.CAPABILITY_COMPRESSION, address):
+            patch.compression, patch.delta = self.compressor.compress(patch.relative_path, patch.delta)
+
+    # Sends patch directly to one node (not queued for other nodes)
+    def send_patch(self, patch, address):
+        self.__compress(patch, address)
+        self.comm.send_control(patch.to_bytes(), address)
+
+    # Schedules patch to be applied, a worker is started only for the first pending patch of a file
+    def __enqueue_patch(self, patch):
+        with self.incoming_lock:
+            pending = self.incoming.get(patch.relative_path)
+            if pending is not None:
+                pending.append(patch)
+                return
 
-            basename = os.path.basename(pathname)
+            self.incoming[patch.relative_path] = [patch]
+
+        self.workers.submit(patch.relative_path, self.apply_patches, patch.relative_path)
+
+    def apply_patches(self, relative_path):
+        try:
+            with self.incoming_lock:
+                patches = self.incoming.pop(relative_path)
 
+            for patch in patches:
+                patch.delta = self.compressor.decompress(patch.relative_path, patch.compression, patch.delta)
+                patch.compression = compression.NONE
+
+            with self.vcs.file_version_control(relative_path) as file_vcs:
+                file_vcs.apply_patches(patches)
+
+            # Later commits follow merges, so other nodes need them
+            for patch in file_vcs.merge_patches:
+                self.__send(patch)
+        except Exception:
+            logging.exception("apply_patches")
+
+    def file_updated(self, pathname):
+        logging.info("File updated: " + pathname)
+
+        relative_path = os.path.relpath(pathname, self.directory)
+        self.workers.submit(relative_path, self.commit, relative_path)
+
+    def commit(self, relative_path):
+        try:
             # Update revision and time and save
-            with self.vcs.file_version_control(basename) as file_vcs:
+            with self.vcs.file_version_control(relative_path) as file_vcs:
                 patch = file_vcs.commit()
-                self.comm.send(patch.to_bytes())
+
+            if patch is None:
+                logging.debug("Content not changed: " + relative_path)
+                with self.suppressed_lock:
+                    self.suppressed_commits_n += 1
+                return
+
+            self.__send(patch)
         except Exception:
             logging.exception("file_updated")
-    
\ No newline at end of file
+
+    # Sends patch to all nodes (file is not locked during compression)
+    def __send(self, patch):
+        self.__compress(patch)
+        # Bundle carrying the patch is identified by its head commit
+        self.comm.send(patch.to_bytes(), patch.commits[-1].id.bytes)
+
+    # Stops watching and receiving, waits until queued commits and patches are handled
+    def stop(self):
+        self.monitor.stop()
+        self.anti_entropy.stop()
+        self.comm.stop()
+        self.workers.stop()
+
+        logging.info("History cache: %s" % self.vcs.histories.stats())
+        logging.info("Suppressed commits: %d" % self.suppressed_commits_n)
+        logging.info("Stopped")
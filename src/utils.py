@@ -2,6 +2,7 @@ import random
 import string
 import subprocess
 import os
+import hashing
 
 def generate_random_name(length = 8):
     letters = string.ascii_letters + string.digits
@@ -22,14 +23,12 @@ def run_command(command, input=None, env_vars = []):
         name, value = env
         os.environ[name] = value
 
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL)
 
-    if input is not None:
-        process.stdin.write(input)
-
-    std, stderr = process.communicate()
-
-    process.stdin.close()
+    # Input is written while output is read - writing all of it first would block once
+    # the process fills its output pipe
+    std, stderr = process.communicate(input)
 
     for env in env_vars:
         name, value = env
@@ -40,11 +39,6 @@ def run_command(command, input=None, env_vars = []):
 
     return std
 
+# Hex SHA-1 of file content (as printed by sha1sum)
 def get_file_checksum(file):
-    output = run_command(["sha1sum", "-b", file])
-
-    # Remove file-name from the output
-    return output[0:40]
-
-def get_node_name():
-    return run_command(["hostname"]).decode('utf-8').strip()
+    return hashing.file_digest(file, "sha1").hex().encode()
@@ -4,47 +4,630 @@ import errno
 import threading
 import time
 import utils
+import rdiff
 import uuid
-import shutil
+import hashlib
 import logging
+import re
+import collections
+import store
+import hashing
+import compression
+import digest
+import merge
+import zlib
 
 from enum import Enum
 from serialization import Serializable
 
 RDIFF_EMPTY_SIGNATURE = b'rs\x016\x00\x00\x08\x00\x00\x00\x00\x08'
 
+# Number of the most recent signatures kept in VersionHistory. Only the last one is needed
+# to compute delta for the next commit, older ones are used when history is truncated
+# to the commits common with a conflicting remote history.
+SIGNATURES_RETENTION = 16
+
+# Number of the most recent commits kept in VersionHistory. Older commits are represented
+# only by the chain digest of the oldest retained commit.
+COMMITS_RETENTION = 1024
+
+# History is stored as a snapshot followed by a journal of changes. When the journal has
+# more records than this, it is replaced by a single snapshot.
+JOURNAL_COMPACTION_THRESHOLD = 64
+
+# Chain digest of an empty history
+EMPTY_CHAIN = bytes(16)
+
+# Memory used by loaded version histories kept by HistoryCache
+DEFAULT_HISTORY_CACHE_BYTES = 64 * 1024 * 1024
+
+# Estimated memory used by a single commit (object, id, author, chain digest, index entry)
+COMMIT_MEMORY_SIZE = 400
+
+# At most this many sequential patches are composed and applied at once
+MAX_COMPOSED_PATCHES = 64
+
+# Contents of versions of files up to this size are kept (for merging concurrent changes)
+DEFAULT_MERGE_MAX_BYTES = 16 * 1024 * 1024
+
+# Number of the most recent versions of a file whose contents are kept (a merge keeps
+# four: the branching point, both branches and the result)
+BASES_RETENTION = 16
+
+# Name of the metadata database (in .sync)
+METADATA_STORE_NAME = "metadata.db"
+
+# Waiting patch files written by older versions: <name>.patch<id of the patch's last commit>
+WAITING_PATCH_FILE = re.compile(r"^(.*)\.patch([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$")
+
 def rdiff_empty_signature():
     return RDIFF_EMPTY_SIGNATURE
 
 def rdiff_signature(file):
-    return utils.run_command(["rdiff", "signature", file, "-"])
+    return rdiff.get_backend().signature(file)
 
 def rdiff_delta(signature, file):
-    return utils.run_command(["rdiff", "delta", "-", file], signature)
+    return rdiff.get_backend().delta(signature, file)
 
 def rdiff_delta_apply(file, delta, new_file):
-    return utils.run_command(["rdiff", "patch", file, "-", new_file], delta)
+    return rdiff.get_backend().patch(file, delta, new_file)
+
+# Signature of file which was created by applying delta to a file with the given signature
+def rdiff_update_signature(signature, delta, file):
+    if signature is None:
+        return rdiff_signature(file)
+
+    try:
+        return rdiff.get_backend().update_signature(signature, delta, file)
+    except rdiff.UnsupportedFormat:
+        return rdiff_signature(file)
 
+# author is id (UUID) of the node which created the commit. Names of conflict variants
+# are derived from it (see node_name), so only the fixed-size id is sent.
 class Commit(Serializable):
+    TYPE_ID = 1
+    SCHEMA_VERSION = 1
+
     def __init__(self):
         self.author = None
         self.id = None
 
+    # Commits pickled by older versions have hostnames of their authors
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.author, str):
+            self.author = uuid.uuid5(uuid.NAMESPACE_DNS, self.author)
+
+    def encode(self, writer):
+        writer.write_fixed(self.id.bytes)
+        writer.write_fixed(self.author.bytes)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        commit = cls()
+        commit.id = uuid.UUID(bytes=reader.read_fixed(16))
+        commit.author = uuid.UUID(bytes=reader.read_fixed(16))
+
+        return commit
+
+
+# Name of a node (given by its id) appended to names of its conflict variants
+def node_name(node_id):
+    return node_id.hex
+
+# Namespace of ids of merge commits, they are name-based (derived from heads of the
+# merged branches) while other commits have time-based ids
+MERGE_NAMESPACE = uuid.UUID("6c1a3e0e-5d4b-4f0e-9a53-1f6f1b0d2c77")
+
+def merge_commit_id(first_head, second_head):
+    return uuid.uuid5(MERGE_NAMESPACE, (first_head + second_head).hex())
+
+# Merge commits only combine changes of the commits they follow
+def is_merge(commit):
+    return commit.id.version == 5
+
+
+# Digest of the whole history up to (and including) commit. Two histories with
+# the same chain digest contain exactly the same commits.
+def chain_digest(parent_chain, commit):
+    return hashlib.blake2b(parent_chain + commit.id.bytes, digest_size=len(EMPTY_CHAIN)).digest()
+
 
 # This structrue contains all information about file version (it is stored on-disk)
-# XXX: think about vector clocks https://queue.acm.org/detail.cfm?id=2917756
+#
+# Only the most recent commits are kept. Every commit is identified by its chain digest
+# and its position (number of commits in history up to and including it). Position 0
+# is an empty history (EMPTY_CHAIN).
 class VersionHistory(Serializable):
+    TYPE_ID = 2
+    SCHEMA_VERSION = 1
+
     def __init__(self):
-        self.commits = []
-        self.signatures = [] #XXX: signatures can be prunned sometimes
+        # Total number of commits (including pruned ones)
+        self.length = 0
 
+        # Chain digest of the last pruned commit
+        self.base_chain = EMPTY_CHAIN
 
-# Class representing patch to a file. Holds basename of file, commit info and delta
+        # The most recent commits and their chain digests
+        self.commits = []
+        self.chains = []
+
+        # Signatures of the most recent commits only: signatures[i] is a signature
+        # of file after commit at position signatures_offset + i + 1
+        self.signatures = []
+        self.signatures_offset = 0
+
+        self.__build_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("index", None)
+        state.pop("commit_ids", None)
+        return state
+
+    # Histories pickled by older versions keep all commits and their signatures
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        self.length = len(self.commits)
+        self.base_chain = EMPTY_CHAIN
+        self.signatures_offset = 0
+        self.chains = []
+
+        chain = EMPTY_CHAIN
+        for commit in self.commits:
+            chain = chain_digest(chain, commit)
+            self.chains.append(chain)
+
+        self.__build_index()
+        self.prune()
+
+    # Chain digests are not stored, they are computed from base_chain and commits
+    def encode(self, writer):
+        writer.write_varint(self.length)
+        writer.write_fixed(self.base_chain)
+
+        writer.write_varint(len(self.commits))
+        for commit in self.commits:
+            commit.encode(writer)
+
+        writer.write_varint(self.signatures_offset)
+        writer.write_varint(len(self.signatures))
+        for signature in self.signatures:
+            writer.write_optional_bytes(signature)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        history = cls.__new__(cls)
+        history.length = reader.read_varint()
+        history.base_chain = reader.read_fixed(len(EMPTY_CHAIN))
+
+        history.commits = [Commit.decode(reader, schema_version) for _ in range(reader.read_varint())]
+        history.chains = []
+
+        chain = history.base_chain
+        for commit in history.commits:
+            chain = chain_digest(chain, commit)
+            history.chains.append(chain)
+
+        history.signatures_offset = reader.read_varint()
+        history.signatures = [reader.read_optional_bytes() for _ in range(reader.read_varint())]
+
+        history.__build_index()
+        return history
+
+    # chain digest -> position and ids of all retained commits (with numbers of their
+    # occurrences, merged branches can share commits)
+    def __build_index(self):
+        self.index = {self.base_chain: self.base_length()}
+        for i, chain in enumerate(self.chains):
+            self.index[chain] = self.base_length() + i + 1
+
+        self.commit_ids = collections.Counter(commit.id for commit in self.commits)
+
+    def __forget_commits(self, commits):
+        for commit in commits:
+            self.commit_ids[commit.id] -= 1
+            if self.commit_ids[commit.id] == 0:
+                del self.commit_ids[commit.id]
+
+    def base_length(self):
+        return self.length - len(self.commits)
+
+    def head(self):
+        if len(self.chains) == 0:
+            return self.base_chain
+        return self.chains[-1]
+
+    # Returns position of commit with given chain digest or None if it is unknown
+    def position(self, chain):
+        return self.index.get(chain)
+
+    # Returns True if commit with given id is among retained commits
+    def has_commit(self, commit_id):
+        return commit_id in self.commit_ids
+
+    def last_signature(self):
+        if len(self.signatures) == 0:
+            return None
+        return self.signatures[-1]
+
+    def append(self, commit, signature):
+        chain = chain_digest(self.head(), commit)
+
+        self.commits.append(commit)
+        self.chains.append(chain)
+        self.length += 1
+        self.index[chain] = self.length
+        self.commit_ids[commit.id] += 1
+
+        # Keep signatures contiguous, intermediate commits (applied together with
+        # the following one) have no signature
+        if len(self.signatures) == 0:
+            self.signatures_offset = self.length - 1
+        self.signatures.append(signature)
+
+        self.prune()
+
+    # Keeps only first n commits, n cannot be lower than base_length()
+    def truncate(self, n):
+        if n < self.base_length():
+            raise Exception("Cannot truncate history to pruned commit: %d" % n)
+
+        removed = self.length - n
+        for chain in self.chains[len(self.chains) - removed:]:
+            del self.index[chain]
+        self.__forget_commits(self.commits[len(self.commits) - removed:])
+
+        del self.commits[len(self.commits) - removed:]
+        del self.chains[len(self.chains) - removed:]
+        self.length = n
+
+        del self.signatures[max(0, n - self.signatures_offset):]
+        self.signatures_offset = min(self.signatures_offset, n)
+
+    # Replaces whole history with a history (known only by its head) of given length
+    def rebase(self, length, chain):
+        self.length = length
+        self.base_chain = chain
+        self.commits = []
+        self.chains = []
+        self.signatures = []
+        self.signatures_offset = length
+
+        self.__build_index()
+
+    def prune(self):
+        excess = len(self.signatures) - SIGNATURES_RETENTION
+        if excess > 0:
+            del self.signatures[:excess]
+            self.signatures_offset += excess
+
+        excess = len(self.commits) - COMMITS_RETENTION
+        if excess > 0:
+            del self.index[self.base_chain]
+            for chain in self.chains[:excess - 1]:
+                del self.index[chain]
+            self.__forget_commits(self.commits[:excess])
+
+            self.base_chain = self.chains[excess - 1]
+            del self.commits[:excess]
+            del self.chains[:excess]
+
+    # Estimated number of bytes used by the history in memory
+    def memory_size(self):
+        return len(self.commits) * COMMIT_MEMORY_SIZE + sum(len(signature) for signature in self.signatures
+                                                            if signature is not None)
+
+    def replay(self, record):
+        if record.operation == HistoryRecord.APPEND:
+            self.append(record.commit, record.signature)
+        elif record.operation == HistoryRecord.TRUNCATE:
+            self.truncate(record.commits_n)
+        elif record.operation == HistoryRecord.REBASE:
+            self.rebase(record.commits_n, record.chain)
+        else:
+            raise Exception("Unknown history record: %s" % record.operation)
+
+    # Loads snapshot and replays journal records (as stored in MetadataStore)
+    @staticmethod
+    def load(snapshot, records):
+        history = VersionHistory.from_bytes(snapshot)
+        for record in records:
+            history.replay(HistoryRecord.from_bytes(record))
+
+        return history
+
+
+# Single change of VersionHistory, appended to the history file instead of rewriting it
+class HistoryRecord(Serializable):
+    TYPE_ID = 3
+    SCHEMA_VERSION = 1
+
+    APPEND = 0
+    TRUNCATE = 1
+    REBASE = 2
+
+    def __init__(self, operation, commit=None, signature=None, commits_n=None, chain=None):
+        self.operation = operation
+        self.commit = commit
+        self.signature = signature
+        self.commits_n = commits_n
+        self.chain = chain
+
+    def encode(self, writer):
+        writer.write_varint(self.operation)
+        if self.operation == HistoryRecord.APPEND:
+            self.commit.encode(writer)
+            writer.write_optional_bytes(self.signature)
+        elif self.operation == HistoryRecord.TRUNCATE:
+            writer.write_varint(self.commits_n)
+        else:
+            writer.write_varint(self.commits_n)
+            writer.write_fixed(self.chain)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        operation = reader.read_varint()
+        if operation == HistoryRecord.APPEND:
+            return cls(operation, commit=Commit.decode(reader, schema_version), signature=reader.read_optional_bytes())
+        elif operation == HistoryRecord.TRUNCATE:
+            return cls(operation, commits_n=reader.read_varint())
+        else:
+            return cls(operation, commits_n=reader.read_varint(), chain=reader.read_fixed(len(EMPTY_CHAIN)))
+
+
+# Class representing patch to a file. Holds path of file (relative to synchronized
+# directory), commit info and delta
+#
+# Delta transforms the file at parent (identified by its position and chain digest)
+# to the file after all commits from the patch. Full history is never sent, the
+# receiver finds out from the parent whether it is behind the sender or has diverged.
+#
+# Delta can be compressed (compression is a codec id from compression module), such
+# patches are written as CompressedFilePatch. Decoded delta is a memoryview of the buffer
+# passed to from_bytes (it is not copied).
 class FilePatch(Serializable):
+    TYPE_ID = 4
+    SCHEMA_VERSION = 1
+
     def __init__(self):
-        self.file_basename = None
+        self.relative_path = None
+        self.parent_length = 0
+        self.parent_chain = EMPTY_CHAIN
         self.commits = []
         self.delta = None
+        self.compression = compression.NONE
+
+        # Digest of the file after the patch is applied (see hashing) or None if unknown
+        self.content_hash = None
+
+    # Patches pickled by older versions carry the file's basename and the sender's
+    # whole history, with delta from its previous commit
+    def __setstate__(self, state):
+        self.__init__()
+        self.relative_path = state["file_basename"]
+        self.delta = state["delta"]
+
+        commits = state["commits"]
+        self.parent_length = len(commits) - 1
+        for commit in commits[:-1]:
+            self.parent_chain = chain_digest(self.parent_chain, commit)
+        self.commits = commits[-1:]
+
+    def encode(self, writer):
+        writer.write_str(self.relative_path)
+        writer.write_varint(self.parent_length)
+        writer.write_fixed(self.parent_chain)
+
+        writer.write_varint(len(self.commits))
+        for commit in self.commits:
+            commit.encode(writer)
+
+        writer.write_bytes(self.delta)
+        writer.write_varint(self.compression)
+        writer.write_optional_bytes(self.content_hash)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        patch = cls()
+        patch.relative_path = reader.read_str()
+        patch.parent_length = reader.read_varint()
+        patch.parent_chain = reader.read_fixed(len(EMPTY_CHAIN))
+        patch.commits = [Commit.decode(reader, schema_version) for _ in range(reader.read_varint())]
+        patch.delta = reader.read_view(reader.read_varint())
+        patch.compression = reader.read_varint()
+        patch.content_hash = reader.read_optional_bytes()
+
+        return patch
+
+    def head_length(self):
+        return self.parent_length + len(self.commits)
+
+    def head_chain(self):
+        chain = self.parent_chain
+        for commit in self.commits:
+            chain = chain_digest(chain, commit)
+        return chain
+
+    def to_bytes(self):
+        if self.compression == compression.NONE:
+            return super().to_bytes()
+        return CompressedFilePatch(self).to_bytes()
+
+
+# FilePatch with compressed delta. It has its own type id so that nodes which do not
+# announce CAPABILITY_COMPRESSION (e.g. forwarded bundles reach them later) reject it
+# instead of applying the compressed delta. It is decoded as FilePatch.
+class CompressedFilePatch(Serializable):
+    TYPE_ID = 6
+    SCHEMA_VERSION = FilePatch.SCHEMA_VERSION
+
+    def __init__(self, patch):
+        self.patch = patch
+
+    def encode(self, writer):
+        self.patch.encode(writer)
+
+    @classmethod
+    def decode(cls, reader, schema_version):
+        return FilePatch.decode(reader, schema_version)
+
+
+# Version histories of recently used files, so that they are not loaded from the store
+# (and their journals replayed) every time a file is changed. Estimated memory used by
+# cached histories is at most max_bytes, the least recently used ones are evicted first.
+#
+# FileVersionControl takes its file's entry (and entries of variants it looks at) out
+# of the cache when it is created and puts them back when its context exits without
+# an exception (store is always written immediately, the cache only holds what was
+# loaded or written). Entry which was not put back (e.g. histories changed by conflict
+# resolution or failed operations) is loaded from the store next time. As the entry
+# is taken under the file's lock (variants share it), it is never used by two threads.
+class HistoryCache:
+    def __init__(self, max_bytes=DEFAULT_HISTORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.mutex = threading.Lock()
+
+        # path -> (version history or None if the file is conflicted, journal records, content hash, size)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        self.hits_n = 0
+        self.misses_n = 0
+        self.evictions_n = 0
+
+    # Removes entry of a file and returns (version history, journal records, content hash) or None
+    def take(self, path):
+        with self.mutex:
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                self.misses_n += 1
+                return None
+
+            self.hits_n += 1
+            self.size -= entry[3]
+            return entry[:3]
+
+    def put(self, path, history, journal_records, content_hash):
+        size = len(path) if history is None else len(path) + history.memory_size()
+
+        with self.mutex:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old[3]
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[path] = (history, journal_records, content_hash, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, _, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions_n += 1
+
+    def invalidate(self, path):
+        with self.mutex:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= entry[3]
+
+    def __len__(self):
+        with self.mutex:
+            return len(self.entries)
+
+    def stats(self):
+        with self.mutex:
+            return {"files": len(self.entries), "bytes": self.size, "hits": self.hits_n,
+                    "misses": self.misses_n, "evictions": self.evictions_n}
+
+
+# Table of per-file locks. A lock is created when a file is locked for the first time
+# and evicted as soon as no thread holds it or waits for it. The table holds at most
+# max_locks locks - if it is full, threads locking other files wait for an eviction.
+#
+# Conflict variants of a file (created by __resolve_conflict) are aliases of the
+# original file and share its lock.
+class LockTable:
+    def __init__(self, max_locks=1024):
+        self.max_locks = max_locks
+        self.mutex = threading.Lock()
+        self.evicted = threading.Condition(self.mutex)
+
+        # key -> [lock, number of threads holding or waiting for the lock]
+        self.locks = {}
+
+        # file (path relative to synchronized directory) -> key
+        self.aliases = {}
+
+    def __key(self, name):
+        return self.aliases.get(name, name)
+
+    def __register(self, name):
+        with self.mutex:
+            key = self.__key(name)
+            while key not in self.locks and len(self.locks) >= self.max_locks:
+                self.evicted.wait()
+                key = self.__key(name)
+
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+            return key, entry[0]
+
+    # Locks file, returns key of the lock which has to be passed to release()
+    def acquire(self, name):
+        while True:
+            key, lock = self.__register(name)
+            lock.acquire()
+
+            # File could have become an alias while we were waiting
+            with self.mutex:
+                if self.__key(name) == key:
+                    return key
+
+            self.release(key)
+
+    def release(self, key):
+        with self.mutex:
+            entry = self.locks[key]
+            entry[0].release()
+            entry[1] -= 1
+
+            if entry[1] == 0:
+                del self.locks[key]
+                self.evicted.notify()
+
+    def alias(self, name, key):
+        with self.mutex:
+            if name != key:
+                self.aliases[name] = key
+
+    def __len__(self):
+        with self.mutex:
+            return len(self.locks)
+
+
+# Lock of a single file (taken from LockTable)
+class FileLock:
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+        self.key = None
+
+    def acquire(self):
+        self.key = self.table.acquire(self.name)
+
+    def release(self):
+        self.table.release(self.key)
+        self.key = None
+
+    # Makes other file share this lock
+    def alias(self, name):
+        self.table.alias(name, self.key)
 
 
 class SynchronizationType(Enum):
@@ -55,34 +638,88 @@ class SynchronizationType(Enum):
 
 
 # This structure is used to control version of a file
+#
+# lock is a FileLock already held by the creator (see VCS.file_version_control), it is
+# released when the object is used as a context manager and the context exits.
+#
+# Version history, waiting patches and conflict flag are kept in store (MetadataStore)
+# under the path relative to the synchronized directory. Loaded histories are kept in
+# cache (HistoryCache) if it is given.
+#
+# Contents of versions of files up to merge_max_bytes are kept, so concurrent changes
+# of such files are merged (see merge.merge) instead of splitting the file into variants
+# (0 disables merging).
 class FileVersionControl:
-    def __init__(self, file_path, metapath, lock):
+    def __init__(self, file_path, metapath, lock, store, cache=None, merge_max_bytes=0):
         self.lock = lock
+        self.store = store
+        self.cache = cache
+        self.merge_max_bytes = merge_max_bytes
         self.file_path = file_path
         self.metapath = metapath
+        self.relative_path = os.path.relpath(file_path, os.path.dirname(metapath))
+
+        # Conflicted file this one is a variant of (or the file itself)
+        self.logical_path = self.relative_path
+
+        # Variants of this (conflicted) file created by __variant, their cache entries are
+        # put back when this object's context exits
+        self.variants = []
+
+        # Patches with merges of concurrent changes made by apply_patches (see __merge),
+        # they are sent to other nodes. Variants add their merges here too.
+        self.merge_patches = []
+
+        # Temporary files are created in .sync under the same relative directory as the file
+        self.metadir = os.path.join(metapath, os.path.dirname(self.relative_path))
+
+        cached = self.cache.take(self.relative_path) if self.cache is not None else None
+        if cached is not None:
+            history, self.journal_records, self.content_hash = cached
+            self.conflicted = history is None
+        else:
+            snapshot, records, self.conflicted = self.store.load_file(self.relative_path)
+            self.content_hash = self.store.content_hash(self.relative_path)
 
         # If conflicted path is set this means that now there are per-node files
         # XXX: we can have node name in filename from the beggining (just keep on link per
         # file without nodename)
-        if os.path.exists(self.__conflict_flag_path()):
+        if self.conflicted:
             # In this case, we do not know which file to update - decision is made in apply_patch
             return
 
-        self.patched_file_path = os.path.join(metapath, os.path.basename(self.file_path) + ".new")
-        self.version_history_file_path = os.path.join(metapath, os.path.basename(self.file_path) + ".version")
+        self.patched_file_path = self.__metadata_path(".new")
 
         self.__init_file()
-        self.__init_version()
+        if cached is not None:
+            self.version_history = history
+        else:
+            self.__init_version(snapshot, records)
 
     def __exit__(self, exception_type, exception_value, traceback):
+        # History may differ from the stored one if the operation failed
+        if self.cache is not None and exception_type is None:
+            self.__put_in_cache()
+
         self.lock.release()
 
+    def __put_in_cache(self):
+        if self.conflicted:
+            self.cache.put(self.relative_path, None, None, None)
+        else:
+            self.cache.put(self.relative_path, self.version_history, self.journal_records, self.content_hash)
+
+        for variant in self.variants:
+            variant.__put_in_cache()
+
     def __enter__(self):
-        self.lock.acquire()
         return self
 
-    def __conflict_flag_path(self):
-        return os.path.join(self.metapath, os.path.basename(self.file_path) + ".conflicted")
+    def __metadata_path(self, suffix):
+        return os.path.join(self.metadir, os.path.basename(self.file_path) + suffix)
+
+    def __make_metadir(self):
+        os.makedirs(self.metadir, exist_ok=True)
 
     def __init_file(self):
         # Create file if not exists
@@ -93,59 +730,163 @@ class FileVersionControl:
             open(tmp, 'w').close()
             os.rename(tmp, self.file_path)
 
-    def __init_version(self):
-        # Load version from file or create empty version if file does not exist
-        if not os.path.exists(self.version_history_file_path):
+    # journal_records is None if there is no stored snapshot yet
+    def __init_version(self, snapshot, records):
+        # Load version from store or create empty version if there is none
+        if snapshot is None:
             self.version_history = VersionHistory()
+            self.journal_records = None
         else:
-            with open(self.version_history_file_path, 'rb') as f:
-                content = f.read()
-                self.version_history = VersionHistory.from_bytes(content)
+            self.version_history = VersionHistory.load(snapshot, records)
+            self.journal_records = len(records)
 
-    # Saves version to file
+    # Replaces stored snapshot (and journal) with the whole version
     def __flush_version(self):
-        with open(self.version_history_file_path, 'wb') as f:
-            f.write(self.version_history.to_bytes())
+        self.store.save_history(self.relative_path, self.version_history.to_bytes(),
+                                self.version_history.length, self.version_history.head())
+        self.journal_records = 0
+
+    # Appends change to the journal. Cost of this operation does not depend
+    # on history length (apart from periodic compaction)
+    def __journal_version(self, record):
+        if self.journal_records is None or self.journal_records >= JOURNAL_COMPACTION_THRESHOLD:
+            self.__flush_version()
+            return
+
+        self.store.append_history_record(self.relative_path, self.journal_records, record.to_bytes(),
+                                         self.version_history.length, self.version_history.head())
+        self.journal_records += 1
+
+    # Digest of the file's content at the head (see hashing) or None if it is unknown
+    def __set_content_hash(self, content_hash):
+        self.store.set_content_hash(self.relative_path, content_hash)
+        self.content_hash = content_hash
+
+    def __append_commit(self, commit, signature):
+        self.version_history.append(commit, signature)
+        self.__journal_version(HistoryRecord(HistoryRecord.APPEND, commit=commit, signature=signature))
+
+    def __truncate_history(self, commits_n):
+        self.version_history.truncate(commits_n)
+        self.__journal_version(HistoryRecord(HistoryRecord.TRUNCATE, commits_n=commits_n))
+
+    def __rebase_history(self, commits_n, chain):
+        self.version_history.rebase(commits_n, chain)
+        self.__journal_version(HistoryRecord(HistoryRecord.REBASE, commits_n=commits_n, chain=chain))
 
     # Returns diff between current version and version represented by signature file
     def __get_delta(self):
-        signature = None
-        if len(self.version_history.signatures) > 0:
-            signature = self.version_history.signatures[-1]
-        else:
+        signature = self.version_history.last_signature()
+        if signature is None:
             signature = rdiff_empty_signature()
 
         return rdiff_delta(signature, self.file_path)
 
-    def __waiting_patch_location(self, commit_id):
-        return os.path.join(self.metapath, os.path.basename(self.file_path) + ".patch" + str(commit_id))
+    # Keeps content of the file at the head (if its digest is content_hash)
+    def __save_base(self, content_hash):
+        if self.merge_max_bytes <= 0 or content_hash is None or os.path.getsize(self.file_path) > self.merge_max_bytes:
+            return
 
-    def __load_patch(self, commit_id):
-        with open(self.__waiting_patch_location(commit_id), 'rb') as f:
+        with open(self.file_path, 'rb') as f:
             content = f.read()
-            return FilePatch.from_bytes(content)
 
-    def __apply_waiting_patches(self, waiting):
-        for commit in waiting:
-            self.apply_patch(self.__load_patch(commit.id))
+        if hashing.digest(content) == content_hash:
+            self.store.save_base(self.relative_path, self.version_history.head(), zlib.compress(content, 1),
+                                 BASES_RETENTION)
+
+    # Returns content of the file's version identified by chain digest or None if it is not kept
+    def __load_base(self, chain):
+        content = self.store.load_base(self.relative_path, chain)
+        return None if content is None else zlib.decompress(content)
+
+    # Waiting patches are identified by chain digest of their head
+    def __load_patch(self, chain):
+        return FilePatch.from_bytes(self.store.load_waiting_patch(self.relative_path, chain))
+
+    # Applies patches (every one is a child of the previous one, the first one is a child
+    # of the head) followed by waiting patches which continue them, so the file is
+    # rewritten and its signature is updated once for all of them. waiting_chains
+    # identify patches which were waiting (None for others). Returns False if there
+    # was nothing to apply.
+    def __fast_forward_chain(self, patches, waiting_chains):
+        patches, waiting_chains = list(patches), list(waiting_chains)
+
+        head = patches[-1].head_chain() if patches else self.version_history.head()
+        while len(patches) < MAX_COMPOSED_PATCHES:
+            children = self.store.waiting_children(self.relative_path, head)
+            if not children:
+                break
+
+            patch = self.__load_patch(children[0])
+            patches.append(patch)
+            waiting_chains.append(children[0])
+            head = patch.head_chain()
+
+        if not patches:
+            return False
+
+        if len(patches) > 1:
+            try:
+                self.__fast_forward(patches, waiting_chains)
+                return True
+            except Exception:
+                logging.warning("VCS-apply_patch: cannot apply %d composed patches to %s, applying them one by one"
+                                % (len(patches), self.relative_path), exc_info=True)
+
+        for patch, waiting_chain in zip(patches, waiting_chains):
+            try:
+                self.__fast_forward([patch], [waiting_chain])
+            except:
+                # Patch is requested again by anti-entropy
+                if waiting_chain is not None:
+                    self.store.remove_waiting_patch(self.relative_path, waiting_chain)
+                raise
 
-        for commit in waiting:
-            os.remove(self.__waiting_patch_location(commit.id))
+        return True
 
-    # Saves patch which cannot be applied (waiting for other patch)
-    def __save_patch(self, patch):
-        last_commit_id = patch.commits[-1].id
+    # Applies waiting patches which can be applied now. Waiting patches form a graph
+    # (every patch is an edge from its parent to its head), so starting at the head,
+    # children of the head are applied one after another in topological order - every
+    # waiting patch is loaded and classified once. Then waiting patches which became
+    # duplicates are dropped and a patch which conflicts with the history is resolved.
+    def apply_waiting_patches(self):
+        while self.__fast_forward_chain([], []):
+            pass
+
+        for chain, parent in self.store.waiting_patches(self.relative_path):
+            if self.version_history.position(chain) is not None:
+                self.store.remove_waiting_patch(self.relative_path, chain)
+            elif parent is not None and self.version_history.position(parent) is not None:
+                patch = self.__load_patch(chain)
+                self.store.remove_waiting_patch(self.relative_path, chain)
+
+                # Merged (its commits follow commits of the other branch)
+                if self.version_history.has_commit(patch.commits[-1].id):
+                    continue
+
+                logging.debug("VCS-apply_patch: waiting patch conflicts")
+                self.__resolve_conflict(patch)
+                return
 
-        with open(self.__waiting_patch_location(last_commit_id), 'wb') as f:
-            f.write(patch.to_bytes())
+    # Called after branches were merged. Waiting patches whose commits were merged (e.g. they
+    # came in other node's merge) are dropped, the others may continue the merged branches.
+    def __apply_merged_waiting_patches(self):
+        for chain, parent in self.store.waiting_patches(self.relative_path):
+            patch = self.__load_patch(chain)
+            if self.version_history.has_commit(patch.commits[-1].id) or (
+                    self.version_history.position(parent) is None and self.__merged(patch)):
+                self.store.remove_waiting_patch(self.relative_path, chain)
 
-    def __patch_exists(self, commit_id):
-        return os.path.exists(self.__waiting_patch_location(commit_id))
+        self.apply_waiting_patches()
+
+    # Saves patch which cannot be applied (waiting for other patch)
+    def __save_patch(self, patch):
+        self.store.save_waiting_patch(self.relative_path, patch.head_chain(), patch.parent_chain, patch.to_bytes())
 
     # Save information about change and update file signature
     def __create_commit(self):
         c = Commit()
-        c.author = utils.get_node_name()
+        c.author = self.store.node_id
         c.id = uuid.uuid1()
 
         return c
@@ -157,21 +898,39 @@ class FileVersionControl:
     # so, in apply_patch we verify that a file hase the same signature as the one
     # stored in self.signature_file_path. If signatures do not match we perform
     # recovery
+    #
+    # Returns None if content of the file did not change since the last commit (e.g. it
+    # was opened for writing and closed or the same data was written again).
     def commit(self):
+        key = hashing.file_key(self.file_path)
+        content_hash = hashing.cache.digest(self.file_path)
+
+        if content_hash == self.content_hash:
+            return None
+
         delta = self.__get_delta()
-        signature = rdiff_signature(self.file_path)
+        signature = rdiff_update_signature(self.version_history.last_signature(), delta, self.file_path)
 
-        # Commit changes
-        commit = self.__create_commit()
-        self.version_history.commits.append(commit)
-        self.version_history.signatures.append(signature)
-        self.__flush_version()
+        # File was modified while the delta was computed, its content is unknown
+        if hashing.file_key(self.file_path) != key:
+            content_hash = None
 
-        # Create patch
+        # Create patch (on top of the current head)
         patch = FilePatch()
-        patch.file_basename = os.path.basename(self.file_path)
+        patch.relative_path = self.relative_path
         patch.delta = delta
-        patch.commits = self.version_history.commits
+        patch.parent_length = self.version_history.length
+        patch.parent_chain = self.version_history.head()
+        patch.content_hash = content_hash
+
+        # Commit changes
+        commit = self.__create_commit()
+        with self.store.transaction():
+            self.__append_commit(commit, signature)
+            self.__set_content_hash(content_hash)
+        patch.commits = [commit]
+
+        self.__save_base(content_hash)
 
         # XXX: what if application crashes here? Should we handle that?
         # Patch won't be send to other nodes. We could have some "flag" stored on-disk
@@ -179,6 +938,28 @@ class FileVersionControl:
 
         return patch
 
+    # Returns patch which brings the file from an older version (identified by its position,
+    # chain digest and signature of its content) to the current head. Returns None if the
+    # version is not an ancestor of the head or commits following it were pruned.
+    def patch_since(self, parent_length, parent_chain, signature):
+        history = self.version_history
+        if parent_length >= history.length or history.position(parent_chain) != parent_length:
+            return None
+
+        patch = FilePatch()
+        patch.relative_path = self.relative_path
+        patch.parent_length = parent_length
+        patch.parent_chain = parent_chain
+        patch.commits = history.commits[parent_length - history.base_length():]
+
+        key = hashing.file_key(self.file_path)
+        content_hash = hashing.cache.digest(self.file_path)
+        patch.delta = rdiff_delta(signature if signature is not None else rdiff_empty_signature(), self.file_path)
+        if hashing.file_key(self.file_path) == key:
+            patch.content_hash = content_hash
+
+        return patch
+
     # def __verify_signature(self):
     #     tmp_file = utils.get_tmp_file()
     #     rdiff_signature(tmp_file, self.file_path)
@@ -207,53 +988,677 @@ class FileVersionControl:
 
         return new_filename
 
+    # Creates the remote version of the file (the patch applied to the patch's parent) in
+    # .sync and returns its path, or None if it cannot be recreated. The delta is applied
+    # to the kept content of the parent (base) and if there is none (or the delta was
+    # computed against other content), to the local file. The result of the latter is
+    # correct only if the delta does not copy locally changed data (e.g. it was requested
+    # with the local signature, see unresolved_parent), so it must match the patch's content hash.
+    def __remote_version(self, patch, base):
+        self.__make_metadir()
+        remote_path = self.__metadata_path(".remote")
+
+        sources = [] if base is None else [base]
+        if patch.content_hash is not None:
+            sources.append(None)
+
+        for source in sources:
+            try:
+                if source is None:
+                    rdiff_delta_apply(self.file_path, patch.delta, remote_path)
+                else:
+                    base_path = self.__metadata_path(".base")
+                    with open(base_path, 'wb') as f:
+                        f.write(source)
+
+                    try:
+                        rdiff_delta_apply(base_path, patch.delta, remote_path)
+                    finally:
+                        os.remove(base_path)
+            except Exception as e:
+                logging.debug("VCS-remote_version: cannot apply delta of %s: %s" % (self.relative_path, e))
+                continue
+
+            if patch.content_hash is None or hashing.cache.digest(remote_path) == patch.content_hash:
+                return remote_path
+
+        if os.path.exists(remote_path):
+            os.remove(remote_path)
+        return None
+
+    # Returns patch followed by waiting patches which continue it as one patch (the whole
+    # branch of concurrent changes known so far) and chain digests of those waiting patches
+    def __branch(self, patch):
+        patches, waiting_chains = [patch], []
+
+        head = patch.head_chain()
+        while len(patches) < MAX_COMPOSED_PATCHES:
+            children = self.store.waiting_children(self.relative_path, head)
+            if not children:
+                break
+
+            child = self.__load_patch(children[0])
+            patches.append(child)
+            waiting_chains.append(children[0])
+            head = child.head_chain()
+
+        if len(patches) == 1:
+            return patch, []
+
+        try:
+            delta = rdiff.compose_deltas([child.delta for child in patches])
+        except rdiff.UnsupportedFormat:
+            return patch, []
+
+        branch = FilePatch()
+        branch.relative_path = patch.relative_path
+        branch.parent_length = patch.parent_length
+        branch.parent_chain = patch.parent_chain
+        branch.commits = [commit for child in patches for commit in child.commits]
+        branch.delta = delta
+        branch.content_hash = patches[-1].content_hash
+
+        return branch, waiting_chains
+
+    # Replaces commits following position parent_length with a merge of two branches of
+    # concurrent changes - sides given as (head chain digest, commits, content). parent is
+    # content at the branching point, bases are contents of versions both branches contain
+    # (see __merge_bases), the first one the changes can be merged from is used. Branches
+    # are ordered by their heads and the merge commit is derived from both heads, so all
+    # nodes merging the same branches end up with the same content and history. Returns
+    # False if changes overlap.
+    #
+    # Later commits follow the merge, so it is sent to other nodes like a commit: a patch
+    # from the branching point with both branches and the merge commit is added to
+    # merge_patches. It starts at sent_parent ((length, chain digest, content) of an earlier
+    # version of the history) if given, e.g. the parent of the merged patch other nodes have.
+    def __merge(self, parent_length, parent_chain, parent, bases, local_side, remote_side, sent_parent=None):
+        first, second = sorted([local_side, remote_side], key=lambda side: side[0])
+
+        merged = next(filter(None, (merge.merge(base, first[2], second[2]) for base in bases)), None)
+        if merged is None:
+            return False
+
+        with open(self.patched_file_path, 'wb') as f:
+            f.write(merged)
+        os.replace(self.patched_file_path, self.file_path)
+
+        commit = Commit()
+        commit.author = second[1][-1].author
+        commit.id = merge_commit_id(first[0], second[0])
+
+        content_hash = hashing.digest(merged)
+        signature = rdiff_signature(self.file_path)
+
+        with self.store.transaction():
+            self.__truncate_history(parent_length)
+            for merged_commit in first[1] + second[1]:
+                self.__append_commit(merged_commit, None)
+            self.__append_commit(commit, signature)
+            self.__set_content_hash(content_hash)
+
+            # Branches are merged again if they are continued (see __remerge). Content at
+            # the branching point is kept too, other nodes' merges start there.
+            self.store.save_merge(self.relative_path, self.version_history.head(), parent_length, parent_chain,
+                                  first[0], len(first[1]), second[0], len(second[1]))
+            for chain, content in ((parent_chain, parent), (first[0], first[2]), (second[0], second[2])):
+                self.store.save_base(self.relative_path, chain, zlib.compress(content, 1), BASES_RETENTION)
+
+        self.__save_base(content_hash)
+
+        history = self.version_history
+        sent_length, sent_chain, sent_content = sent_parent or (parent_length, parent_chain, parent)
+
+        patch = FilePatch()
+        patch.relative_path = self.relative_path
+        patch.parent_length = sent_length
+        patch.parent_chain = sent_chain
+        patch.commits = history.commits[sent_length - history.base_length():]
+        patch.delta = self.__delta_from(sent_content)
+        patch.content_hash = content_hash
+        self.merge_patches.append(patch)
+
+        return True
+
+    # Returns delta from given content to the file
+    def __delta_from(self, content):
+        self.__make_metadir()
+        base_path = self.__metadata_path(".base")
+        with open(base_path, 'wb') as f:
+            f.write(content)
+
+        try:
+            signature = rdiff_signature(base_path)
+        finally:
+            os.remove(base_path)
+
+        return rdiff_delta(signature, self.file_path)
+
+    # Replaces local commits following the patch's parent with the patch's branch (remote
+    # version) if it contains all of them (apart from local merges), e.g. the patch is other
+    # node's merge of local changes. Returns False if it does not.
+    def __replace_branch(self, patch, remote_path):
+        changes = self.__branch_changes(patch.parent_length, patch.commits)
+        if changes is None or not changes[0] <= changes[1]:
+            return False
+
+        # Uncommitted local changes would be lost
+        if hashing.cache.digest(self.file_path) != self.content_hash:
+            return False
+
+        os.replace(remote_path, self.file_path)
+        signature = rdiff_signature(self.file_path)
+
+        with self.store.transaction():
+            self.__truncate_history(patch.parent_length)
+            for commit in patch.commits[:-1]:
+                self.__append_commit(commit, None)
+            self.__append_commit(patch.commits[-1], signature)
+            self.__set_content_hash(patch.content_hash)
+
+        self.__save_base(patch.content_hash)
+
+        return True
+
+    # Returns True if the local branch has all changes of the patch's one (e.g. the patch is
+    # other node's merge superseded by a later one). Of branches with the same changes merged
+    # differently, the one with the lower head is kept by both nodes.
+    def __superseded(self, patch):
+        changes = self.__branch_changes(patch.parent_length, patch.commits)
+        if changes is None:
+            return False
+
+        local, remote = changes
+        return remote < local or (remote == local and patch.head_chain() > self.version_history.head())
+
+    # Returns (local, remote) - ids of changes (commits which are not merges) following
+    # position parent_length in the history and in commits of a remote branch starting
+    # there, or None if the history does not have the position. Changes the history has
+    # before it are left out (a branch merged again after other commits contains them twice).
+    def __branch_changes(self, parent_length, commits):
+        history = self.version_history
+        if parent_length < history.base_length():
+            return None
+
+        following = history.commits[parent_length - history.base_length():]
+        counts = collections.Counter(commit.id for commit in following)
+
+        def changes(commits):
+            return {commit.id for commit in commits
+                    if not is_merge(commit) and history.commit_ids[commit.id] <= counts[commit.id]}
+
+        return changes(following), changes(commits)
+
+    # Merges local commits following the patch's parent with the patch
+    def __merge_conflict(self, patch, base, remote_path):
+        history = self.version_history
+        if (patch.parent_length < history.base_length() or os.path.getsize(self.file_path) > self.merge_max_bytes
+                or os.path.getsize(remote_path) > self.merge_max_bytes):
+            return False
+
+        with open(self.file_path, 'rb') as f:
+            local = f.read()
+
+        # Uncommitted local changes would be lost
+        if hashing.digest(local) != self.content_hash:
+            return False
+
+        with open(remote_path, 'rb') as f:
+            remote = f.read()
+
+        # Bases are looked for since the version the merge is sent from, the merge itself
+        # starts after commits both branches have
+        sent_parent = self.__sent_parent(patch, base)
+        sent_start = sent_parent[0] - history.base_length()
+        bases = self.__merge_bases(*sent_parent, history.commits[sent_start:patch.parent_length - history.base_length()]
+                                   + patch.commits)
+        patch, base = self.__skip_common_commits(patch, base)
+
+        return self.__merge(patch.parent_length, patch.parent_chain, base, bases,
+                            (history.head(), history.commits[patch.parent_length - history.base_length():], local),
+                            (patch.head_chain(), patch.commits, remote), sent_parent)
+
+    # Returns (length, chain digest, content) of the version the merge with the patch is sent
+    # from - the patch's parent, or the branching point of the last merge if the parent is
+    # one of its versions. Nodes which merged the same branches in other order do not have
+    # versions following the branching point.
+    def __sent_parent(self, patch, base):
+        history = self.version_history
+        record = self.store.last_merge(self.relative_path)
+        if record is not None:
+            head, parent_length, parent_chain, first_head, first_n, second_head, second_n = record
+            if (history.base_length() <= parent_length < patch.parent_length < (history.position(head) or 0)
+                    and history.position(parent_chain) == parent_length):
+                content = self.__load_base(parent_chain)
+                if content is not None:
+                    return parent_length, parent_chain, content
+
+        return patch.parent_length, patch.parent_chain, base
+
+    # Returns (patch, base) with the patch's commits which the local history has at the same
+    # positions (apart from the last ones of both branches, e.g. a merged branch both nodes
+    # have) moved to its parent, so nodes merging the same heads merge them from the same
+    # version. base is content of the new parent, the patch is returned unchanged if it is
+    # not kept. The delta stays the same.
+    def __skip_common_commits(self, patch, base):
+        history = self.version_history
+        start = patch.parent_length - history.base_length()
+
+        n = 0
+        while (n < len(patch.commits) - 1 and start + n < len(history.commits) - 1
+               and history.commits[start + n].id == patch.commits[n].id):
+            n += 1
+        if n == 0:
+            return patch, base
+
+        parent = self.__load_base(history.chains[start + n - 1])
+        if parent is None:
+            return patch, base
+
+        branch = FilePatch()
+        branch.relative_path = patch.relative_path
+        branch.parent_length = patch.parent_length + n
+        branch.parent_chain = history.chains[start + n - 1]
+        branch.commits = patch.commits[n:]
+        branch.delta = patch.delta
+        branch.content_hash = patch.content_hash
+
+        return branch, parent
+
+    # Returns contents of versions following position parent_length (whose chain digest is
+    # parent_chain and content is parent) which can be used as the base of a merge of the
+    # local branch and the remote one (its commits given), the best first and parent as the
+    # last one. Changes made since the base are merged, so it has to contain only changes
+    # both branches have (e.g. both merged the same changes before) - the more of them, the
+    # fewer are taken for concurrent ones. Results of merges with any of such bases are
+    # the same, if they succeed.
+    #
+    # Kept contents of versions of both branches and of the second branch of the last merge
+    # are used. If none of them has all common changes, merge of two of them which together
+    # have the most is tried first.
+    def __merge_bases(self, parent_length, parent_chain, parent, commits):
+        history = self.version_history
+        start = parent_length - history.base_length()
+        local, remote = self.__branch_changes(parent_length, commits)
+        common, changed = local & remote, local | remote
+
+        # (changes since the parent, content)
+        candidates = []
+
+        def add(commits, chain):
+            changes = set()
+            for commit in commits:
+                chain = chain_digest(chain, commit)
+                if commit.id in changed:
+                    if commit.id not in common:
+                        return
+                    changes.add(commit.id)
+
+                content = self.__load_base(chain)
+                if content is not None:
+                    candidates.append((frozenset(changes), content))
+
+        add(history.commits[start:], parent_chain)
+        add(commits, parent_chain)
+
+        record = self.store.last_merge(self.relative_path)
+        if record is not None:
+            head, merge_length, merge_chain, first_head, first_n, second_head, second_n = record
+            merge_start = merge_length - history.base_length()
+
+            if merge_length >= parent_length and history.position(head) == merge_length + first_n + second_n + 1:
+                second = history.commits[merge_start + first_n:merge_start + first_n + second_n]
+                changes = changed.intersection(commit.id for commit in history.commits[start:merge_start] + second)
+                content = self.__load_base(second_head)
+                if changes <= common and content is not None:
+                    candidates.append((frozenset(changes), content))
+
+        candidates.sort(key=lambda candidate: len(candidate[0]), reverse=True)
+        bases = [content for changes, content in candidates]
+
+        if candidates and candidates[0][0] != common:
+            first = candidates[0]
+            others = [candidate for candidate in candidates[1:] if not candidate[0] <= first[0]]
+            if others:
+                second = max(others, key=lambda candidate: len(candidate[0] | first[0]))
+                base = next((content for changes, content in candidates if changes <= first[0] & second[0]), parent)
+                merged = merge.merge(base, first[1], second[1])
+                if merged is not None:
+                    bases.insert(0, merged)
+
+        return bases + [parent]
+
+    # Patch continues one of the branches merged by the last merge (e.g. the rest of other
+    # node's changes arrived after the merge). If nothing was committed since the merge, it
+    # is done again with the continued branch - the same way as on nodes which had the
+    # whole branch when they merged. Returns False if the patch was not merged.
+    def __remerge(self, patch):
+        history = self.version_history
+        if self.merge_max_bytes <= 0:
+            return False
+
+        record = self.store.load_merge(self.relative_path, history.head())
+        if record is None:
+            return False
+
+        parent_length, parent_chain, first_head, first_n, second_head, second_n = record
+        if patch.parent_chain not in (first_head, second_head) or parent_length < history.base_length():
+            return False
+
+        # Patch continuing the first branch has all changes of the second one (other node's
+        # merge) or the history has all of its changes, see __resolve_conflict
+        if history.position(patch.parent_chain) is not None:
+            local, remote = self.__branch_changes(patch.parent_length, patch.commits)
+            if local <= remote or remote <= local:
+                return False
+
+        # Uncommitted local changes would be lost
+        if hashing.cache.digest(self.file_path) != self.content_hash:
+            return False
+
+        start = parent_length - history.base_length()
+        first = (first_head, history.commits[start:start + first_n])
+        second = (second_head, history.commits[start + first_n:start + first_n + second_n])
+        continued, other = (first, second) if patch.parent_chain == first_head else (second, first)
+
+        base = self.__load_base(parent_chain)
+        continued_content = self.__load_base(continued[0])
+        other_content = self.__load_base(other[0])
+        if base is None or continued_content is None or other_content is None:
+            return False
+
+        patch, waiting_chains = self.__branch(patch)
+        remote_path = self.__remote_version(patch, continued_content)
+        if remote_path is None:
+            return False
+
+        try:
+            with open(remote_path, 'rb') as f:
+                remote = f.read()
+        finally:
+            os.remove(remote_path)
+
+        if not self.__merge(parent_length, parent_chain, base, [base], (other[0], other[1], other_content),
+                            (patch.head_chain(), continued[1] + patch.commits, remote)):
+            return False
+
+        for waiting_chain in waiting_chains:
+            self.store.remove_waiting_patch(self.relative_path, waiting_chain)
+        self.__apply_merged_waiting_patches()
+
+        return True
+
+    # Returns (parent length, parent chain digest) of a patch whose conflict could not be
+    # resolved (see __resolve_conflict) or None. The patch's commits are requested again
+    # from its parent with signature of the local head, so that the remote version can be
+    # recreated from the local file. Unresolved patches which are already in the history
+    # or whose parents are not are dropped.
+    def unresolved_parent(self):
+        history = self.version_history
+        dropped = []
+
+        for head, parent_length, parent_chain in self.store.unresolved_patches(self.relative_path):
+            if history.position(head) is None and history.position(parent_chain) == parent_length:
+                self.store.remove_unresolved_patches(self.relative_path, dropped)
+                return parent_length, parent_chain
+            dropped.append(head)
+
+        self.store.remove_unresolved_patches(self.relative_path, dropped)
+        return None
+
+    # Concurrent changes are merged if possible (content of their common version is kept
+    # and they do not overlap), otherwise the file is split into local and remote variants.
+    # If the patch's branch already contains all local changes (other node merged them),
+    # it replaces them. Waiting patches which continue the patch are resolved together with it.
+    #
+    # If the remote version cannot be recreated (content of the common version is not
+    # kept and the delta copies locally changed data), the patch stays unresolved until
+    # anti-entropy gets it again with a delta against the local content.
     def __resolve_conflict(self, patch):
-        tmp_copy_location = os.path.join(self.metapath, os.path.basename(self.file_path) + ".conflict_copy")
+        patch, waiting_chains = self.__branch(patch)
+
+        # Unresolved patches with heads among the patch's commits are resolved with it
+        heads, chain = [], patch.parent_chain
+        for commit in patch.commits:
+            chain = chain_digest(chain, commit)
+            heads.append(chain)
+
+        if self.__superseded(patch):
+            logging.debug("VCS: changes of %s were merged before" % self.relative_path)
+            with self.store.transaction():
+                for waiting_chain in waiting_chains:
+                    self.store.remove_waiting_patch(self.relative_path, waiting_chain)
+                self.store.remove_unresolved_patches(self.relative_path, heads)
+            return
 
-        already_conflicted = os.path.exists(self.__conflict_flag_path())
+        base = self.__load_base(patch.parent_chain) if self.merge_max_bytes > 0 else None
+        remote_path = self.__remote_version(patch, base)
 
-        # Create conflict flag
-        open(self.__conflict_flag_path(), 'w').close()
+        if remote_path is None:
+            logging.info("VCS: remote version of %s cannot be recreated, it will be requested again"
+                         % self.relative_path)
+            self.store.save_unresolved_patch(self.relative_path, patch.head_chain(), patch.parent_length,
+                                             patch.parent_chain)
+            return
 
-        shutil.copy2(self.file_path, tmp_copy_location)
+        replaced = self.__replace_branch(patch, remote_path)
+        if replaced or (base is not None and self.__merge_conflict(patch, base, remote_path)):
+            if replaced:
+                logging.debug("VCS: local changes of %s were merged by other node" % self.relative_path)
+            else:
+                logging.info("VCS: merged concurrent changes of %s" % self.relative_path)
+                os.remove(remote_path)
+
+            with self.store.transaction():
+                for waiting_chain in waiting_chains:
+                    self.store.remove_waiting_patch(self.relative_path, waiting_chain)
+                self.store.remove_unresolved_patches(self.relative_path, heads)
+            self.__apply_merged_waiting_patches()
+            return
+
+        already_conflicted = self.conflicted
 
         if not already_conflicted:
-            new_filename1 = self.__append_node_name_to_file_name(self.file_path, utils.get_node_name())
+            new_filename1 = self.__append_node_name_to_file_name(self.file_path, node_name(self.store.node_id))
         else:
             new_filename1 = self.file_path
 
-        new_filename2 = self.__append_node_name_to_file_name(self.file_path, patch.commits[-1].author)
+        new_filename2 = self.__append_node_name_to_file_name(self.file_path, node_name(patch.commits[-1].author))
 
-        # Create two files
-        os.rename(tmp_copy_location, new_filename1)
-        os.rename(self.file_path, new_filename2)
+        # Variants stay in the file's directory
+        for new_filename in (new_filename1, new_filename2):
+            if os.path.dirname(new_filename) != os.path.dirname(self.file_path):
+                raise Exception("Invalid name of conflict variant of %s: %s" % (self.relative_path, new_filename))
 
-        local_file_vcs = FileVersionControl(new_filename1, self.metapath, None)
-        shutil.copy2(self.version_history_file_path, local_file_vcs.version_history_file_path)
-        local_file_vcs.__init_version()
+        # Both files are versions of this one and are protected by the same lock
+        directory = os.path.dirname(self.metapath)
+        self.lock.alias(os.path.relpath(new_filename1, directory))
+        self.lock.alias(os.path.relpath(new_filename2, directory))
 
-        remote_file_vcs = FileVersionControl(new_filename2, self.metapath, None)
-        shutil.copy2(self.version_history_file_path, remote_file_vcs.version_history_file_path)
-        remote_file_vcs.__init_version()
-        
-        common_commits = self.__common_commits_n(remote_file_vcs.version_history.commits, patch.commits)
-        remote_file_vcs.version_history.commits = remote_file_vcs.version_history.commits[:common_commits]
-        remote_file_vcs.version_history.signatures = remote_file_vcs.version_history.signatures[:common_commits]
+        # Create two files
+        if new_filename1 != self.file_path:
+            os.rename(self.file_path, new_filename1)
+        os.rename(remote_path, new_filename2)
+
+        # Cached histories of variants (if they existed before) are replaced
+        if self.cache is not None:
+            self.cache.invalidate(os.path.relpath(new_filename1, directory))
+            self.cache.invalidate(os.path.relpath(new_filename2, directory))
+
+        signature = rdiff_signature(new_filename2)
+
+        # Conflict flag, histories of both files and the variants index are updated together
+        with self.store.transaction():
+            self.store.set_conflicted(self.relative_path)
+            self.store.add_variants(self.logical_path,
+                                    [os.path.relpath(new_filename1, directory), os.path.relpath(new_filename2, directory)],
+                                    self.relative_path if self.relative_path != self.logical_path else None)
+
+            self.store.copy_history(self.relative_path, os.path.relpath(new_filename1, directory))
+            local_file_vcs = FileVersionControl(new_filename1, self.metapath, self.lock, self.store,
+                                                merge_max_bytes=self.merge_max_bytes)
+            local_file_vcs.__set_content_hash(self.content_hash)
+
+            self.store.copy_history(self.relative_path, os.path.relpath(new_filename2, directory))
+            remote_file_vcs = FileVersionControl(new_filename2, self.metapath, self.lock, self.store,
+                                                 merge_max_bytes=self.merge_max_bytes)
+
+            # Remote version follows the patch's parent (common with local history)
+            if patch.parent_length >= remote_file_vcs.version_history.base_length():
+                remote_file_vcs.__truncate_history(patch.parent_length)
+            else:
+                remote_file_vcs.__rebase_history(patch.parent_length, patch.parent_chain)
+
+            for commit in patch.commits[:-1]:
+                remote_file_vcs.__append_commit(commit, None)
+            remote_file_vcs.__append_commit(patch.commits[-1], signature)
+            remote_file_vcs.__set_content_hash(patch.content_hash)
+
+            for waiting_chain in waiting_chains:
+                self.store.remove_waiting_patch(self.relative_path, waiting_chain)
+            self.store.remove_unresolved_patches(self.relative_path, heads)
+
+        self.conflicted = True
+
+    # Checks that applying the patch produced the same content as the sender has. Digest of
+    # the patched file stays cached after it replaces the original file (same inode).
+    def __verify_patched_file(self, patch):
+        if patch.content_hash is None:
+            return
 
-        remote_file_vcs.apply_patch(patch)
+        if hashing.cache.digest(self.patched_file_path) != patch.content_hash:
+            os.remove(self.patched_file_path)
+            raise Exception("Content of %s does not match the patch (local file has uncommitted changes?)"
+                            % self.relative_path)
 
+    # Classifies patch using chain digests only (without comparing whole histories):
+    #  * DUPLICATE - patch's head is already in local history
+    #  * FAST_FORWARD - patch's parent is local head
+    #  * CONFLICT - patch's parent is in local history but is not its head
+    #  * OUT_OF_ORDER - patch's parent is unknown (some patches did not arrive yet)
+    #
+    # Commits of a merged patch are in local history with different chain digests (they
+    # follow commits of the other merged patch), such patch is found by its last commit.
     def __synchronization_type(self, patch):
-        common_commits = self.__common_commits_n(self.version_history.commits, patch.commits)
+        history = self.version_history
 
-        if common_commits == len(self.version_history.commits) and len(self.version_history.commits) + 1 == len(patch.commits):
+        if history.position(patch.head_chain()) is not None:
+            return SynchronizationType.DUPLICATE
+        elif patch.parent_chain == history.head():
             return SynchronizationType.FAST_FORWARD
-        elif common_commits == len(self.version_history.commits) and common_commits == len(patch.commits):
+        elif history.has_commit(patch.commits[-1].id):
+            return SynchronizationType.DUPLICATE
+        elif history.position(patch.parent_chain) is not None:
+            return SynchronizationType.CONFLICT
+        elif self.__merged(patch):
             return SynchronizationType.DUPLICATE
-        elif common_commits + 1 < len(patch.commits):
+        else:
             return SynchronizationType.OUT_OF_ORDER
+
+    # Returns True if the history has all changes of the patch (commits which are not merges),
+    # e.g. the patch is other node's merge of branches which were merged again later
+    def __merged(self, patch):
+        return all(self.version_history.has_commit(commit.id) for commit in patch.commits if not is_merge(commit))
+
+    # Applies patches whose parent is the head (every one is a child of the previous one).
+    # Their deltas are composed, so the file is rewritten once. waiting_chains identify
+    # patches which were waiting (they are removed together with applying them).
+    def __fast_forward(self, patches, waiting_chains):
+        if len(patches) == 1:
+            delta = patches[0].delta
         else:
-            return SynchronizationType.CONFLICT
-        
+            delta = rdiff.compose_deltas([patch.delta for patch in patches])
+
+        self.__make_metadir()
+        rdiff_delta_apply(self.file_path, delta, self.patched_file_path)
+        self.__verify_patched_file(patches[-1])
+
+        # XXX: This is a race with user updates, see https://github.com/chorig9/dtn-sync/issues/15
+        # for solutions (replace itself is atomic operation)
+        os.replace(self.patched_file_path, self.file_path)
+
+        # Unchanged blocks of the basis are known only if it was not modified locally
+        if patches[-1].content_hash is not None:
+            signature = rdiff_update_signature(self.version_history.last_signature(), delta, self.file_path)
+        else:
+            signature = rdiff_signature(self.file_path)
+
+        # Only the head has a signature, versions in between were never materialized
+        commits = [commit for patch in patches for commit in patch.commits]
+        with self.store.transaction():
+            for commit in commits[:-1]:
+                self.__append_commit(commit, None)
+            self.__append_commit(commits[-1], signature)
+            self.__set_content_hash(patches[-1].content_hash)
+
+            for waiting_chain in waiting_chains:
+                if waiting_chain is not None:
+                    self.store.remove_waiting_patch(self.relative_path, waiting_chain)
+
+        self.__save_base(patches[-1].content_hash)
+
+    # Applies patches received together (e.g. when catching up after reconnecting). Patches
+    # which continue the head one after another are applied with one rewrite of the file,
+    # others are applied one by one.
+    def apply_patches(self, patches):
+        if len(patches) == 1 or self.conflicted:
+            for patch in patches:
+                self.apply_patch(patch)
+            return
+
+        children = {}
+        for patch in patches:
+            children.setdefault(patch.parent_chain, patch)
+
+        chain = []
+        head = self.version_history.head()
+        while head in children:
+            patch = children.pop(head)
+            chain.append(patch)
+            head = patch.head_chain()
+
+        if chain:
+            logging.debug("VCS-apply_patch: fast forward %d patches" % len(chain))
+            self.__fast_forward_chain(chain, [None] * len(chain))
+            self.apply_waiting_patches()
+
+        # Patches which continue a conflicting one are saved (as waiting) before it is
+        # resolved, so the whole branch is resolved at once
+        rest = [patch for patch in patches if not any(patch is applied for applied in chain)]
+        rest.sort(key=lambda patch: self.version_history.position(patch.parent_chain) is not None)
+
+        for patch in rest:
+            self.apply_patch(patch)
+
+    def __variant(self, relative_path):
+        directory = os.path.dirname(self.metapath)
+        variant = FileVersionControl(os.path.join(directory, relative_path), self.metapath, self.lock, self.store,
+                                     self.cache, self.merge_max_bytes)
+        variant.logical_path = self.relative_path
+        variant.merge_patches = self.merge_patches
+        self.variants.append(variant)
+
+        return variant
+
+    # Returns variant of this (conflicted) file the patch should be applied to. Variant
+    # whose head is the patch's parent (or head) is found by one lookup in the store.
+    # Otherwise histories of variants are checked: a variant which already has the patch
+    # is preferred, then one with the patch's parent (the patch conflicts with it). If
+    # no variant knows the parent, the patch waits in the oldest variant.
+    def __find_variant(self, patch):
+        relative_path = self.store.variant_with_head(self.relative_path, [patch.parent_chain, patch.head_chain()])
+        if relative_path is not None:
+            return self.__variant(relative_path)
+
+        candidates = [self.__variant(relative_path) for relative_path in self.store.variants(self.relative_path)]
+        candidates = [candidate for candidate in candidates if not candidate.conflicted]
+
+        for sync_type in (SynchronizationType.DUPLICATE, SynchronizationType.CONFLICT):
+            for candidate in candidates:
+                if candidate.__synchronization_type(patch) == sync_type:
+                    return candidate
+
+        return candidates[0] if candidates else None
 
     # Applies patch (obtained from remote commit)
     def apply_patch(self, patch):
@@ -275,30 +1680,26 @@ class FileVersionControl:
         # If file is marked as conflicted this means that there are multiple versions of this file.
         # If possible, find version to which the patch can be applied. If that's not possible take
         # whichever
-        if os.path.exists(self.__conflict_flag_path()):
-            dir = os.path.dirname(self.file_path)
-            for file in os.listdir(dir):
-                if file.startswith(os.path.basename(self.file_path)):
-                    candidate = FileVersionControl(os.path.join(dir, file), self.metapath, None)
-                    if candidate.__synchronization_type(patch) != SynchronizationType.CONFLICT:
-                        self = candidate
-                        break
-
-        common_commits = self.__common_commits_n(self.version_history.commits, patch.commits)
-        logging.debug("VCS-apply_patch: common_commits: %d -- %d %d" % (common_commits, len(self.version_history.commits), len(patch.commits)))
+        if self.conflicted:
+            variant = self.__find_variant(patch)
+            if variant is None:
+                logging.warning("VCS-apply_patch: no variants of conflicted file %s" % self.relative_path)
+                return
+            self = variant
+
+        logging.debug("VCS-apply_patch: local length: %d, patch parent length: %d, patch commits: %d" %
+                      (self.version_history.length, patch.parent_length, len(patch.commits)))
 
         sync_type = self.__synchronization_type(patch)
 
-        if sync_type == SynchronizationType.FAST_FORWARD:
+        if sync_type in (SynchronizationType.OUT_OF_ORDER, SynchronizationType.CONFLICT) and self.__remerge(patch):
+            logging.debug("VCS-apply_patch: merged again with continued branch")
+        elif sync_type == SynchronizationType.FAST_FORWARD:
             logging.debug("VCS-apply_patch: fast forward")
-            rdiff_delta_apply(self.file_path, patch.delta, self.patched_file_path)
 
-            # XXX: This is a race with user updates, see https://github.com/chorig9/dtn-sync/issues/15
-            # for solutions (replace itself is atomic operation)
-            os.replace(self.patched_file_path, self.file_path)
-            self.version_history.commits = patch.commits
-            self.version_history.signatures.append(rdiff_signature(self.file_path))
-            self.__flush_version()
+            # Patches which were waiting for this one are applied together with it
+            self.__fast_forward_chain([patch], [None])
+            self.apply_waiting_patches()
         elif sync_type == SynchronizationType.DUPLICATE:
             logging.debug("VCS-apply_patch: duplicate")
             pass
@@ -314,43 +1715,23 @@ class FileVersionControl:
             # *     -- 2 common commits
             # |
             # *
+            #
+            # Patch is applied (or resolved as a conflict) when its parent is applied,
+            # see apply_waiting_patches
             self.__save_patch(patch)
-
-            # Check whether all required patches are present
-            dependencies = patch.commits[common_commits:]
-            for commit in dependencies:
-                if not self.__patch_exists(commit.id):
-                    return
-
-            # We have all the required patches (dependencies)
-            self.__apply_waiting_patches(dependencies)
-
-            # XXX: add some recovery mechanism (restore after restart?)
-            # Both for case when we crashed during applying patches and
-            # before even handling one.
         else:
             logging.debug("VCS-apply_patch: conflict")
             self.__resolve_conflict(patch)
 
-    def __common_commits_n(self, local_commits, remote_commits):
-        n_commits = min(len(local_commits), len(remote_commits))
-        for i in range(0, n_commits):
-            local_commit = local_commits[i]
-            remote_commit = remote_commits[i]
-
-            if local_commit.id != remote_commit.id:
-                return i
-
-        return n_commits
-
 # Version Control System - Class which creates abstraction for versioning system
 class VCS:
-    def __init__(self, directory):
+    def __init__(self, directory, history_cache_bytes=DEFAULT_HISTORY_CACHE_BYTES, merge_max_bytes=DEFAULT_MERGE_MAX_BYTES):
         self.directory = directory
         self.metapath = os.path.join(self.directory, ".sync")
+        self.merge_max_bytes = merge_max_bytes
 
-        # XXX: lock per file
-        self.lock = threading.Lock()
+        self.locks = LockTable()
+        self.histories = HistoryCache(history_cache_bytes)
 
         try:
             os.makedirs(self.metapath)
@@ -358,9 +1739,144 @@ class VCS:
             if e.errno != errno.EEXIST:
                 raise
 
-    def _file_path(self, basename):
-        return os.path.join(self.directory, basename)
+        self.store = store.MetadataStore(os.path.join(self.metapath, METADATA_STORE_NAME))
+
+        # Merges made while recovering waiting patches, to be sent to other nodes
+        self.merge_patches = []
+
+        self.__migrate_sidecar_files()
+        self.__load_lock_aliases()
+        self.__load_digest()
+        self.__recover_waiting_patches()
+
+    # Older versions kept metadata of every file in separate files in .sync
+    # (<name>.version, <name>.patch<uuid>, <name>.conflicted). Moves them to the store.
+    def __migrate_sidecar_files(self):
+        if self.store.get_property("sidecars_migrated"):
+            return
+
+        migrated = []
+        with self.store.transaction():
+            for name in os.listdir(self.metapath):
+                path = os.path.join(self.metapath, name)
+                if name.startswith(METADATA_STORE_NAME) or not os.path.isfile(path):
+                    continue
+
+                patch = WAITING_PATCH_FILE.match(name)
 
-    # Returns instance of FileVersionControl
-    def file_version_control(self, file_basename):
-        return FileVersionControl(self._file_path(file_basename), self.metapath, self.lock)
+                if name.endswith(".version"):
+                    with open(path, 'rb') as f:
+                        history = VersionHistory.from_stored_bytes(f.read())
+                    self.store.save_history(name[:-len(".version")], history.to_bytes(), history.length, history.head())
+                elif name.endswith(".conflicted"):
+                    self.store.set_conflicted(name[:-len(".conflicted")])
+                elif patch is not None:
+                    self.__migrate_waiting_patch(patch.group(1), path)
+                elif not name.endswith((".new", ".conflict_copy")):
+                    logging.warning("VCS: dropping unknown metadata file %s" % path)
+
+                migrated.append(path)
+
+            self.store.set_property("sidecars_migrated", 1)
+
+        for path in migrated:
+            os.remove(path)
+
+    def __migrate_waiting_patch(self, relative_path, path):
+        try:
+            with open(path, 'rb') as f:
+                patch = FilePatch.from_stored_bytes(f.read())
+        except Exception as e:
+            logging.warning("VCS: dropping unreadable waiting patch %s: %s" % (path, e))
+            return
+
+        patch.relative_path = relative_path
+        self.store.save_waiting_patch(relative_path, patch.head_chain(), patch.parent_chain, patch.to_bytes())
+
+    # Digest of heads of all files, kept up to date by the store
+    def __load_digest(self):
+        self.digest = digest.DirectoryDigest()
+        self.store.head_observers.append(self.digest.update)
+
+        for path, length, head in self.store.heads():
+            self.digest.update(path, length, head)
+
+    # Applies waiting patches which could have been applied before restart (e.g. if
+    # it crashed after their parent was applied)
+    def __recover_waiting_patches(self):
+        for path in self.store.paths_with_waiting_patches():
+            try:
+                with self.file_version_control(path) as file_vcs:
+                    if not file_vcs.conflicted:
+                        file_vcs.apply_waiting_patches()
+                self.merge_patches.extend(file_vcs.merge_patches)
+            except Exception:
+                logging.exception("VCS: recovery of waiting patches of %s" % path)
+
+    # Older versions did not index variants of conflicted files, they were found by
+    # scanning the file's directory. Names of variants are built as in
+    # __append_node_name_to_file_name (node name inserted before the first dot).
+    def __index_variants(self):
+        conflicted = self.store.conflicted_paths()
+
+        with self.store.transaction():
+            # Variants of variants are variants of the original file
+            roots = {}
+            for path in sorted(conflicted, key=len):
+                root = roots.get(path, path)
+
+                relative_dir, name = os.path.split(path)
+                directory = os.path.join(self.directory, relative_dir)
+                if not os.path.isdir(directory):
+                    continue
+
+                dot_index = name.find('.')
+                if dot_index == -1:
+                    dot_index = len(name)
+                stem, extension = name[:dot_index], name[dot_index:]
+
+                for file in sorted(os.listdir(directory)):
+                    variant = os.path.join(relative_dir, file)
+                    if len(file) > len(name) and file.startswith(stem) and file.endswith(extension):
+                        roots[variant] = root
+                        if variant not in conflicted:
+                            self.store.add_variants(root, [variant])
+
+            self.store.set_property("variants_indexed", 1)
+
+    # Conflict variants of a file share its lock
+    def __load_lock_aliases(self):
+        if not self.store.get_property("variants_indexed"):
+            self.__index_variants()
+
+        for path, variant in self.store.all_variants():
+            self.locks.alias(variant, path)
+
+    # Returns normalized path relative to the synchronized directory. Paths pointing
+    # outside of the directory or into metadata (e.g. received from other nodes) are rejected.
+    def _relative_path(self, path):
+        normalized = os.path.normpath(path)
+        if os.path.isabs(normalized) or normalized.split(os.sep)[0] in (os.curdir, os.pardir, ".sync"):
+            raise Exception("Invalid file path: %s" % path)
+
+        return normalized
+
+    def _file_path(self, relative_path):
+        return os.path.join(self.directory, relative_path)
+
+    # Returns instance of FileVersionControl for a file (path relative to the synchronized
+    # directory). File is locked before its version is loaded and stays locked until
+    # the returned object's context exits.
+    def file_version_control(self, relative_path):
+        relative_path = self._relative_path(relative_path)
+
+        lock = FileLock(self.locks, relative_path)
+        lock.acquire()
+
+        try:
+            os.makedirs(os.path.dirname(self._file_path(relative_path)), exist_ok=True)
+            return FileVersionControl(self._file_path(relative_path), self.metapath, lock, self.store, self.histories,
+                                      self.merge_max_bytes)
+        except:
+            lock.release()
+            raise
@@ -0,0 +1,94 @@
+import threading
+import queue
+import time
+import logging
+
+# Number of completed tasks after which statistics are logged
+STATS_LOG_INTERVAL = 100
+
+# Pool of worker threads. Tasks with the same key are always executed by the same
+# worker, in order of submission, so operations on one file are never reordered.
+#
+# Every worker has a bounded queue - if it is full, submit() blocks (backpressure
+# on the producer instead of unbounded memory growth).
+#
+# Workers are threads, they run in parallel only while the GIL is released - signatures
+# and deltas of big files are computed by rdiff processes or by the native engine in
+# a pool of processes (see rdiff.create_backend), hashing and file I/O release the GIL.
+class WorkerPool:
+    def __init__(self, workers_n=4, queue_size=64):
+        self.queues = [queue.Queue(queue_size) for _ in range(workers_n)]
+
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+
+        self.threads = []
+        for q in self.queues:
+            thread = threading.Thread(target=self.__work, args=(q,))
+            thread.start()
+            self.threads.append(thread)
+
+    def __work(self, q):
+        while True:
+            task = q.get()
+            if task is None:
+                return
+
+            submit_time, function, args = task
+            start_time = time.monotonic()
+
+            failed = False
+            try:
+                function(*args)
+            except Exception:
+                failed = True
+                logging.exception("WorkerPool: task failed")
+
+            self.__task_done(start_time - submit_time, time.monotonic() - start_time, failed)
+
+    def __task_done(self, wait_time, run_time, failed):
+        with self.stats_lock:
+            self.completed += 1
+            self.failed += failed
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.run_time += run_time
+
+            log = self.completed % STATS_LOG_INTERVAL == 0
+
+        if log:
+            logging.debug("WorkerPool: %s" % self.stats())
+
+    # Schedules function(*args), tasks with equal keys are executed sequentially
+    def submit(self, key, function, *args):
+        with self.stats_lock:
+            self.submitted += 1
+
+        q = self.queues[hash(key) % len(self.queues)]
+        q.put((time.monotonic(), function, args))
+
+    def stats(self):
+        with self.stats_lock:
+            completed = max(self.completed, 1)
+            return {
+                "queued": [q.qsize() for q in self.queues],
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait": self.wait_time / completed,
+                "max_wait": self.max_wait_time,
+                "avg_run": self.run_time / completed,
+            }
+
+    # Waits for queued tasks and stops workers
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+
+        for thread in self.threads:
+            thread.join()
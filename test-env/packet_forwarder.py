@@ -1,60 +1,105 @@
 import socket
-import threading
-import io
+import sys
 import os
 import argparse
 
-# This class is used to forward packets with some delay.
-# For example, if skip == 2, it will buffer 2 packets and when third
-# one arrives it will send those 2 packets to the destination and quit
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import communication
+import bundles
+import neighbors
+
+# This class relays messages between two nodes which cannot reach each other directly
+# (see PatchTests.isolate) and delays some of them.
+#
+# Nodes send patches only to neighbors they receive beacons from, so all messages
+# (beacons included) are relayed in both directions and every node sees the other one
+# as a neighbor at the forwarder's address. Messages are reassembled to tell bundles
+# (patches) from beacons and control messages.
+#
+# Messages to send_to (except for beacons) are held until skip bundles are held and
+# another bundle is relayed (in either direction), then the held messages are sent after
+# it. For example, if skip == 2, the first 2 patches for send_to arrive after the third
+# one. After that all messages are relayed right away.
 class Receiver:
-    def __init__(self, port, send_to, skip):
+    def __init__(self, port, send_to, receive_from, skip):
         self.port = port
         self.send_to = send_to
+        self.receive_from = receive_from
         self.skip = skip
 
-        self.out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self.out_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("", self.port))
 
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.client.bind(("", self.port))
+        self.reassembler = communication.Reassembler()
 
-        self.skipped = []
+        # Messages are sent on behalf of their original senders
+        self.fragmenters = {}
 
-        self.listen_thread = threading.Thread(target=self.listen)
-        self.listen_thread.start()
+        self.held = []
+        self.held_bundles_n = 0
+        self.holding = skip > 0
 
         with open("/tmp/log.txt", "w") as f:
             f.write("Started\n")
 
     def listen(self):
+        buffer = bytearray(communication.MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+
         while True:
-            buffer = bytearray(4096) # XXX bigger buffer size/split recv
-            nbytes, addr = self.client.recvfrom_into(buffer)
+            nbytes, (address, _) = self.sock.recvfrom_into(buffer)
+            if address not in (self.send_to, self.receive_from):
+                continue
+
+            try:
+                sender, message = self.reassembler.add(view[:nbytes])
+            except ValueError:
+                continue
+
+            if message is not None and len(message) > 0:
+                destination = self.send_to if address == self.receive_from else self.receive_from
+                self.relay(sender, bytes(message), destination)
+
+    def relay(self, sender, message, destination):
+        bundle = message[0] == bundles.Bundle.TYPE_ID
+
+        if not self.holding or message[0] == neighbors.Beacon.TYPE_ID:
+            self.send(sender, message, destination)
+        elif destination == self.send_to and (not bundle or self.held_bundles_n < self.skip):
+            self.held.append((sender, message))
+            self.held_bundles_n += bundle
+            self.log("Held")
+        else:
+            self.send(sender, message, destination)
 
-            self.skipped.append(buffer)
+            # Bundle which triggers sending of the held ones
+            if bundle and self.held_bundles_n == self.skip:
+                for held_sender, held_message in self.held:
+                    self.send(held_sender, held_message, self.send_to)
 
-            if self.skip + 1 == len(self.skipped):
-                for packet in self.skipped[:-1]:
-                    self.send(packet)
+                self.held = []
+                self.holding = False
+                self.log("Send")
 
-                with open("/tmp/log.txt", "a+") as f:
-                    f.write("Send\n")
+    def send(self, sender, message, destination):
+        fragmenter = self.fragmenters.get(sender)
+        if fragmenter is None:
+            fragmenter = self.fragmenters[sender] = communication.Fragmenter(sender)
 
-                sys.exit()
-            else:
-                with open("/tmp/log.txt", "a+") as f:
-                    f.write("Skipped\n")
+        fragmenter.send(self.sock, message, (destination, self.port))
 
-    def send(self, data):
-        self.out_sock.sendto(data, (self.send_to, self.port))
+    def log(self, line):
+        with open("/tmp/log.txt", "a+") as f:
+            f.write(line + "\n")
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-p", "--port", type=int, required=True)
 parser.add_argument("-s", "--send_to", required=True)
+parser.add_argument("-f", "--receive_from", required=True)
 parser.add_argument("-k", "--skip", required=True)
 
 args = parser.parse_args()
 
-receiver = Receiver(args.port, args.send_to, int(args.skip))
+receiver = Receiver(args.port, args.send_to, args.receive_from, int(args.skip))
+receiver.listen()
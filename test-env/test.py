@@ -3,10 +3,13 @@ import time
 import os
 import sys
 import shutil
+import sqlite3
+import uuid
 
 sys.path.append(os.path.abspath('../src'))
 
 import utils
+import vcs
 
 
 class BasicTests(AbstractTest):
@@ -28,8 +31,16 @@ class PatchTests(AbstractTest):
 	def node_log_file(self, node):
 		return "/tmp/node%d_out.txt" % node
 
+	# Conflict copies of files are named after the persistent id of the node (see
+	# vcs.node_name), it is read from the node's metadata store
 	def node_name(self, node):
-		return "CoreNode%d" % (node + 1)
+		db = sqlite3.connect(os.path.join(self.node_dir_path(node), ".sync", vcs.METADATA_STORE_NAME))
+		try:
+			node_id = db.execute("SELECT value FROM properties WHERE name = 'node_id'").fetchone()[0]
+		finally:
+			db.close()
+
+		return vcs.node_name(uuid.UUID(bytes=node_id))
 
 	def setup_dirs(self):
 		try:
@@ -41,13 +52,37 @@ class PatchTests(AbstractTest):
 		os.mkdir(self.node_dir_path(0))
 		os.mkdir(self.node_dir_path(1))
 
+	# Writes are not coalesced, every write_to_file is a separate patch (packet_forwarder
+	# counts patches)
 	def init_node(self, node):
 		self.env.run_command(node, ["python3", 
 			PatchTests.DTN_SOURCE_DIR + "/src/main.py",
 			"-p", PatchTests.TEST_PORT,
 			"-d", self.node_dir_path(node),
 			"--stdout", self.node_log_file(node),
-			"--log", "debug"],
+			"--log", "debug",
+			"--quiet-period", "0"],
+			False)
+
+	# Nodes drop each other's datagrams, they communicate only through packet_forwarder
+	# (otherwise they would send patches to each other directly, see Communicator)
+	def isolate(self, node1, node2):
+		for node, other in ((node1, node2), (node2, node1)):
+			self.env.run_command(node, ["iptables", "-A", "INPUT", "-p", "udp",
+				"-s", self.env.get_node_ip(other),
+				"--dport", PatchTests.TEST_PORT,
+				"-j", "DROP"])
+
+	# Starts packet_forwarder on node 2, it delays the first skip patches sent to node
+	def start_forwarder(self, node, other, skip):
+		self.isolate(node, other)
+
+		self.env.run_command(2, ["python3", 
+			PatchTests.DTN_SOURCE_DIR + "/test-env/packet_forwarder.py",
+			"-p", PatchTests.TEST_PORT,
+			"-s", self.env.get_node_ip(node),
+			"-f", self.env.get_node_ip(other),
+			"-k", str(skip)],
 			False)
 
 	def write_to_file(self, file, content):
@@ -99,16 +134,14 @@ class PatchTests(AbstractTest):
 		self.env.finish()
 
 	# This test sends patches in this order (from node 0 to node 1):
-	# commit3, commit4, commit1, commit2
+	# commit3, commit1, commit2, commit4
+	#
+	# Node 0 sends queued commit1 and commit2 when node 1 appears, packet_forwarder
+	# holds them until commit3 passes
 	def test3(self):
 		self.init_node(0)
 
-		self.env.run_command(2, ["python3", 
-			PatchTests.DTN_SOURCE_DIR + "/test-env/packet_forwarder.py",
-			"-p", PatchTests.TEST_PORT,
-			"-s", self.env.get_node_ip(1),
-			"-k", "2"],
-			False)
+		self.start_forwarder(1, 0, 2)
 
 		time.sleep(5)
 
@@ -117,7 +150,7 @@ class PatchTests(AbstractTest):
 
 		time.sleep(5)
 		
-		# Get node 1 up - he will receive first two patches from packet_forwarder
+		# Get node 1 up - it will receive first two patches from packet_forwarder
 		self.init_node(1)
 
 		time.sleep(5)
@@ -138,12 +171,7 @@ class PatchTests(AbstractTest):
 
 		self.init_node(1)
 
-		self.env.run_command(2, ["python3", 
-			PatchTests.DTN_SOURCE_DIR + "/test-env/packet_forwarder.py",
-			"-p", PatchTests.TEST_PORT,
-			"-s", self.env.get_node_ip(0),
-			"-k", "4"],
-			False)
+		self.start_forwarder(0, 1, 4)
 
 		time.sleep(5)
 
@@ -172,18 +200,16 @@ class PatchTests(AbstractTest):
 	# node0:
 	# commit1, commit2
 	# node1:
+	# commit3
 	#
+	# packet_forwarder holds commit1 and commit2 (and anti-entropy messages for node 1)
+	# until commit3 is sent to node 0
 	def test5(self):
 		self.setup_dirs()
 
 		self.init_node(0)
 
-		self.env.run_command(2, ["python3", 
-			PatchTests.DTN_SOURCE_DIR + "/test-env/packet_forwarder.py",
-			"-p", PatchTests.TEST_PORT,
-			"-s", self.env.get_node_ip(1),
-			"-k", "2"],
-			False)
+		self.start_forwarder(1, 0, 2)
 
 		time.sleep(5)
 
@@ -0,0 +1,108 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bundles
+
+
+def bundle(n, priority=bundles.DEFAULT_PRIORITY, lifetime=bundles.DEFAULT_LIFETIME, created=None):
+    return bundles.Bundle(bytes([n]) * 16, b"x" * 100, priority, lifetime, created)
+
+
+class BundleQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def queue(self, max_bytes=bundles.DEFAULT_MAX_QUEUE_BYTES):
+        return bundles.BundleQueue(os.path.join(self.directory.name, "bundles.db"), max_bytes)
+
+    def put(self, queue, b):
+        return queue.put(b, b.to_bytes())
+
+    def ids(self, queue):
+        return [id[0] for ids in queue.pending_ids() for id in ids]
+
+    def test_duplicate(self):
+        queue = self.queue()
+        self.assertTrue(self.put(queue, bundle(1)))
+        self.assertFalse(self.put(queue, bundle(1)))
+        self.assertEqual(len(queue), 1)
+
+    def test_lowest_priority_is_evicted_first(self):
+        size = len(bundle(1).to_bytes())
+        queue = self.queue(3 * size)
+
+        self.put(queue, bundle(1, priority=2))
+        self.put(queue, bundle(2, priority=1))
+        self.put(queue, bundle(3, priority=3))
+        self.put(queue, bundle(4, priority=2))
+
+        self.assertEqual(sorted(self.ids(queue)), [1, 3, 4])
+        self.assertEqual(queue.stats()["bytes"], 3 * size)
+
+    def test_bundle_expiring_first_is_evicted_first(self):
+        size = len(bundle(1).to_bytes())
+        queue = self.queue(2 * size)
+
+        self.put(queue, bundle(1, lifetime=300))
+        self.put(queue, bundle(2, lifetime=100))
+        self.put(queue, bundle(3, lifetime=200))
+
+        self.assertEqual(sorted(self.ids(queue)), [1, 3])
+
+    def test_new_bundle_can_be_evicted(self):
+        size = len(bundle(1).to_bytes())
+        queue = self.queue(size)
+
+        self.put(queue, bundle(1, priority=2))
+        self.put(queue, bundle(2, priority=1))
+
+        self.assertEqual(self.ids(queue), [1])
+
+    def test_expire(self):
+        queue = self.queue()
+        now = int(time.time())
+        alive = bundle(2, lifetime=30, created=now - 20)
+        self.put(queue, bundle(1, lifetime=10, created=now - 20))
+        self.put(queue, alive)
+
+        self.assertIsNone(queue.get(bytes([1]) * 16))
+        self.assertEqual(queue.expire(), 1)
+        self.assertEqual(self.ids(queue), [2])
+        self.assertEqual(queue.stats()["bytes"], len(alive.to_bytes()))
+
+    def test_pending_ids(self):
+        queue = self.queue()
+        for n, priority in ((1, 1), (2, 2), (3, 1), (4, 3), (5, 2)):
+            self.put(queue, bundle(n, priority=priority))
+
+        batches = list(queue.pending_ids(batch_size=2))
+        self.assertEqual([[id[0] for id in ids] for ids in batches], [[4, 2], [5, 1], [3]])
+
+    def test_missing(self):
+        queue = self.queue()
+        self.put(queue, bundle(1))
+        self.put(queue, bundle(3))
+
+        ids = [bytes([n]) * 16 for n in range(1, 5)]
+        self.assertEqual(queue.missing(ids), [ids[1], ids[3]])
+        self.assertEqual(queue.get(ids[0]), bundle(1).to_bytes())
+
+
+class BundleIdsTest(unittest.TestCase):
+    def test_roundtrip(self):
+        ids = [bytes([n]) * 16 for n in range(3)]
+
+        self.assertEqual(bundles.BundleOffer.from_bytes(bundles.BundleOffer(ids).to_bytes()).ids, ids)
+        self.assertEqual(bundles.BundleRequest.from_bytes(bundles.BundleRequest([]).to_bytes()).ids, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
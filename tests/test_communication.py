@@ -0,0 +1,259 @@
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bundles
+import communication
+import neighbors
+
+SENDER = bytes(range(16))
+
+
+# Collects datagrams instead of sending them
+class _Socket:
+    def __init__(self):
+        self.datagrams = []
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        datagram = b"".join(bytes(buffer) for buffer in buffers)
+        self.datagrams.append(datagram)
+        return len(datagram)
+
+
+def fragments(data, payload_size=communication.MIN_FRAGMENT_PAYLOAD, node_id=SENDER):
+    sock = _Socket()
+    communication.Fragmenter(node_id, payload_size).send(sock, data, ("127.0.0.1", 0))
+    return sock.datagrams
+
+
+def datagram(length, index, fragments_n, payload=b"", message_id=1):
+    return communication.FRAGMENT_HEADER.pack(communication.FRAGMENT_MAGIC, communication.FRAGMENT_VERSION, 0,
+                                              SENDER, message_id, length, index, fragments_n) + payload
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ReassemblerTest(unittest.TestCase):
+    def test_unfragmented_message(self):
+        reassembler = communication.Reassembler()
+        datagrams = fragments(b"hello")
+
+        self.assertEqual(len(datagrams), 1)
+        sender, message = reassembler.add(datagrams[0])
+        self.assertEqual((sender, bytes(message)), (SENDER, b"hello"))
+
+    def test_fragments_in_any_order(self):
+        data = os.urandom(10 * communication.MIN_FRAGMENT_PAYLOAD + 17)
+        datagrams = fragments(data)
+        random.Random(0).shuffle(datagrams)
+
+        reassembler = communication.Reassembler()
+        results = [reassembler.add(datagram)[1] for datagram in datagrams]
+
+        self.assertTrue(all(result is None for result in results[:-1]))
+        self.assertEqual(bytes(results[-1]), data)
+        self.assertEqual(reassembler.pending_bytes, 0)
+
+    def test_duplicate_fragments(self):
+        data = os.urandom(3 * communication.MIN_FRAGMENT_PAYLOAD)
+        datagrams = fragments(data)
+
+        reassembler = communication.Reassembler()
+        reassembler.add(datagrams[0])
+        reassembler.add(datagrams[0])
+        reassembler.add(datagrams[1])
+        self.assertEqual(bytes(reassembler.add(datagrams[2])[1]), data)
+
+    def test_own_messages_are_dropped(self):
+        reassembler = communication.Reassembler(local_id=SENDER)
+        self.assertEqual(reassembler.add(fragments(b"data")[0]), (SENDER, None))
+
+    def test_fragment_count_is_bounded_by_length(self):
+        reassembler = communication.Reassembler()
+
+        for length, fragments_n in ((1000, 0xffffffff), (1000, 3), (0, 2), (10, 0)):
+            with self.assertRaises(ValueError):
+                reassembler.add(datagram(length, 0, fragments_n, b"x"))
+
+        self.assertEqual(reassembler.pending_bytes, 0)
+        self.assertEqual(len(reassembler.partial), 0)
+
+    def test_pending_bytes_include_fragment_bitmap(self):
+        reassembler = communication.Reassembler()
+        length = 4 * communication.MIN_FRAGMENT_PAYLOAD
+        reassembler.add(datagram(length, 0, 4, bytes(communication.MIN_FRAGMENT_PAYLOAD)))
+
+        self.assertEqual(reassembler.pending_bytes, length + 4)
+
+    def test_oldest_partial_messages_are_dropped(self):
+        length = 4 * communication.MIN_FRAGMENT_PAYLOAD
+        reassembler = communication.Reassembler(max_pending_bytes=2 * (length + 4))
+
+        for message_id in range(3):
+            reassembler.add(datagram(length, 0, 4, bytes(communication.MIN_FRAGMENT_PAYLOAD), message_id))
+
+        self.assertEqual([key[1] for key in reassembler.partial], [1, 2])
+        self.assertEqual(reassembler.pending_bytes, 2 * (length + 4))
+        self.assertEqual(reassembler.dropped_n, 1)
+
+    def test_message_too_big(self):
+        reassembler = communication.Reassembler(max_message_size=1024)
+        with self.assertRaises(ValueError):
+            reassembler.add(datagram(2048, 0, 4, bytes(communication.MIN_FRAGMENT_PAYLOAD)))
+
+    def test_inconsistent_fragment_count(self):
+        reassembler = communication.Reassembler()
+        length = 4 * communication.MIN_FRAGMENT_PAYLOAD
+        reassembler.add(datagram(length, 0, 4, bytes(communication.MIN_FRAGMENT_PAYLOAD)))
+
+        with self.assertRaises(ValueError):
+            reassembler.add(datagram(length, 1, 3, bytes(communication.MIN_FRAGMENT_PAYLOAD)))
+
+    def test_fragment_out_of_bounds(self):
+        reassembler = communication.Reassembler()
+        with self.assertRaises(ValueError):
+            reassembler.add(datagram(1536, 2, 3, bytes(2000)))
+
+    def test_malformed_datagrams(self):
+        reassembler = communication.Reassembler()
+        with self.assertRaises(ValueError):
+            reassembler.add(b"DS")
+        with self.assertRaises(ValueError):
+            reassembler.add(b"XX" + datagram(1, 0, 1, b"x")[2:])
+
+    def test_fragmenter_payload_size(self):
+        with self.assertRaises(ValueError):
+            communication.Fragmenter(SENDER, communication.MIN_FRAGMENT_PAYLOAD - 1)
+
+    def test_rate_is_shared_by_threads(self):
+        fragmenter = communication.Fragmenter(SENDER, max_rate=1024 * 1024)
+        data = bytes(128 * 1024)
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=fragmenter.send, args=(_Socket(), data, ("127.0.0.1", 0)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 512 KiB (and headers) at 1 MiB/s, the first datagram is sent right away
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+
+class CommunicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.controls = []
+        self.received = threading.Event()
+
+        self.port = free_port()
+        self.comm = communication.Communicator(self.port, lambda data: None,
+                                               os.path.join(self.directory.name, "bundles.db"),
+                                               on_control_callback=self.on_control, broadcast_address="127.0.0.1")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sock.close()
+        self.comm.stop()
+        self.directory.cleanup()
+
+    def on_control(self, message, address):
+        message = bytes(message)
+        self.controls.append(message)
+        if message == b"\xffraise":
+            raise Exception("Failed to handle the message")
+        self.received.set()
+
+    def send(self, data):
+        communication.Fragmenter(SENDER).send(self.sock, data, ("127.0.0.1", self.port))
+
+    # Large messages are sent through a node's Communicator (paced by default)
+    def test_large_message(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sender = communication.Communicator(free_port(), lambda data: None,
+                                                os.path.join(directory, "bundles.db"),
+                                                broadcast_address="127.0.0.2")
+
+            # All nodes use the same port, here the receiver listens on a different one
+            sender.port = self.port
+            try:
+                data = b"\xff" + os.urandom(16 * 1024 * 1024)
+                sender.send_control(data, "127.0.0.1")
+
+                self.assertTrue(self.received.wait(10))
+                self.assertEqual(self.controls, [data])
+            finally:
+                sender.stop()
+
+    def test_bad_messages_do_not_stop_listening(self):
+        self.send(b"")
+        self.send(b"\xffraise")
+        self.send(b"\xffcontrol")
+
+        self.assertTrue(self.received.wait(5))
+        self.assertEqual(self.controls, [b"\xffraise", b"\xffcontrol"])
+
+
+# Two nodes on one host, each one sends to the port of the other one
+class ForwardTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.beacon_interval = neighbors.BEACON_INTERVAL
+        neighbors.BEACON_INTERVAL = 0.1
+
+        self.received = []
+        self.all_received = threading.Event()
+        self.nodes = []
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.stop()
+        neighbors.BEACON_INTERVAL = self.beacon_interval
+        self.directory.cleanup()
+
+    # Payloads of bundles are their ids
+    def on_receive(self, data):
+        self.received.append(bytes(data))
+        if len(self.received) == 2:
+            self.all_received.set()
+
+    def node(self, name, port, ids, on_receive=lambda data: None):
+        path = os.path.join(self.directory.name, name + ".db")
+        queue = bundles.BundleQueue(path)
+        for id in ids:
+            bundle = bundles.Bundle(id, id)
+            queue.put(bundle, bundle.to_bytes())
+
+        node = communication.Communicator(port, on_receive, path, broadcast_address="127.0.0.1",
+                                          summary=lambda: name.encode() * 16)
+        self.nodes.append(node)
+        return node
+
+    def test_only_missing_bundles_are_sent(self):
+        ids = [bytes([n]) * 16 for n in range(3)]
+        ports = free_port(), free_port()
+
+        sender = self.node("a", ports[0], ids)
+        receiver = self.node("b", ports[1], ids[1:2], self.on_receive)
+        sender.port, receiver.port = ports[1], ports[0]
+
+        self.assertTrue(self.all_received.wait(10))
+        self.assertEqual(sorted(self.received), [ids[0], ids[2]])
+        self.assertEqual(receiver.duplicates_n, 0)
+        self.assertEqual(len(receiver.queue), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
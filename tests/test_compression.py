@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import compression
+
+
+class DecompressTest(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(1000) * 20
+
+    def test_roundtrip(self):
+        for codec, (_, compress, _) in compression.CODECS.items():
+            self.assertEqual(compression.decompress(codec, memoryview(compress(self.data))), self.data)
+
+        self.assertEqual(compression.decompress(compression.NONE, self.data), self.data)
+
+    def test_output_is_bounded(self):
+        for codec, (name, compress, _) in compression.CODECS.items():
+            compressed = compress(self.data)
+            self.assertEqual(compression.decompress(codec, compressed, len(self.data)), self.data)
+
+            with self.assertRaises(ValueError, msg=name):
+                compression.decompress(codec, compressed, len(self.data) - 1)
+
+    def test_truncated(self):
+        for codec, (name, compress, _) in compression.CODECS.items():
+            with self.assertRaises(ValueError, msg=name):
+                compression.decompress(codec, compress(self.data)[:100])
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            compression.decompress(0xff, b"data")
+
+
+class AdaptiveCompressorTest(unittest.TestCase):
+    def test_compressible_delta(self):
+        compressor = compression.AdaptiveCompressor()
+        data = b"line of text\n" * 1000
+
+        codec, compressed = compressor.compress("file.txt", data)
+        self.assertNotEqual(codec, compression.NONE)
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(compressor.decompress("file.txt", codec, compressed), data)
+
+    def test_small_and_incompressible_deltas(self):
+        compressor = compression.AdaptiveCompressor()
+        for data in (b"x" * (compression.MIN_COMPRESSED_SIZE - 1), os.urandom(10000)):
+            self.assertEqual(compressor.compress("file.bin", data), (compression.NONE, data))
+
+    def test_none_mode(self):
+        compressor = compression.AdaptiveCompressor.create("none")
+        data = b"x" * 10000
+        self.assertEqual(compressor.compress("file.txt", data), (compression.NONE, data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import merge
+
+BASE = b"".join(b"line %d\n" % i for i in range(100))
+
+
+def replace_line(content, n, line):
+    lines = content.splitlines(True)
+    lines[n] = line
+    return b"".join(lines)
+
+
+class MergeTest(unittest.TestCase):
+    def test_unchanged_sides(self):
+        changed = replace_line(BASE, 3, b"changed\n")
+
+        self.assertEqual(merge.merge(BASE, changed, changed), changed)
+        self.assertEqual(merge.merge(BASE, changed, BASE), changed)
+        self.assertEqual(merge.merge(BASE, BASE, changed), changed)
+
+    def test_appended_lines(self):
+        self.assertEqual(merge.merge(BASE, BASE + b"x\n", BASE + b"y\n"), BASE + b"x\ny\n")
+
+    def test_lines_appended_on_both_sides_are_kept_once(self):
+        self.assertEqual(merge.merge(BASE, BASE + b"a\nx\n", BASE + b"a\ny\n"), BASE + b"a\nx\ny\n")
+
+    def test_disjoint_regions(self):
+        x = replace_line(BASE, 10, b"x\n")
+        y = replace_line(BASE, 90, b"y\n")
+        expected = replace_line(x, 90, b"y\n")
+
+        self.assertEqual(merge.merge(BASE, x, y), expected)
+        self.assertEqual(merge.merge(BASE, y, x), expected)
+
+    def test_lines_within_overlapping_regions(self):
+        # Each side changes two distant lines, the regions overlap but the lines do not
+        x = replace_line(replace_line(BASE, 10, b"x\n"), 50, b"x\n")
+        y = replace_line(replace_line(BASE, 30, b"y\n"), 70, b"y\n")
+
+        self.assertEqual(merge.merge(BASE, x, y), replace_line(replace_line(x, 30, b"y\n"), 70, b"y\n"))
+
+    def test_same_line_changed(self):
+        self.assertIsNone(merge.merge(BASE, replace_line(BASE, 10, b"x\n"), replace_line(BASE, 10, b"y\n")))
+
+    def test_adjacent_lines_changed(self):
+        self.assertIsNone(merge.merge(BASE, replace_line(BASE, 10, b"x\n"), replace_line(BASE, 11, b"y\n")))
+
+    def test_binary(self):
+        self.assertIsNone(merge.merge(b"\0" + BASE, b"\0x" + BASE, b"\0" + BASE + b"y"))
+
+    def test_too_many_lines(self):
+        base = b"".join(b"%d\n" % i for i in range(merge.MAX_DIFF_LINES + 1))
+        x = replace_line(replace_line(base, 0, b"x\n"), merge.MAX_DIFF_LINES, b"x\n")
+        y = replace_line(base, 100, b"y\n")
+
+        self.assertIsNone(merge.merge(base, x, y))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+try:
+    import monitor
+except ImportError:
+    monitor = None
+
+# How long to wait for inotify events
+TIMEOUT = 5.0
+
+
+class _Callback:
+    def __init__(self):
+        self.updated = set()
+
+    def file_updated(self, path):
+        self.updated.add(path)
+
+
+@unittest.skipIf(monitor is None, "pyinotify is not installed")
+class MonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        self.callback = _Callback()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(b"data")
+
+    def test_directory_created_in_place_of_moved_directory(self):
+        old, new = os.path.join(self.root, "old"), os.path.join(self.root, "new")
+        os.makedirs(os.path.join(old, "sub"))
+
+        files_monitor = monitor.Monitor(self.root, self.callback, quiet_period=0)
+        watcher = files_monitor.files_watcher
+        try:
+            os.rename(old, new)
+            self.wait_for(lambda: new in watcher.wds and old not in watcher.wds)
+            self.assertNotIn(os.path.join(old, "sub"), watcher.wds)
+
+            os.makedirs(os.path.join(old, "sub"))
+            self.wait_for(lambda: os.path.join(old, "sub") in watcher.wds)
+
+            for path in (os.path.join(old, "sub", "file"), os.path.join(new, "sub", "file")):
+                self.write(path)
+                self.wait_for(lambda: path in self.callback.updated)
+        finally:
+            files_monitor.stop()
+
+    def test_directory_moved_out(self):
+        with tempfile.TemporaryDirectory() as outside:
+            directory = os.path.join(self.root, "directory")
+            os.mkdir(directory)
+
+            files_monitor = monitor.Monitor(self.root, self.callback, quiet_period=0)
+            watcher = files_monitor.files_watcher
+            try:
+                os.rename(directory, os.path.join(outside, "directory"))
+                self.wait_for(lambda: directory not in watcher.wds)
+
+                self.write(os.path.join(outside, "directory", "file"))
+                self.write(os.path.join(self.root, "file"))
+                self.wait_for(lambda: os.path.join(self.root, "file") in self.callback.updated)
+                self.assertNotIn(os.path.join(directory, "file"), self.callback.updated)
+            finally:
+                files_monitor.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
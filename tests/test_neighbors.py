@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import neighbors
+
+
+def beacon(n, capabilities):
+    return neighbors.Beacon(bytes([n]) * 16, capabilities, bytes(16))
+
+
+class NeighborTableTest(unittest.TestCase):
+    def test_expire(self):
+        table = neighbors.NeighborTable(timeout=10)
+        table.update(beacon(1, 0), "10.0.0.1", now=0)
+        table.update(beacon(2, 0), "10.0.0.2", now=5)
+
+        self.assertEqual([neighbor.address for neighbor in table.expire(now=12)], ["10.0.0.1"])
+        self.assertEqual([neighbor.address for neighbor in table.alive(now=12)], ["10.0.0.2"])
+
+    def test_capable(self):
+        table = neighbors.NeighborTable(timeout=10)
+        compression = neighbors.CAPABILITY_COMPRESSION
+
+        self.assertTrue(table.capable(compression, now=0))
+        self.assertFalse(table.capable(compression, "10.0.0.1", now=0))
+
+        table.update(beacon(1, compression | neighbors.CAPABILITY_CUSTODY), "10.0.0.1", now=0)
+        table.update(beacon(2, neighbors.CAPABILITY_CUSTODY), "10.0.0.2", now=0)
+
+        self.assertTrue(table.capable(compression, "10.0.0.1", now=0))
+        self.assertFalse(table.capable(compression, "10.0.0.2", now=0))
+        self.assertFalse(table.capable(compression, now=0))
+
+        # Neighbor without compression timed out
+        table.update(beacon(1, compression), "10.0.0.1", now=8)
+        self.assertTrue(table.capable(compression, now=15))
+
+
+if __name__ == '__main__':
+    unittest.main()
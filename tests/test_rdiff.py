@@ -0,0 +1,299 @@
+import os
+import random
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rdiff
+
+# Signature of an empty file written by librsync's rdiff (MD4, block 2048, strong sum 8)
+RDIFF_EMPTY_SIGNATURE = b'rs\x016\x00\x00\x08\x00\x00\x00\x00\x08'
+
+
+class NativeBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = rdiff.NativeBackend(block_len=64)
+        self.rnd = random.Random(0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def random_bytes(self, n):
+        return bytes(self.rnd.getrandbits(8) for _ in range(n))
+
+    def roundtrip(self, old, new):
+        basis = self.write("basis", old)
+        changed = self.write("changed", new)
+        out = os.path.join(self.directory.name, "out")
+
+        delta = self.backend.delta(self.backend.signature(basis), changed)
+        self.backend.patch(basis, delta, out)
+        self.assertEqual(self.read(out), new)
+
+        return delta
+
+    def test_signature_header(self):
+        path = self.write("file", self.random_bytes(200))
+        signature = self.backend.signature(path)
+
+        self.assertEqual(struct.unpack_from(">III", signature), (rdiff.BLAKE2_SIG_MAGIC, 64, rdiff.DEFAULT_STRONG_LEN))
+        # 4 blocks (the last one is shorter), weak and strong sum of each
+        self.assertEqual(len(signature), 12 + 4 * (4 + rdiff.DEFAULT_STRONG_LEN))
+
+    def test_literal_delta_format(self):
+        path = self.write("file", b"abc")
+        delta = self.backend.delta(RDIFF_EMPTY_SIGNATURE, path)
+
+        self.assertEqual(delta, b"rs\x026\x03abc\x00")
+
+    def test_unchanged_file_is_copied(self):
+        content = self.random_bytes(1000)
+        delta = self.roundtrip(content, content)
+
+        self.assertEqual(list(rdiff.parse_delta(delta)), [("copy", 0, len(content))])
+
+    def test_roundtrip(self):
+        old = self.random_bytes(5000)
+        for new in (b"", old[:100], old + self.random_bytes(10), self.random_bytes(7) + old,
+                    old[:2000] + self.random_bytes(300) + old[2100:], old[3000:] + old[:3000]):
+            self.roundtrip(old, new)
+
+    def test_rabinkarp_signature(self):
+        old = self.random_bytes(1000)
+        blocks = [old[i:i + 64] for i in range(0, len(old), 64)]
+        signature = struct.pack(">III", rdiff.RK_BLAKE2_SIG_MAGIC, 64, 8) + b"".join(
+            struct.pack(">I", rdiff.rabinkarp(block)) + rdiff._blake2_sum(block)[:8] for block in blocks)
+
+        new = self.random_bytes(5) + old
+        delta = self.backend.delta(signature, self.write("changed", new))
+        self.assertIn(("copy", 0, len(old)), list(rdiff.parse_delta(delta)))
+
+    def test_update_signature(self):
+        old = self.random_bytes(5000)
+        basis = self.write("basis", old)
+        signature = self.backend.signature(basis)
+
+        for new in (old + self.random_bytes(100), old[:640] + self.random_bytes(64) + old[704:],
+                    self.random_bytes(3) + old, old[:1000]):
+            changed = self.write("changed", new)
+            delta = self.backend.delta(signature, changed)
+
+            self.assertEqual(self.backend.update_signature(signature, delta, changed), self.backend.signature(changed))
+
+    def test_update_signature_rejects_foreign_signature(self):
+        path = self.write("file", b"data")
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            self.backend.update_signature(RDIFF_EMPTY_SIGNATURE, b"rs\x026\x04data\x00", path)
+
+    def test_patch_rejects_copy_beyond_basis(self):
+        basis = self.write("basis", b"x" * 10)
+        delta = b"rs\x026" + bytes((rdiff.OP_COPY_N1_N1, 5, 10, rdiff.OP_END))
+
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            self.backend.patch(basis, delta, os.path.join(self.directory.name, "out"))
+
+
+class ComposeDeltasTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = rdiff.NativeBackend(block_len=64)
+        self.rnd = random.Random(0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'wb') as f:
+            f.write(content)
+        return self.path(name)
+
+    def random_bytes(self, n):
+        return bytes(self.rnd.getrandbits(8) for _ in range(n))
+
+    # Deltas between consecutive versions
+    def deltas(self, versions):
+        result = []
+        for old, new in zip(versions, versions[1:]):
+            signature = self.backend.signature(self.write("old", old))
+            result.append(self.backend.delta(signature, self.write("new", new)))
+        return result
+
+    def test_composed_delta_gives_last_version(self):
+        v0 = self.random_bytes(3000)
+        v1 = v0[:1000] + self.random_bytes(200) + v0[1000:]
+        v2 = self.random_bytes(50) + v1[:2500] + v1[2600:]
+        v3 = v2[1500:] + v2[:1500] + self.random_bytes(10)
+        versions = [v0, v1, v2, v3]
+
+        basis = self.write("basis", v0)
+        for n in range(2, len(versions) + 1):
+            delta = rdiff.compose_deltas(self.deltas(versions[:n]))
+            self.backend.patch(basis, delta, self.path("out"))
+
+            with open(self.path("out"), 'rb') as f:
+                self.assertEqual(f.read(), versions[n - 1])
+
+    def test_single_delta(self):
+        delta = self.deltas([b"a" * 100, b"b" * 100])[0]
+        self.assertEqual(rdiff.compose_deltas([delta]), delta)
+
+    def test_copies_refer_to_first_basis(self):
+        v0 = self.random_bytes(640)
+        delta = rdiff.compose_deltas(self.deltas([v0, v0 + b"x", v0]))
+
+        commands = list(rdiff.parse_delta(delta))
+        self.assertTrue(all(command[0] == "copy" for command in commands))
+        self.assertEqual(sum(command[2] for command in commands), len(v0))
+
+    def test_copy_beyond_previous_result(self):
+        first = b"rs\x026\x03abc\x00"
+        second = b"rs\x026" + bytes((rdiff.OP_COPY_N1_N1, 1, 3, rdiff.OP_END))
+
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            rdiff.compose_deltas([first, second])
+
+
+class _RecordingBackend:
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+
+    def signature(self, file):
+        self.calls.append("signature")
+        return b""
+
+    def delta(self, signature, file):
+        self.calls.append("delta")
+        return b""
+
+    def patch(self, file, delta, new_file):
+        self.calls.append("patch")
+
+    def update_signature(self, signature, delta, file):
+        self.calls.append("update_signature")
+        return b""
+
+
+class SizeBackendTest(unittest.TestCase):
+    def test_dispatch_by_file_size(self):
+        small, large = _RecordingBackend("small"), _RecordingBackend("large")
+        backend = rdiff.SizeBackend(small, large, max_size=10)
+
+        with tempfile.TemporaryDirectory() as directory:
+            small_file, large_file = os.path.join(directory, "small"), os.path.join(directory, "large")
+            with open(small_file, 'wb') as f:
+                f.write(b"x" * 10)
+            with open(large_file, 'wb') as f:
+                f.write(b"x" * 11)
+
+            for file in (small_file, large_file):
+                backend.signature(file)
+                backend.delta(b"", file)
+                backend.update_signature(b"", b"", file)
+                backend.patch(file, b"", os.path.join(directory, "out"))
+
+        self.assertEqual(small.calls, ["signature", "delta", "update_signature", "patch", "patch"])
+        self.assertEqual(large.calls, ["signature", "delta", "update_signature"])
+
+    def test_auto_backend(self):
+        backend = rdiff.create_backend("auto")
+        if rdiff.shutil.which("rdiff") is None:
+            self.assertIsInstance(backend, rdiff.NativeBackend)
+        else:
+            self.assertIsInstance(backend, rdiff.SizeBackend)
+
+
+class ProcessBackendTest(unittest.TestCase):
+    def test_same_results_as_native(self):
+        native = rdiff.NativeBackend()
+        backend = rdiff.ProcessBackend(2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            basis, changed = os.path.join(directory, "basis"), os.path.join(directory, "changed")
+            content = os.urandom(100 * 1024)
+            with open(basis, 'wb') as f:
+                f.write(content)
+            with open(changed, 'wb') as f:
+                f.write(content[:5000] + os.urandom(100) + content[5000:])
+
+            try:
+                signature = backend.signature(basis)
+                self.assertEqual(signature, native.signature(basis))
+
+                delta = backend.delta(memoryview(signature), changed)
+                self.assertEqual(delta, native.delta(signature, changed))
+                self.assertEqual(backend.update_signature(signature, delta, changed), native.signature(changed))
+
+                with self.assertRaises(rdiff.UnsupportedFormat):
+                    backend.delta(b"rs\x01\x00", changed)
+            finally:
+                backend.close()
+
+
+class SignatureValidationTest(unittest.TestCase):
+    def test_empty_signature(self):
+        signature = rdiff.Signature.parse(RDIFF_EMPTY_SIGNATURE)
+        self.assertEqual((signature.block_len, signature.strong_len, signature.blocks_n), (2048, 8, 0))
+
+    def test_zero_block_length(self):
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            rdiff.Signature.parse(struct.pack(">III", rdiff.BLAKE2_SIG_MAGIC, 0, 8) + bytes(12))
+
+    def test_strong_length(self):
+        for magic, strong_len in ((rdiff.BLAKE2_SIG_MAGIC, 0), (rdiff.BLAKE2_SIG_MAGIC, rdiff.BLAKE2_SUM_LEN + 1),
+                                  (rdiff.MD4_SIG_MAGIC, rdiff.MD4_SUM_LEN + 1)):
+            with self.assertRaises(rdiff.UnsupportedFormat):
+                rdiff.Signature.parse(struct.pack(">III", magic, 2048, strong_len))
+
+    def test_unknown_magic(self):
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            rdiff.Signature.parse(struct.pack(">III", 0x12345678, 2048, 8))
+
+    def test_truncated(self):
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            rdiff.Signature.parse(b"rs\x017")
+
+
+class DeltaFormatTest(unittest.TestCase):
+    def test_not_a_delta(self):
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            list(rdiff.parse_delta(b"xxxx\x00"))
+
+    def test_truncated_delta(self):
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            list(rdiff.parse_delta(b"rs\x026\x03abc"))
+
+    def test_unknown_opcode(self):
+        with self.assertRaises(rdiff.UnsupportedFormat):
+            list(rdiff.parse_delta(b"rs\x026\x60\x00"))
+
+    def test_large_literal_and_copy(self):
+        writer = rdiff._DeltaWriter()
+        writer.literal(b"y" * 300)
+        writer.copy(1 << 33, 5)
+        delta = writer.finish()
+
+        self.assertEqual([(command[0], bytes(command[1]) if command[0] == "literal" else command[1:])
+                          for command in rdiff.parse_delta(delta)],
+                         [("literal", b"y" * 300), ("copy", (1 << 33, 5))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+import io
+import os
+import pickle
+import sys
+import unittest
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import compression
+import vcs
+from serialization import Reader, SerializationError, Serializable, Writer
+
+
+def commit(author=None):
+    result = vcs.Commit()
+    result.id = uuid.uuid4()
+    result.author = author if author is not None else uuid.uuid4()
+    return result
+
+
+def history(commits_n):
+    result = vcs.VersionHistory()
+    for i in range(commits_n):
+        result.append(commit(), b"signature%d" % i)
+    return result
+
+
+def history_head(commits):
+    chain = vcs.EMPTY_CHAIN
+    for c in commits:
+        chain = vcs.chain_digest(chain, c)
+    return chain
+
+
+# Pickle of a history as written by older versions (all commits and signatures)
+def legacy_history(commits):
+    old = vcs.VersionHistory.__new__(vcs.VersionHistory)
+    old.__dict__ = {"commits": commits, "signatures": [b"signature%d" % i for i in range(len(commits))]}
+    return pickle.dumps(old, protocol=3)
+
+
+class WriterReaderTest(unittest.TestCase):
+    def test_primitives(self):
+        writer = Writer()
+        for value in (0, 1, 0x7f, 0x80, 1 << 40):
+            writer.write_varint(value)
+        writer.write_bytes(b"bytes")
+        writer.write_optional_bytes(None)
+        writer.write_optional_bytes(b"")
+        writer.write_fixed_array([b"ab", b"cd"])
+        writer.write_str("žluťoučký")
+
+        reader = Reader(writer.getvalue())
+        self.assertEqual([reader.read_varint() for _ in range(5)], [0, 1, 0x7f, 0x80, 1 << 40])
+        self.assertEqual(reader.read_bytes(), b"bytes")
+        self.assertIsNone(reader.read_optional_bytes())
+        self.assertEqual(reader.read_optional_bytes(), b"")
+        self.assertEqual(reader.read_fixed_array(2), [b"ab", b"cd"])
+        self.assertEqual(reader.read_str(), "žluťoučký")
+        self.assertTrue(reader.at_end())
+
+    def test_negative_varint(self):
+        with self.assertRaises(SerializationError):
+            Writer().write_varint(-1)
+
+    def test_truncated(self):
+        writer = Writer()
+        writer.write_bytes(b"bytes")
+
+        with self.assertRaises(SerializationError):
+            Reader(writer.getvalue()[:-1]).read_bytes()
+
+
+class SchemaTest(unittest.TestCase):
+    def test_history_roundtrip(self):
+        original = history(5)
+        decoded = vcs.VersionHistory.from_bytes(original.to_bytes())
+
+        self.assertEqual(decoded.length, 5)
+        self.assertEqual(decoded.chains, original.chains)
+        self.assertEqual(decoded.signatures, original.signatures)
+        self.assertEqual([c.id for c in decoded.commits], [c.id for c in original.commits])
+
+    def test_unknown_trailing_fields_are_ignored(self):
+        record = vcs.HistoryRecord(vcs.HistoryRecord.TRUNCATE, commits_n=3)
+        writer = Writer()
+        record.encode(writer)
+        writer.write_bytes(b"field of a newer schema")
+        body = writer.getvalue()
+
+        data = bytes((vcs.HistoryRecord.TYPE_ID, vcs.HistoryRecord.SCHEMA_VERSION + 1, len(body))) + body
+        decoded = vcs.HistoryRecord.from_bytes(data)
+        self.assertEqual((decoded.operation, decoded.commits_n), (vcs.HistoryRecord.TRUNCATE, 3))
+
+    def test_unknown_type(self):
+        with self.assertRaises(SerializationError):
+            Serializable.from_bytes(bytes((0xff, 1, 0)))
+
+    def test_unexpected_type(self):
+        with self.assertRaises(SerializationError):
+            vcs.FilePatch.from_bytes(history(1).to_bytes())
+
+    def test_patch_roundtrip(self):
+        patch = vcs.FilePatch()
+        patch.relative_path = "directory/file"
+        patch.parent_length = 7
+        patch.parent_chain = bytes(range(16))
+        patch.commits = [commit(), commit()]
+        patch.delta = b"delta"
+        patch.content_hash = b"hash"
+
+        decoded = vcs.FilePatch.from_bytes(patch.to_bytes())
+        self.assertEqual((decoded.relative_path, decoded.parent_length, decoded.parent_chain),
+                         ("directory/file", 7, bytes(range(16))))
+        self.assertEqual([c.id for c in decoded.commits], [c.id for c in patch.commits])
+        self.assertEqual((bytes(decoded.delta), decoded.compression, decoded.content_hash),
+                         (b"delta", compression.NONE, b"hash"))
+        self.assertEqual(decoded.head_chain(), patch.head_chain())
+
+    def test_compressed_patch(self):
+        patch = vcs.FilePatch()
+        patch.relative_path = "file"
+        patch.commits = [commit()]
+        patch.delta = compression.CODECS[compression.ZLIB][1](b"delta" * 100)
+        patch.compression = compression.ZLIB
+
+        data = patch.to_bytes()
+        # Nodes which do not know compression do not know this type
+        self.assertEqual(data[0], vcs.CompressedFilePatch.TYPE_ID)
+
+        decoded = vcs.FilePatch.from_bytes(data)
+        self.assertIsInstance(decoded, vcs.FilePatch)
+        self.assertEqual((decoded.compression, bytes(decoded.delta)), (compression.ZLIB, patch.delta))
+
+        patch.compression, patch.delta = compression.NONE, b"delta"
+        self.assertEqual(patch.to_bytes()[0], vcs.FilePatch.TYPE_ID)
+
+    # Author is sent as node id, it cannot be an arbitrary string (e.g. a path)
+    def test_commit_author_is_node_id(self):
+        original = commit()
+        data = original.to_bytes()
+
+        self.assertEqual(len(data), 3 + 32)
+        decoded = vcs.Commit.from_bytes(data)
+        self.assertEqual((decoded.id, decoded.author), (original.id, original.author))
+
+    def test_duplicate_type_id(self):
+        with self.assertRaises(SerializationError):
+            class Duplicate(Serializable):
+                TYPE_ID = vcs.Commit.TYPE_ID
+                SCHEMA_VERSION = 1
+
+
+class LegacyTest(unittest.TestCase):
+    def test_pickles_are_rejected(self):
+        data = legacy_history([commit()])
+
+        with self.assertRaises(SerializationError):
+            vcs.VersionHistory.from_bytes(data)
+        with self.assertRaises(SerializationError):
+            Serializable.from_bytes(data)
+
+    def test_stored_legacy_history(self):
+        commits = [commit() for _ in range(3)]
+        loaded = vcs.VersionHistory.from_stored_bytes(legacy_history(commits))
+
+        self.assertEqual(loaded.length, 3)
+        self.assertEqual(loaded.head(), history_head(commits))
+        self.assertEqual(loaded.position(loaded.head()), 3)
+
+        # Migrated history is written in the binary format
+        self.assertEqual(vcs.VersionHistory.from_bytes(loaded.to_bytes()).head(), loaded.head())
+
+    def test_stored_legacy_authors(self):
+        commits = [commit(), commit()]
+        for c, hostname in zip(commits, ("host1", "host2")):
+            c.author = hostname
+        loaded = vcs.VersionHistory.from_stored_bytes(legacy_history(commits))
+
+        authors = [c.author for c in loaded.commits]
+        self.assertEqual(authors, [uuid.uuid5(uuid.NAMESPACE_DNS, "host1"), uuid.uuid5(uuid.NAMESPACE_DNS, "host2")])
+        self.assertEqual([c.author for c in vcs.VersionHistory.from_bytes(loaded.to_bytes()).commits], authors)
+
+    def test_stored_binary_history(self):
+        original = history(2)
+        self.assertEqual(vcs.VersionHistory.from_stored_bytes(original.to_bytes()).head(), original.head())
+
+    def test_forbidden_global(self):
+        with self.assertRaises(pickle.UnpicklingError):
+            vcs.VersionHistory.from_stored_bytes(pickle.dumps(io.BytesIO(), protocol=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
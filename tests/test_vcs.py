@@ -0,0 +1,355 @@
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rdiff
+import vcs
+
+
+def commit():
+    result = vcs.Commit()
+    result.id = uuid.uuid4()
+    result.author = uuid.uuid4()
+    return result
+
+
+class VersionHistoryTest(unittest.TestCase):
+    def test_has_commit(self):
+        history = vcs.VersionHistory()
+        commits = [commit() for _ in range(vcs.COMMITS_RETENTION + 10)]
+        for c in commits:
+            history.append(c, None)
+
+        # Pruned commits are not known
+        self.assertFalse(history.has_commit(commits[9].id))
+        self.assertTrue(history.has_commit(commits[10].id))
+        self.assertTrue(history.has_commit(commits[-1].id))
+
+        history.truncate(history.length - 1)
+        self.assertFalse(history.has_commit(commits[-1].id))
+        self.assertTrue(history.has_commit(commits[-2].id))
+
+        decoded = vcs.VersionHistory.from_bytes(history.to_bytes())
+        self.assertTrue(decoded.has_commit(commits[-2].id))
+        self.assertFalse(decoded.has_commit(commits[9].id))
+
+        history.rebase(5, bytes(16))
+        self.assertFalse(history.has_commit(commits[-2].id))
+
+
+# Two synchronized directories, patches are passed between them directly
+class TwoNodesTest(unittest.TestCase):
+    MERGE_MAX_BYTES = vcs.DEFAULT_MERGE_MAX_BYTES
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local = self.node("local")
+        self.remote = self.node("remote")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def node(self, name):
+        directory = os.path.join(self.directory.name, name)
+        os.makedirs(directory)
+        return vcs.VCS(directory, merge_max_bytes=self.MERGE_MAX_BYTES)
+
+    def write(self, node, path, content):
+        with open(os.path.join(node.directory, path), 'w') as f:
+            f.write(content)
+
+    def read(self, node, path):
+        with open(os.path.join(node.directory, path)) as f:
+            return f.read()
+
+    def files(self, node):
+        return sorted(name for name in os.listdir(node.directory) if name != ".sync")
+
+    def commit(self, node, path, content):
+        self.write(node, path, content)
+        with node.file_version_control(path) as file_vcs:
+            return file_vcs.commit()
+
+    # Patch is passed as it would be sent, returns patches of merges it caused
+    def apply(self, node, *patches):
+        patches = [vcs.FilePatch.from_bytes(patch.to_bytes()) for patch in patches]
+        with node.file_version_control(patches[0].relative_path) as file_vcs:
+            file_vcs.apply_patches(patches)
+        return file_vcs.merge_patches
+
+    def variant(self, path, node):
+        return path + vcs.node_name(node.store.node_id)
+
+    # Both nodes change the file after the remote node's common version, returns their patches
+    def diverge(self, path, common, local, remote):
+        self.apply(self.local, self.commit(self.remote, path, common))
+
+        return self.commit(self.local, path, local), self.commit(self.remote, path, remote)
+
+    def head(self, node, path):
+        with node.file_version_control(path) as file_vcs:
+            return file_vcs.version_history.head()
+
+
+# Text file whose local and remote changes are far apart (in different delta blocks)
+LINES = ["line %d\n" % i for i in range(1000)]
+COMMON = "".join(LINES)
+LOCAL = "changed locally\n" + "".join(LINES[1:])
+REMOTE = "".join(LINES[:500]) + "changed remotely\n" + "".join(LINES[501:])
+MERGED = "changed locally\n" + "".join(LINES[1:500]) + "changed remotely\n" + "".join(LINES[501:])
+
+
+
+def replace_line(content, n, line):
+    lines = content.splitlines(True)
+    lines[n] = line
+    return "".join(lines)
+
+
+class PatchesTest(TwoNodesTest):
+    def test_fast_forward(self):
+        self.apply(self.local, self.commit(self.remote, "file", COMMON))
+        self.apply(self.local, self.commit(self.remote, "file", REMOTE))
+
+        self.assertEqual(self.read(self.local, "file"), REMOTE)
+        self.assertEqual(self.head(self.local, "file"), self.head(self.remote, "file"))
+
+    def test_duplicate(self):
+        patch = self.commit(self.remote, "file", COMMON)
+        self.apply(self.local, patch)
+        self.apply(self.local, patch)
+
+        self.assertEqual(self.read(self.local, "file"), COMMON)
+        self.assertEqual(self.head(self.local, "file"), patch.head_chain())
+
+    def test_out_of_order(self):
+        patches = [self.commit(self.remote, "file", content) for content in (COMMON, REMOTE, MERGED)]
+
+        self.apply(self.local, patches[2])
+        self.apply(self.local, patches[1])
+        self.assertEqual(self.read(self.local, "file"), "")
+
+        self.apply(self.local, patches[0])
+        self.assertEqual(self.read(self.local, "file"), MERGED)
+        self.assertEqual(self.head(self.local, "file"), patches[2].head_chain())
+
+
+class MergeTest(TwoNodesTest):
+    def test_concurrent_changes_are_merged(self):
+        local_patch, remote_patch = self.diverge("file", COMMON, LOCAL, REMOTE)
+
+        self.apply(self.local, remote_patch)
+        self.apply(self.remote, local_patch)
+
+        self.assertEqual(self.files(self.local), ["file"])
+        self.assertEqual(self.read(self.local, "file"), MERGED)
+        self.assertEqual(self.read(self.remote, "file"), MERGED)
+        self.assertEqual(self.head(self.local, "file"), self.head(self.remote, "file"))
+
+    def test_merges_of_other_changes_converge(self):
+        # Local node merges the first remote change and commits on the merge, the remote
+        # node merges the local change with both of its changes
+        local_patch, remote_patch = self.diverge("file", COMMON, LOCAL, REMOTE)
+        second_remote_patch = self.commit(self.remote, "file", replace_line(REMOTE, 700, "changed remotely again\n"))
+
+        local_merges = self.apply(self.local, remote_patch)
+        second_local_patch = self.commit(self.local, "file", replace_line(MERGED, 300, "changed locally again\n"))
+        remote_merges = self.apply(self.remote, local_patch)
+
+        sent = {self.local: [second_remote_patch] + remote_merges, self.remote: [second_local_patch] + local_merges}
+        while sent[self.local] or sent[self.remote]:
+            for node, other in ((self.local, self.remote), (self.remote, self.local)):
+                if sent[node]:
+                    sent[other].extend(self.apply(node, sent[node].pop(0)))
+
+        expected = replace_line(replace_line(MERGED, 300, "changed locally again\n"), 700, "changed remotely again\n")
+        for node in (self.local, self.remote):
+            self.assertEqual(self.files(node), ["file"])
+            self.assertEqual(self.read(node, "file"), expected)
+            self.assertEqual(node.store.paths_with_waiting_patches(), [])
+        self.assertEqual(self.head(self.local, "file"), self.head(self.remote, "file"))
+
+    def test_overlapping_changes_split_file(self):
+        _, remote_patch = self.diverge("file", COMMON, "local\n" + COMMON, "remote\n" + COMMON)
+        self.apply(self.local, remote_patch)
+
+        self.assertEqual(self.read(self.local, self.variant("file", self.local)), "local\n" + COMMON)
+        self.assertEqual(self.read(self.local, self.variant("file", self.remote)), "remote\n" + COMMON)
+
+
+# Content of the common version is not kept, the remote version of the file cannot be
+# recreated from the remote delta (it copies the locally changed first line)
+class UnresolvedConflictTest(TwoNodesTest):
+    MERGE_MAX_BYTES = 0
+
+    def test_patch_is_requested_again(self):
+        _, remote_patch = self.diverge("file", COMMON, LOCAL, REMOTE)
+        self.apply(self.local, remote_patch)
+
+        # Nothing is lost, the local file is unchanged until the patch is resolved
+        self.assertEqual(self.files(self.local), ["file"])
+        self.assertEqual(self.read(self.local, "file"), LOCAL)
+
+        # Request sent by anti-entropy and its answer
+        with self.local.file_version_control("file") as file_vcs:
+            parent = file_vcs.unresolved_parent()
+            signature = file_vcs.version_history.last_signature()
+        self.assertEqual(parent, (remote_patch.parent_length, remote_patch.parent_chain))
+
+        with self.remote.file_version_control("file") as file_vcs:
+            answer = file_vcs.patch_since(parent[0], parent[1], signature)
+        self.apply(self.local, answer)
+
+        self.assertEqual(self.read(self.local, self.variant("file", self.local)), LOCAL)
+        self.assertEqual(self.read(self.local, self.variant("file", self.remote)), REMOTE)
+        self.assertEqual(self.local.store.unresolved_patches("file"), [])
+
+
+class UnresolvedLargeFileConflictTest(UnresolvedConflictTest):
+    MERGE_MAX_BYTES = 1024
+
+
+# Objects as pickled by the first versions (see git history): histories with all commits
+# and their signatures, patches with the sender's whole history
+def baseline_object(cls, state):
+    obj = cls.__new__(cls)
+    obj.__dict__ = state
+    return pickle.dumps(obj, protocol=3)
+
+
+def baseline_commit(author="host1"):
+    result = commit()
+    result.author = author
+    return result
+
+
+def chain(commits):
+    result = vcs.EMPTY_CHAIN
+    for c in commits:
+        result = vcs.chain_digest(result, c)
+    return result
+
+
+class BaselineMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        self.metapath = os.path.join(self.root, ".sync")
+        os.makedirs(self.metapath)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, path, content):
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def delta(self, old, new):
+        backend = rdiff.NativeBackend()
+        signature = backend.signature(self.write(os.path.join(self.root, "old.tmp"), old))
+        delta = backend.delta(signature, self.write(os.path.join(self.root, "new.tmp"), new))
+
+        os.remove(os.path.join(self.root, "old.tmp"))
+        os.remove(os.path.join(self.root, "new.tmp"))
+        return delta
+
+    def test_waiting_patches(self):
+        commits = [baseline_commit("host1"), baseline_commit("host2"), baseline_commit("host2")]
+        versions = [b"v1\n", b"v1\nv2\n", b"v1\nv2\nv3\n"]
+
+        self.write(os.path.join(self.root, "a.txt"), versions[0])
+        self.write(os.path.join(self.metapath, "a.txt.version"),
+                   baseline_object(vcs.VersionHistory, {"commits": commits[:1], "signatures": [b"signature"]}))
+
+        # Patches received out of order, the first one was not applied before the upgrade
+        for n in (2, 3):
+            patch = baseline_object(vcs.FilePatch, {"file_basename": "a.txt", "commits": commits[:n],
+                                                    "delta": self.delta(versions[n - 2], versions[n - 1])})
+            self.write(os.path.join(self.metapath, "a.txt.patch" + str(commits[n - 1].id)), patch)
+
+        node = vcs.VCS(self.root)
+
+        self.assertTrue(all(name.startswith(vcs.METADATA_STORE_NAME) for name in os.listdir(self.metapath)))
+        with open(os.path.join(self.root, "a.txt"), 'rb') as f:
+            self.assertEqual(f.read(), versions[2])
+        with node.file_version_control("a.txt") as file_vcs:
+            self.assertEqual(file_vcs.version_history.head(), chain(commits))
+        self.assertEqual(node.store.paths_with_waiting_patches(), [])
+
+    def test_patch_waiting_for_missing_parent(self):
+        commits = [baseline_commit(), baseline_commit(), baseline_commit()]
+        self.write(os.path.join(self.root, "a.txt"), b"")
+        self.write(os.path.join(self.metapath, "a.txt.patch" + str(commits[2].id)),
+                   baseline_object(vcs.FilePatch, {"file_basename": "a.txt", "commits": commits,
+                                                   "delta": self.delta(b"v2\n", b"v3\n")}))
+
+        node = vcs.VCS(self.root)
+
+        self.assertEqual(node.store.waiting_patches("a.txt"), [(chain(commits), chain(commits[:2]))])
+        patch = vcs.FilePatch.from_bytes(node.store.load_waiting_patch("a.txt", chain(commits)))
+        self.assertEqual((patch.relative_path, patch.parent_length, [c.id for c in patch.commits]),
+                         ("a.txt", 2, [commits[2].id]))
+
+    # Baseline named variants by inserting the node name before the extension
+    def test_variants_of_conflicted_file(self):
+        common = baseline_commit("host1")
+        commits = {"host1": [common, baseline_commit("host1")], "host2": [common, baseline_commit("host2")]}
+
+        self.write(os.path.join(self.metapath, "b.txt.conflicted"), b"")
+        for host, history in commits.items():
+            self.write(os.path.join(self.root, "b%s.txt" % host), host.encode() + b"\n")
+            self.write(os.path.join(self.metapath, "b%s.txt.version" % host),
+                       baseline_object(vcs.VersionHistory, {"commits": history, "signatures": [b"s1", b"s2"]}))
+
+        node = vcs.VCS(self.root)
+        self.assertEqual(node.store.variants("b.txt"), ["bhost1.txt", "bhost2.txt"])
+
+        # Patch continuing the second node's version goes to its variant
+        patch = vcs.FilePatch()
+        patch.relative_path = "b.txt"
+        patch.parent_length, patch.parent_chain = 2, chain(commits["host2"])
+        patch.commits = [commit()]
+        patch.delta = self.delta(b"host2\n", b"host2 changed\n")
+        with node.file_version_control("b.txt") as file_vcs:
+            file_vcs.apply_patches([vcs.FilePatch.from_bytes(patch.to_bytes())])
+
+        with open(os.path.join(self.root, "bhost2.txt"), 'rb') as f:
+            self.assertEqual(f.read(), b"host2 changed\n")
+        with open(os.path.join(self.root, "bhost1.txt"), 'rb') as f:
+            self.assertEqual(f.read(), b"host1\n")
+
+
+class VariantsTest(TwoNodesTest):
+    MERGE_MAX_BYTES = 0
+
+    def test_conflict_splits_file(self):
+        self.apply(self.local, self.diverge("file", "common\n", "local\n", "remote\n")[1])
+
+        local, remote = self.variant("file", self.local), self.variant("file", self.remote)
+        self.assertEqual(self.files(self.local), sorted([local, remote]))
+        self.assertEqual(self.read(self.local, local), "local\n")
+        self.assertEqual(self.read(self.local, remote), "remote\n")
+
+    def test_patch_of_conflicted_file_goes_to_variant(self):
+        self.apply(self.local, self.diverge("file", "common\n", "local\n", "remote\n")[1])
+
+        # Remote node does not know about the conflict yet
+        patch = self.commit(self.remote, "file", "remote 2\n")
+        self.apply(self.local, patch)
+
+        remote = self.variant("file", self.remote)
+        self.assertEqual(self.read(self.local, remote), "remote 2\n")
+
+        # Entry of the variant is back in the cache
+        history, _, _ = self.local.histories.take(remote)
+        self.assertEqual(history.head(), patch.head_chain())
+
+
+if __name__ == '__main__':
+    unittest.main()